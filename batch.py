@@ -0,0 +1,198 @@
+'''
+The upload batch format: door events and sensor buckets, delta and
+varint encoded, then deflated if there is a compressor. Plain Python
+with no firmware imports, the host decoder uses this module as is.
+
+  b"CDB1", flags (1: everything after is zlib deflated), then
+  device id (length, bytes), time the batch was built
+  events: count, then per event
+    seq - previous seq, zigzag(time - previous time), door, event,
+    tenths of a second + 1 (0 for none)
+  samples: count, bucket seconds, field names (length, "a,b,..."),
+  then per bucket
+    (start - previous start) / bucket seconds, and per field its count
+    and, if that is not 0,
+      zigzag(mean - previous mean), mean - min, max - mean
+    in 1 / SCALES[field] units
+  wakes (may be left out): count, then per wake
+    zigzag(time woken - previous), ms awake, schedule error + 1 (0 for
+    none) and if there is one zigzag(scheduled time - time woken),
+    notification latency ms + 1 (0 for none)
+
+Every number is an unsigned LEB128 varint and every "previous" starts at
+0, so the first record carries the full values. Schedule errors are
+zigzag ms, how late a scheduled move started.
+'''
+
+MAGIC = b"CDB1"
+DEFLATED = 1
+SCALES = {"temperature": 100,"pressure": 10,"humidity": 10,"lux": 10}
+
+
+def _varint(out,value):
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+
+def _zigzag(value):
+  return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+  return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+def _bytes(out,data):
+  _varint(out,len(data))
+  out.extend(data)
+
+
+def encode(device,now,events,samples,seconds,fields,compress=None,wakes=()):
+  '''
+  events are eventlog records, samples rollup entries (start, then min,
+  max, sum and count of every field), wakes (time, ms awake, scheduled,
+  error ms, latency ms) with None for what a wake did not have.
+  compress(bytes) returns the zlib stream, or None to send it as it is.
+  '''
+  body = bytearray()
+  _bytes(body,device)
+  _varint(body,now)
+
+  _varint(body,len(events))
+  seq = t = 0
+  for record in events:
+    _varint(body,record[0] - seq)
+    _varint(body,_zigzag(record[1] - t))
+    _varint(body,record[2])
+    _varint(body,record[3])
+    duration = record[4]
+    _varint(body,0 if duration != duration else int(duration * 10 + 0.5) + 1)
+    seq,t = record[0],record[1]
+
+  _varint(body,len(samples))
+  _varint(body,seconds)
+  _bytes(body,",".join(fields).encode())
+  start = 0
+  means = [0] * len(fields)
+  for entry in samples:
+    _varint(body,(entry[0] - start) // seconds)
+    start = entry[0]
+    for i in range(len(fields)):
+      count = entry[4 + i * 4]
+      _varint(body,count)
+      if not count:
+        continue
+      scale = SCALES.get(fields[i],100)
+      mean = int(round(entry[3 + i * 4] / count * scale))
+      _varint(body,_zigzag(mean - means[i]))
+      _varint(body,max(mean - int(round(entry[1 + i * 4] * scale)),0))
+      _varint(body,max(int(round(entry[2 + i * 4] * scale)) - mean,0))
+      means[i] = mean
+
+  _varint(body,len(wakes))
+  t = 0
+  for woke,awake,scheduled,error,latency in wakes:
+    _varint(body,_zigzag(woke - t))
+    _varint(body,awake)
+    if error is None:
+      _varint(body,0)
+    else:
+      _varint(body,_zigzag(error) + 1)
+      _varint(body,_zigzag(scheduled - woke))
+    _varint(body,0 if latency is None else latency + 1)
+    t = woke
+
+  packed = compress(bytes(body)) if compress else None
+  if packed is not None and len(packed) < len(body):
+    return MAGIC + bytes((DEFLATED,)) + packed
+  return MAGIC + bytes((0,)) + bytes(body)
+
+
+class _Reader:
+
+  def __init__(self,data):
+    self.data = data
+    self.pos = 0
+
+  def varint(self):
+    value = shift = 0
+    while True:
+      byte = self.data[self.pos]
+      self.pos += 1
+      value |= (byte & 0x7f) << shift
+      if not byte & 0x80:
+        return value
+      shift += 7
+
+  def zigzag(self):
+    return _unzigzag(self.varint())
+
+  def bytes(self):
+    length = self.varint()
+    self.pos += length
+    return self.data[self.pos - length:self.pos]
+
+
+def decode(payload,decompress=None):
+  '''
+  A batch back as a dict, the events as (seq, time, door, event,
+  seconds), the samples as (start, {field: (min, max, mean, count)}) and
+  the wakes as they were given to encode().
+  decompress is zlib.decompress or the like.
+  '''
+  if payload[:4] != MAGIC:
+    raise ValueError("not a batch")
+  body = payload[5:]
+  if payload[4] & DEFLATED:
+    body = decompress(body)
+  reader = _Reader(body)
+  device = reader.bytes()
+  now = reader.varint()
+
+  events = []
+  seq = t = 0
+  for _ in range(reader.varint()):
+    seq += reader.varint()
+    t += reader.zigzag()
+    door = reader.varint()
+    event = reader.varint()
+    duration = reader.varint()
+    events.append((seq,t,door,event,None if duration == 0 else (duration - 1) / 10))
+
+  count = reader.varint()
+  seconds = reader.varint()
+  fields = reader.bytes().decode().split(",")
+  samples = []
+  start = 0
+  means = [0] * len(fields)
+  for _ in range(count):
+    start += reader.varint() * seconds
+    values = {}
+    for i in range(len(fields)):
+      n = reader.varint()
+      if not n:
+        continue
+      scale = SCALES.get(fields[i],100)
+      means[i] += reader.zigzag()
+      low = means[i] - reader.varint()
+      high = means[i] + reader.varint()
+      values[fields[i]] = (low / scale,high / scale,means[i] / scale,n)
+    samples.append((start,values))
+
+  wakes = []
+  t = 0
+  for _ in range(reader.varint() if reader.pos < len(body) else 0):
+    t += reader.zigzag()
+    awake = reader.varint()
+    error = reader.varint()
+    scheduled = None
+    if error:
+      error = _unzigzag(error - 1)
+      scheduled = t + reader.zigzag()
+    else:
+      error = None
+    latency = reader.varint()
+    wakes.append((t,awake,scheduled,error,latency - 1 if latency else None))
+  return {"device": device,"time": now,"events": events,"seconds": seconds,"samples": samples,"wakes": wakes}
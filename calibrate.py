@@ -0,0 +1,220 @@
+'''
+Motor tuning found by experiment instead of typed in. Holding both
+buttons at power on starts it, see ChickenDoor.calibrate().
+
+Each door runs open/close cycles from the close limit with a rising top
+speed, at a rising ramp rate. A stalled motor keeps stepping but the
+door stops, so a move is taken as stalled once the limit switch is late
+by more than LATE on what the profile predicts. After a stall the door
+crawls back to the close limit at motor_min before the next cycle.
+
+The fastest clean profile, less margin, is run once more to confirm it,
+and every door's result has to be confirmed before anything is stored.
+The doors share one motor_tuning in config.json, so the slowest door's
+profile is the one saved. The report (travel times before and after,
+every cycle tried) goes to calibration.json and the log.
+'''
+import json
+import utime
+
+# a move is stalled once it runs this much longer than the profile predicts
+LATE = 1.25
+LATE_S = 1
+# the top speed goes up by SPEED_STEP a cycle, the ramp by RAMP_STEP a round
+SPEED_STEP = 1.15
+RAMP_STEP = 1.5
+
+
+class Calibrator:
+
+  def __init__(self,door,margin=0.2,speed_limit=3,ramp_limit=4):
+    self.door = door
+    self.stepper = door.stepper
+    self.margin = margin
+    stepper = self.stepper
+    self.original = (stepper.motor_max,stepper.ramp_steps,stepper.ramp_time)
+    # never tried past these, whether it stalls or not
+    self.max_speed = stepper.motor_max * speed_limit
+    self.max_ramp = stepper.ramp_steps * ramp_limit
+    # (motor_max, ramp_steps, open s, close s), None for a stalled move
+    self.trials = []
+    self.before = None
+    self.after = None
+    self.profile = None
+
+  def move(self,operation,motor_max,ramp_steps):
+    '''
+    One full move at this profile, seconds or None if it stalled (or
+    could not start).
+    '''
+    door = self.door
+    self.stepper.tune(motor_max,ramp_steps,self.original[2])
+    if operation == "open":
+      door.open(notify=False,percent=100)
+    else:
+      door.close(notify=False)
+    if not door.moving():
+      return None
+    # stalls are expected in here, the move runs on its own deadline and
+    # stays out of the travel time model
+    door.stall_deadline = None
+    door.move_clean = False
+    eta = self.stepper.eta()
+    limit = door.operation_timeout if eta is None else eta * LATE + LATE_S
+    deadline = utime.ticks_add(utime.ticks_ms(),int(limit * 1000))
+    while door.moving() and utime.ticks_diff(deadline,utime.ticks_ms()) > 0:
+      utime.sleep_ms(20)
+    if door.moving():
+      door.log.info("{0}: no limit after {1:.1f}s, stalled".format(door.name,limit))
+      door.disable_motor()
+      door.operation_done.signal()
+      return None
+    door.operation_done.wait()
+    return door.telemetry["last_travel"]
+
+  def home(self):
+    # back to the close limit at motor_min, where nothing stalls
+    if self.door.close_limit.value() == 1:
+      return True
+    minimum = self.stepper.motor_min
+    return self.move("close",minimum,self.original[1]) is not None
+
+  def trial(self,motor_max,ramp_steps):
+    # an open/close cycle, (open s, close s) or None if either stalled
+    for speed,ramp,opened,closed in self.trials:
+      if speed == motor_max and ramp == ramp_steps:
+        return (opened,closed) if closed is not None else None
+    opened = self.move("open",motor_max,ramp_steps)
+    closed = None
+    if opened is not None:
+      closed = self.move("close",motor_max,ramp_steps)
+    self.trials.append((motor_max,ramp_steps,opened,closed))
+    self.door.log.info("{0}: {1}Hz, {2} per {3}ms: {4}".format(self.door.name,motor_max,ramp_steps,self.original[2],
+                       "open {0:.1f}s close {1:.1f}s".format(opened,closed) if closed is not None else "stalled"))
+    if closed is None:
+      if not self.home():
+        raise OSError("{0}: could not get back to the close limit".format(self.door.name))
+      return None
+    return opened,closed
+
+  def fastest(self,ramp_steps,speed):
+    '''
+    Highest top speed that runs clean at this ramp, searched from speed:
+    up while it passes, down while it stalls, then once between the last
+    pass and the first stall. (speed, (open s, close s)) or None.
+    '''
+    passed = None
+    stalled = None
+    while passed is None or stalled is None:
+      times = self.trial(speed,ramp_steps)
+      if times:
+        passed = (speed,times)
+        if speed >= self.max_speed:
+          return passed
+        speed = min(int(speed * SPEED_STEP),self.max_speed)
+      else:
+        stalled = speed
+        if passed:
+          break
+        speed = int(speed / SPEED_STEP)
+        if speed <= self.stepper.motor_min:
+          return None
+    middle = (passed[0] + stalled) // 2
+    if passed[0] < middle < stalled:
+      times = self.trial(middle,ramp_steps)
+      if times:
+        passed = (middle,times)
+    return passed
+
+  def run(self):
+    '''
+    Returns the profile it settled on, (motor_max, ramp_steps, ramp_time),
+    and leaves the stepper tuned to it. None leaves the tuning as it was.
+    '''
+    stepper = self.stepper
+    ramp_time = self.original[2]
+    try:
+      if not self.home():
+        raise OSError("{0}: could not get to the close limit".format(self.door.name))
+      self.before = self.trial(self.original[0],self.original[1])
+      best = None
+      speed,ramp = self.original[0],self.original[1]
+      while ramp <= self.max_ramp:
+        found = self.fastest(ramp,speed)
+        if found is None:
+          break
+        total = found[1][0] + found[1][1]
+        if best and total >= best[0]:
+          # a steeper ramp bought nothing
+          break
+        best = (total,found[0],ramp)
+        speed = found[0]
+        ramp = max(int(ramp * RAMP_STEP),ramp + 1)
+
+      if best is not None:
+        # back off from the edge the search found, then make sure of it
+        speed = max(int(best[1] * (1 - self.margin)),stepper.motor_min)
+        ramp = max(int(best[2] * (1 - self.margin)),1)
+        self.after = self.trial(speed,ramp)
+        if self.after is not None:
+          self.profile = (speed,ramp,ramp_time)
+    except OSError as e:
+      self.door.log.info(str(e))
+    stepper.tune(*(self.profile or self.original))
+    return self.profile
+
+  def result(self):
+    return {"before": self.before,"after": self.after,"original": self.original,
+            "profile": self.profile,"trials": self.trials}
+
+
+def report(results,tuning):
+  lines = []
+  for name,result in results.items():
+    for label in ("before","after"):
+      times = result[label]
+      profile = result["original"] if label == "before" else result["profile"]
+      if profile is None:
+        lines.append("{0}: {1} -".format(name,label))
+        continue
+      lines.append("{0}: {1} {2} at {3}Hz, {4} per {5}ms".format(name,label,
+                   "open {0:.1f}s close {1:.1f}s".format(*times) if times else "stalled",*profile))
+    stalls = len([trial for trial in result["trials"] if trial[3] is None])
+    lines.append("{0}: {1} cycles, {2} stalled".format(name,len(result["trials"]),stalls))
+  if tuning:
+    lines.append("saved motor_max {0}, ramp_steps {1}, ramp_time {2}".format(*tuning))
+  else:
+    lines.append("not every door calibrated, the tuning is unchanged")
+  return lines
+
+
+def run(controller,margin=0.2,filename="calibration.json"):
+  '''
+  Calibrates every door and saves the slowest door's profile as the
+  motor tuning in config.json. Returns the report lines.
+  '''
+  results = {}
+  profiles = []
+  for door in controller.doors:
+    calibrator = Calibrator(door,margin)
+    profiles.append(calibrator.run())
+    results[door.name] = calibrator.result()
+
+  tuning = None
+  if profiles and None not in profiles:
+    tuning = (min(profile[0] for profile in profiles),min(profile[1] for profile in profiles),profiles[0][2])
+    controller.json_config['motor_tuning'].update({"motor_max": str(tuning[0]),"ramp_steps": str(tuning[1]),
+                                                   "ramp_time": str(tuning[2])})
+    with open("config.json",'w',encoding = 'utf-8') as f:
+      f.write(json.dumps(controller.json_config))
+    for door in controller.doors:
+      # the old travel times no longer apply
+      door.stepper.tune(*tuning)
+      door.travel_model.reset()
+
+  lines = report(results,tuning)
+  with open(filename,'w',encoding = 'utf-8') as f:
+    f.write(json.dumps({"doors": results,"tuning": tuning,"report": lines}))
+  for line in lines:
+    controller.log.info(line)
+  return lines
@@ -0,0 +1,31 @@
+import _thread
+
+
+class Completion:
+  '''
+  Signals the end of a door move to whoever is waiting on it. begin() when
+  the motor starts, signal() once the move is finished (and notified),
+  wait() blocks until then.
+
+  MicroPython locks have no acquire timeout, so the mover must guarantee
+  signal() is called. The stall timer armed for every move does that.
+  '''
+
+  def __init__(self):
+    self._lock = _thread.allocate_lock()
+    self.pending = False
+
+  def begin(self):
+    if not self.pending:
+      self._lock.acquire()
+      self.pending = True
+
+  def signal(self):
+    if self.pending:
+      self.pending = False
+      self._lock.release()
+
+  def wait(self):
+    if self.pending:
+      self._lock.acquire()
+      self._lock.release()
@@ -0,0 +1,402 @@
+from machine import Pin
+from stepper import Stepper
+from travel_model import TravelModel
+from completion import Completion
+from door_state import DoorState
+import door_state
+import travel_model
+import micropython
+import utime
+from time import sleep
+
+# notification messages as bytes so they can be copied into the payload buffer
+MSG_OPENED = b"Door Opened!"
+MSG_CLOSED = b"Door Closed!"
+MSG_OBSTRUCTED = b"!!! Check the door !!!"
+MSG_STALLED = b"!!! Door stalled, check the door !!!"
+MSG_FAULT = b"!!! Both limit switches made, check the wiring !!!"
+
+# the original single door wiring, used when config.json has no "doors" list
+DEFAULT_PINS = {
+  "name": "door",
+  "stp": 27,
+  "dir": 26,
+  "slp": 14,
+  "close_limit": 32,
+  "open_limit": 33,
+  "obstruction_limit": 35,
+}
+
+
+class Door:
+  '''
+  One door: its stepper driver, limit switches, saved state and travel
+  history. The ChickenDoor controller owns the shared parts (buttons,
+  network, schedule, sleep) and drives any number of these.
+  '''
+
+  def __init__(self,controller,pins,index=0):
+    self.controller = controller
+    self.log = controller.log
+    self.index = index
+    self.name = pins.get("name","door{0}".format(index))
+    self.name_bytes = self.name.encode()
+    # the first door keeps the original file names so existing boards carry on
+    suffix = "" if index == 0 else "_" + self.name
+    self.state_file = "state{0}.txt".format(suffix)
+
+    self.slp = Pin(pins["slp"],Pin.OUT,None)
+    self.stp = Pin(pins["stp"],Pin.OUT) #step when stepper mode
+    self.dir = Pin(pins["dir"],Pin.OUT) #dir when stepper mode
+
+    # the switches are debounced by the controller's input scanner, it
+    # calls limit_handler on the clean rising edges
+    self.inputs = controller.inputs
+    # close_limit stops the motor when closing - normally closed
+    self.close_limit = self.inputs.watch(pins["close_limit"],self.limit_handler,irq=False)
+    # open_limit stops the motor when opening - normally closed
+    self.open_limit = self.inputs.watch(pins["open_limit"],self.limit_handler,irq=False)
+    # obstruction_limit stops the motor while closing, but before
+    # the close limit. in case theres an obstruction. The motor mount will flex
+    # and touch the switch. Copied from the "ladies first" door.- normally closed
+    # It lets go once the motor is off, so its own irq edge is trusted.
+    self.obstruction_limit = self.inputs.watch(pins["obstruction_limit"],self.limit_handler,irq=False,latch=True)
+
+    # Setup interrupts for the limit switches. The hard irq only stops the
+    # motor and starts the scanner. Bound once, a hard irq cant allocate
+    # the bound method. Both edges, the scanner has to see a limit let go
+    # too or a move that stops short of the other end (a stall, a part
+    # open) leaves it with a stale level
+    self._kick = self.inputs.kick
+    self.open_limit.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self.limit_irq, hard=True)
+    self.close_limit.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self.limit_irq, hard=True)
+    self.obstruction_limit.irq(trigger=Pin.IRQ_RISING, handler=self.limit_irq, hard=True)
+
+    self.slp_status = False
+    self.close_dir = True
+    self.open_dir = False
+    self.invert_dir = pins.get("invert_dir",controller.invert_dir)
+    self.open_percent = controller.open_percent
+    self.operation_timeout = controller.operation_timeout
+    self.stepper = Stepper(self.stp,self.slp,controller.motor_min,controller.motor_max,
+                           controller.motor_ramp_time,controller.motor_ramp_steps,
+                           approach_steps=controller.approach_steps,
+                           count_pin=pins.get("count_pin",None),counter_unit=index,
+                           travel_file="travel{0}.json".format(suffix))
+    self.travel_model = TravelModel(filename="travel{0}.bin".format(suffix))
+    self.operation_done = Completion()
+
+    self.operation = None
+    self.close_attempts = 0
+    self.pending_operation = False
+    self.pending_operation_time = 0
+    self.move_clean = False
+    self.operation_start_ms = 0
+    self.stall_deadline = None
+
+    # per door telemetry, reported alongside the shared site state
+    self.telemetry = {"opens": 0, "closes": 0, "obstructions": 0, "stalls": 0, "last_travel": None, "stop_us": None}
+
+    # check for a state file and set
+    self.target = self.get_target_state()
+
+    # a part open door parked by step count has no switch to show for it
+    initial = door_state.BETWEEN
+    if self.target == "open" and self.open_percent < 100 and self.stepper.position:
+      initial = door_state.PARTIAL
+    # the first check_limits() reads the switches, a fault found then is
+    # reported like any other
+    self.state = DoorState(initial,clock=utime.ticks_ms)
+
+  def feed(self,event):
+    before = self.state.state
+    state = self.state.feed(event)
+    if state == door_state.FAULT and before != door_state.FAULT:
+      self.fault()
+    return state
+
+  def read_switches(self):
+    # both limits from one register read, straight in as the event
+    return self.feed(self.inputs.pair(self.open_limit,self.close_limit))
+
+  def fault(self):
+    # both limits made: a broken wire or a stuck switch. The door holds
+    # where it is until the switches read sensibly again
+    self.log.info("{0}: both limit switches made, holding the door".format(self.name))
+    if self.moving():
+      self.disable_motor()
+      self.operation_done.signal()
+    self.controller.door_event(self,"fault")
+    if self.controller.mode == "auto":
+      self.notify("fault",MSG_FAULT,1)
+
+  def notify(self,event,message,priority=0):
+    # the controller's notification policy decides if and when it goes out
+    self.controller.notify(self,message,priority,event)
+
+  def limit_irq(self,pin):
+    # hard irq, no allocation. The switch the door is heading for cuts the
+    # step pulses right on the first edge, before any debouncing
+    edge = utime.ticks_us()
+    if pin == self.open_limit:
+      if self.operation == "open":
+        self.stepper.halt(edge)
+    elif self.operation == "close":
+      self.stepper.halt(edge)
+    try:
+      micropython.schedule(self._kick,pin)
+    except RuntimeError:
+      # queue full of this switch's own bounce
+      pass
+
+  def limit_handler(self,pin):
+    if pin != self.obstruction_limit and self.read_switches() == door_state.FAULT:
+      return
+    if pin == self.open_limit:
+      # The door is open, disable the driver!
+      if self.operation == "open":
+        self.stepper.at_limit(opened=True)
+        self.operation_complete()
+    elif pin == self.close_limit:
+      # The door is closed, disable the driver!
+      if self.operation == "close":
+        self.stepper.at_limit(opened=False)
+        self.operation_complete()
+    elif pin == self.obstruction_limit:
+      if self.obstruction_limit.value() == 1:
+        self.telemetry["obstructions"] += 1
+        self.controller.door_event(self,"obstructed")
+        if self.close_attempts < 2:
+          # The door encountered an obstruction while closing!
+          # disable the driver, change direction, and reenable? maybe just change direction??
+          self.log.info("{0}: Hit an obstruction".format(self.name))
+          self.move_clean = False
+          self.disable_motor()
+          self.dir.value(not self.dir.value())
+          self.enable_motor()
+          sleep(3)
+          self.disable_motor()
+          self.dir.value(not self.dir.value())
+          self.enable_motor()
+          self.close_attempts += 1
+        else:
+          if self.controller.mode == "auto":
+            self.disable_motor()
+            # sent inline so it is out before the monitor is told the move is done
+            self.notify("obstructed",MSG_OBSTRUCTED,1)
+
+          self.open()
+          if not self.moving():
+            # it never left the open limit, no switch will end this move
+            self.operation_done.signal()
+
+  def operation_complete(self):
+    # The door reached the end of the move, either a limit switch or a
+    # partial open position counted out by the stepper.
+    self.disable_motor()
+    seconds = utime.ticks_diff(utime.ticks_ms(),self.operation_start_ms) / 1000
+    if self.move_clean and self.stepper.target is None:
+      # only full, uninterrupted moves teach the travel time model
+      self.travel_model.record(self.model_direction(),seconds)
+    self.move_clean = False
+    self.telemetry["last_travel"] = seconds
+    if self.stepper.halted():
+      # limit edge to the step output cut, from the hard irq
+      self.telemetry["stop_us"] = self.stepper.halt_latency_us
+    if self.operation == "open":
+      self.log.info("{0}: Door has been opened".format(self.name))
+      self.telemetry["opens"] += 1
+      event,message = "opened",MSG_OPENED
+    else:
+      self.log.info("{0}: Door has been closed".format(self.name))
+      self.telemetry["closes"] += 1
+      event,message = "closed",MSG_CLOSED
+    self.controller.door_event(self,event,seconds)
+    if self.controller.mode == "auto":
+      self.notify(event,message)
+    self.operation_done.signal()
+
+  def stall_handler(self):
+    # The move took longer than the travel time model allows. Something is
+    # jammed without hitting the obstruction switch, stop before it gets worse.
+    self.feed(door_state.STALL)
+    self.log.info("{0}: Door stalled, move took longer than expected".format(self.name))
+    self.telemetry["stalls"] += 1
+    self.controller.door_event(self,"stalled")
+    self.move_clean = False
+    self.disable_motor()
+    if self.controller.mode == "auto":
+      self.notify("stalled",MSG_STALLED,1)
+    self.operation_done.signal()
+
+  def tick(self):
+    # called from the controller's motion timer while this door moves
+    self.stepper.tick()
+    if self.stall_deadline is not None and utime.ticks_diff(utime.ticks_ms(),self.stall_deadline) > 0:
+      self.stall_handler()
+
+  def moving(self):
+    return self.stepper.moving()
+
+  def model_direction(self):
+    if self.operation == "open":
+      return travel_model.OPEN
+    return travel_model.CLOSE
+
+  def target_reached(self):
+    # the stepper counted out a part open position
+    self.feed(door_state.ARRIVED)
+    self.operation_complete()
+
+  def disable_motor(self):
+    self.feed(door_state.STOP)
+    self.stall_deadline = None
+    self.pending_operation = False
+    self.pending_operation_time = 0
+    self.stepper.stop()
+
+  def motor_direction(self):
+    # which way the dir pin is driving the door, 1 is opening
+    open_level = self.open_dir
+    if self.invert_dir:
+      open_level = not self.open_dir
+    if self.dir.value() == open_level:
+      return 1
+    return -1
+
+  def enable_motor(self,target=None):
+    self.stepper.sync(self.open_limit.value(),self.close_limit.value())
+    on_target = None
+    if target is not None:
+      on_target = self.target_reached
+    direction = self.motor_direction()
+    self.feed(door_state.GO_OPEN if direction > 0 else door_state.GO_CLOSE)
+    self.operation_done.begin()
+    self.stepper.start(direction,target=target,on_target=on_target)
+    self.pending_operation = True
+    self.pending_operation_time = utime.time()
+    bound = self.travel_model.bound(self.model_direction(),self.operation_timeout)
+    self.stall_deadline = utime.ticks_add(utime.ticks_ms(),int(bound * 1000))
+    self.controller.motion_started()
+    eta = self.stepper.eta(target)
+    if self.operation == "close":
+      self.log.info("{0}: closing the door...".format(self.name))
+    elif self.operation == "open":
+      self.log.info("{0}: opening the door...".format(self.name))
+    if eta is not None:
+      self.log.info("expecting to finish in {0}".format(self.controller.convert_time(eta)))
+
+  def manual(self,operation):
+    # a manual button press starts the door, the next press stops it
+    self.operation = operation
+    self.slp_status = not self.slp_status
+    if self.slp_status:
+      if operation == "open":
+        self.open(notify=False)
+      else:
+        self.close(notify=False)
+    else:
+      self.disable_motor()
+      self.operation_done.signal()
+
+  def close(self,notify=True,duration=None,attempt=0):
+    with self.controller.mem.track("close"):
+      #sleep(0.5)
+      with open(self.state_file,'w',encoding = 'utf-8') as f:
+        f.write("closed")
+      self.target = "closed"
+
+      if self.invert_dir:
+        self.dir.value(not self.close_dir)
+      else:
+        self.dir.value(self.close_dir)
+
+      if self.state.state == door_state.FAULT:
+        self.log.info("{0}: limit switch fault, not closing".format(self.name))
+        return
+      if self.close_limit.value() == 1:
+        self.log.info("{0}: Door is already closed!".format(self.name))
+        return
+      else:
+        self.operation = "close"
+        self.operation_start_ms = utime.ticks_ms()
+        # only a full move from the open limit teaches the travel time model
+        self.move_clean = self.open_limit.value() == 1
+        self.enable_motor()
+
+  def open(self,notify=True,duration=None,percent=None):
+    with self.controller.mem.track("open"):
+      if percent is None:
+        percent = self.open_percent
+
+      #sleep(0.5)
+      with open(self.state_file,'w',encoding = 'utf-8') as f:
+        f.write("open")
+      self.target = "open"
+
+      if self.invert_dir:
+        self.dir.value(not self.open_dir)
+      else:
+        self.dir.value(self.open_dir)
+
+      if self.state.state == door_state.FAULT:
+        self.log.info("{0}: limit switch fault, not opening".format(self.name))
+        return
+      if self.open_limit.value() == 1:
+        self.log.info("{0}: Door is already open!".format(self.name))
+        return
+      else:
+        self.operation = "open"
+        target = None
+        if percent < 100 and self.stepper.travel:
+          # partial open, the stepper counts out the steps and stops short of the limit
+          target = (self.stepper.travel * percent) // 100
+        self.operation_start_ms = utime.ticks_ms()
+        # only a full move from the close limit teaches the travel time model
+        self.move_clean = target is None and self.close_limit.value() == 1
+        self.enable_motor(target=target)
+
+  def get_target_state(self):
+    try:
+      f = open(self.state_file,'r',encoding= 'utf-8')
+      target_state = f.read()
+      if target_state == "open":
+        return "open"
+      elif target_state == "closed":
+        return "closed"
+      else:
+        # any other value means something is probably corrupt and needs to be reset
+        return None
+    except OSError:
+       # Couldnt read the file, Probably means it doesnt exist.
+       return None
+
+  def check_limits(self):
+    '''
+    {"target": ..., "actual": ...} for the door, from one read of both
+    limit switches through the state machine. actual is closed, open,
+    opening, closing, unknown (stopped between the switches) or fault.
+    The result is shared, callers only ever read it.
+    '''
+    return door_state.status(self.target,self.read_switches())
+
+  def sync_state(self):
+    '''
+    Ensure the door matches the intended target state.
+    If it doesn't, either open/close as the state.txt file
+    states.
+    '''
+    todo = door_state.action(self.target,self.read_switches())
+    if todo == door_state.DO_OPEN:
+      self.log.info("{0}: door isnt open, and config says it should be, open it!".format(self.name))
+      self.open()
+    elif todo == door_state.DO_CLOSE:
+      if self.target is None:
+        # no state data, probably newly flashed firmware or the door has
+        # been reset. The door should close by default...
+        self.log.info("{0}: Target isn't defined. Closing the door as default.".format(self.name))
+      else:
+        self.log.info("{0}: door isnt closed, and config says it should be, close it!".format(self.name))
+      self.close()
+    elif todo == door_state.HOLD:
+      self.log.info("{0}: limit switch fault, leaving the door where it is".format(self.name))
@@ -0,0 +1,134 @@
+'''
+Door state machine. The door is always in one of STATES, and everything
+that happens to it is one of EVENTS: a reading of both limit switches,
+a move starting, stopping, reaching a counted position or stalling.
+The next state is one lookup in TABLE. Both switches made is a FAULT
+that holds the door until the switches read sensibly again, instead of
+exiting the firmware.
+
+Switch readings are the event numbers 0-3, open << 1 | close, the same
+as InputScanner.pair() returns, so a read feeds straight in.
+
+status() and action() are lookups as well and return shared values,
+nothing is allocated per call. State changes go into a small ring that
+trace() reads back.
+
+host/door_state_check.py runs every state, event, target and switch
+combination through the tables and checks them.
+'''
+from array import array
+
+CLOSED = 0
+OPEN = 1
+BETWEEN = 2     # stopped with neither switch made
+OPENING = 3
+CLOSING = 4
+PARTIAL = 5     # parked at a counted part open position
+STALLED = 6     # the stall timer stopped a move
+FAULT = 7       # both switches made, a switch or wiring fault
+STATES = ("closed","open","between","opening","closing","partial","stalled","fault")
+
+SW_NONE = 0
+SW_CLOSED = 1
+SW_OPEN = 2
+SW_BOTH = 3
+GO_OPEN = 4
+GO_CLOSE = 5
+STOP = 6
+ARRIVED = 7
+STALL = 8
+EVENTS = ("sw_none","sw_closed","sw_open","sw_both","go_open","go_close","stop","arrived","stall")
+
+#           sw_none  sw_closed sw_open  sw_both go_open  go_close stop     arrived  stall
+_ROWS = (
+  (BETWEEN, CLOSED,  OPEN,    FAULT,  OPENING, CLOSED,  CLOSED,  CLOSED,  CLOSED),    # closed
+  (BETWEEN, CLOSED,  OPEN,    FAULT,  OPEN,    CLOSING, OPEN,    OPEN,    OPEN),      # open
+  (BETWEEN, CLOSED,  OPEN,    FAULT,  OPENING, CLOSING, BETWEEN, BETWEEN, BETWEEN),   # between
+  (OPENING, OPENING, OPEN,    FAULT,  OPENING, CLOSING, BETWEEN, PARTIAL, STALLED),   # opening
+  (CLOSING, CLOSED,  CLOSING, FAULT,  OPENING, CLOSING, BETWEEN, PARTIAL, STALLED),   # closing
+  (PARTIAL, CLOSED,  OPEN,    FAULT,  OPENING, CLOSING, PARTIAL, PARTIAL, PARTIAL),   # partial
+  (STALLED, CLOSED,  OPEN,    FAULT,  OPENING, CLOSING, STALLED, STALLED, STALLED),   # stalled
+  (BETWEEN, CLOSED,  OPEN,    FAULT,  FAULT,   FAULT,   FAULT,   FAULT,   FAULT),     # fault
+)
+TABLE = bytes(state for row in _ROWS for state in row)
+
+# what check_limits() reports as the actual position of each state
+ACTUAL = ("closed","open","unknown","opening","closing","open","unknown","fault")
+
+TARGETS = ("closed","open","unknown")
+
+# what sync_state() does about each target and state
+NOTHING = 0
+DO_OPEN = 1
+DO_CLOSE = 2
+HOLD = 3
+#        closed    open     between   opening  closing   partial   stalled   fault
+_ACTIONS = (
+  (NOTHING, DO_CLOSE, DO_CLOSE, DO_CLOSE, NOTHING, DO_CLOSE, DO_CLOSE, HOLD),   # target closed
+  (DO_OPEN, NOTHING,  DO_OPEN,  NOTHING,  DO_OPEN, NOTHING,  DO_OPEN,  HOLD),   # target open
+  (NOTHING, DO_CLOSE, DO_CLOSE, DO_CLOSE, NOTHING, DO_CLOSE, DO_CLOSE, HOLD),   # no target, close
+)
+ACTIONS = bytes(action for row in _ACTIONS for action in row)
+
+# check_limits results are shared, callers only ever read them
+STATUS = tuple({"target": target,"actual": actual} for target in TARGETS for actual in ACTUAL)
+
+TRACE = 32
+
+
+def _target(target):
+  if target == "closed":
+    return 0
+  if target == "open":
+    return 1
+  return 2
+
+
+def status(target,state):
+  return STATUS[_target(target) * len(STATES) + state]
+
+
+def action(target,state):
+  return ACTIONS[_target(target) * len(STATES) + state]
+
+
+class DoorState:
+
+  def __init__(self,state=BETWEEN,clock=None):
+    self.state = state
+    # clock() stamps the trace, utime.ticks_ms on the board
+    self.clock = clock
+    # (from << 4 | to, event) per change, oldest overwritten first
+    self._trace = bytearray(TRACE * 2)
+    self._times = array('i',[0] * TRACE)
+    self._next = 0
+    self.changes = 0
+
+  def feed(self,event):
+    state = self.state
+    new = TABLE[state * len(EVENTS) + event]
+    if new != state:
+      index = self._next
+      self._trace[index * 2] = (state << 4) | new
+      self._trace[index * 2 + 1] = event
+      if self.clock:
+        self._times[index] = self.clock()
+      self._next = (index + 1) % TRACE
+      self.changes += 1
+      self.state = new
+    return new
+
+  def name(self):
+    return STATES[self.state]
+
+  def trace(self):
+    # [(ms, from, event, to), ...] oldest first, for the REPL and status
+    count = min(self.changes,TRACE)
+    start = (self._next - count) % TRACE
+    entries = []
+    for offset in range(count):
+      index = (start + offset) % TRACE
+      packed = self._trace[index * 2]
+      entries.append((self._times[index],STATES[packed >> 4],EVENTS[self._trace[index * 2 + 1]],STATES[packed & 15]))
+    return entries
+
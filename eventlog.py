@@ -0,0 +1,99 @@
+'''
+Door events kept in flash: a fixed size ring of fixed size records in
+events.bin, the newest overwriting the oldest once it is full. Every
+record gets the next sequence number, which is what a collector passes
+back as since to fetch only what it has not seen.
+
+add() writes one record and the header, records() reads them back one
+at a time.
+'''
+import ustruct
+
+EVENTS = ("opened","closed","obstructed","stalled","fault")
+
+MAGIC = 0x4531
+HEADER = "<HHHL"        # magic, head, used, last sequence number
+# sequence number, time, door index, event, seconds (nan for none)
+RECORD = "<LlBBf"
+HEADER_SIZE = ustruct.calcsize(HEADER)
+RECORD_SIZE = ustruct.calcsize(RECORD)
+
+
+class EventLog:
+
+  def __init__(self,filename="events.bin",size=1024):
+    self.filename = filename
+    self.size = size
+    self.head = 0
+    self.used = 0
+    self.seq = 0
+    self._buf = bytearray(RECORD_SIZE)
+    self.loaded = False
+
+  def _open(self):
+    try:
+      f = open(self.filename,"r+b")
+    except OSError:
+      f = open(self.filename,"w+b")
+    if not self.loaded:
+      data = f.read(HEADER_SIZE)
+      if len(data) == HEADER_SIZE and ustruct.unpack_from("<H",data)[0] == MAGIC:
+        magic,self.head,self.used,self.seq = ustruct.unpack(HEADER,data)
+        self.used = min(self.used,self.size)
+        self.head %= self.size
+      self.loaded = True
+    return f
+
+  def add(self,t,door,event,seconds=None):
+    '''
+    door is the door's index, event one of EVENTS (anything else is not
+    kept).
+    '''
+    if event not in EVENTS:
+      return
+    f = self._open()
+    try:
+      if self.used:
+        self.head = (self.head + 1) % self.size
+      self.used = min(self.used + 1,self.size)
+      self.seq += 1
+      ustruct.pack_into(RECORD,self._buf,0,self.seq,int(t),door,EVENTS.index(event),
+                        float("nan") if seconds is None else seconds)
+      f.seek(HEADER_SIZE + self.head * RECORD_SIZE)
+      f.write(self._buf)
+      f.seek(0)
+      f.write(ustruct.pack(HEADER,MAGIC,self.head,self.used,self.seq))
+    finally:
+      f.close()
+
+  def last(self):
+    # sequence number of the newest record, 0 if there are none
+    if not self.loaded:
+      self._open().close()
+    return self.seq
+
+  def records(self,start=None,end=None,since=0,until=None):
+    '''
+    (seq, time, door index, event index, seconds) oldest first, for the
+    events from start to end with a sequence number above since, and up
+    to until (or what was there when it started).
+    '''
+    # its own buffer, add() can run from another thread meanwhile
+    buf = bytearray(RECORD_SIZE)
+    f = self._open()
+    try:
+      head,used,last = self.head,self.used,self.seq
+      if until is not None:
+        last = min(last,until)
+      first = head - used + 1
+      for slot in range(first,first + used):
+        f.seek(HEADER_SIZE + (slot % self.size) * RECORD_SIZE)
+        f.readinto(buf)
+        record = ustruct.unpack_from(RECORD,buf)
+        if record[0] <= since or record[0] > last:
+          continue
+        if (start is not None and record[1] < start) or (end is not None and record[1] >= end):
+          continue
+        yield record
+    finally:
+      f.close()
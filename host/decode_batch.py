@@ -0,0 +1,46 @@
+'''
+Decodes upload batches (see batch.py) on the collector side and prints
+them as JSON lines, one record per line.
+
+  python host/decode_batch.py batch.bin [...]
+  python host/decode_batch.py - < batch.bin
+'''
+import json
+import os
+import sys
+import zlib
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HOST))
+# eventlog wants ustruct
+sys.path.insert(0,os.path.join(HOST,"fakes"))
+import batch
+from eventlog import EVENTS
+
+
+def records(payload):
+  decoded = batch.decode(payload,zlib.decompress)
+  device = decoded["device"].hex()
+  for seq,t,door,event,seconds in decoded["events"]:
+    yield {"device": device,"kind": "event","seq": seq,"time": t,"door": door,
+           "event": EVENTS[event] if event < len(EVENTS) else event,"seconds": seconds}
+  for start,values in decoded["samples"]:
+    row = {"device": device,"kind": "sample","time": start,"seconds": decoded["seconds"]}
+    for field,(low,high,mean,count) in values.items():
+      row[field] = {"min": low,"max": high,"mean": mean,"count": count}
+    yield row
+
+
+def main():
+  for name in sys.argv[1:] or ["-"]:
+    if name == "-":
+      payload = sys.stdin.buffer.read()
+    else:
+      with open(name,"rb") as f:
+        payload = f.read()
+    for record in records(payload):
+      print(json.dumps(record))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,119 @@
+'''
+Checks the door_state.py tables on the host: every state and event, and
+every target, prior state and switch reading, against what the door
+must never do. Prints the failures and exits 1 if there are any.
+
+  python host/door_state_check.py
+'''
+import os
+import sys
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HOST))
+from door_state import ACTUAL
+from door_state import BETWEEN
+from door_state import CLOSED
+from door_state import CLOSING
+from door_state import DO_CLOSE
+from door_state import DO_OPEN
+from door_state import EVENTS
+from door_state import FAULT
+from door_state import GO_CLOSE
+from door_state import GO_OPEN
+from door_state import HOLD
+from door_state import NOTHING
+from door_state import OPEN
+from door_state import OPENING
+from door_state import STALL
+from door_state import STATES
+from door_state import STOP
+from door_state import SW_BOTH
+from door_state import SW_CLOSED
+from door_state import SW_NONE
+from door_state import SW_OPEN
+from door_state import TABLE
+from door_state import TARGETS
+from door_state import DoorState
+from door_state import action
+from door_state import status
+
+
+def verify():
+  '''
+  Every state and event, and every target, prior state and switch
+  reading. Returns (combinations checked, [failures]).
+  '''
+  failures = []
+  checked = 0
+  moving = (OPENING,CLOSING)
+  for state in range(len(STATES)):
+    for event in range(len(EVENTS)):
+      checked += 1
+      new = TABLE[state * len(EVENTS) + event]
+      if new >= len(STATES):
+        failures.append((STATES[state],EVENTS[event],"no such state"))
+        continue
+      if event == SW_BOTH and new != FAULT:
+        failures.append((STATES[state],EVENTS[event],"both switches made is not a fault"))
+      if state == FAULT and event in (GO_OPEN,GO_CLOSE) and new != FAULT:
+        failures.append((STATES[state],EVENTS[event],"moves with a switch fault"))
+      if state == FAULT and event in (SW_NONE,SW_CLOSED,SW_OPEN) and new == FAULT:
+        failures.append((STATES[state],EVENTS[event],"never recovers"))
+      if state not in moving and event == SW_CLOSED and new != CLOSED:
+        failures.append((STATES[state],EVENTS[event],"stopped on the close switch but not closed"))
+      if state not in moving and event == SW_OPEN and new != OPEN:
+        failures.append((STATES[state],EVENTS[event],"stopped on the open switch but not open"))
+      if state in moving and event in (STOP,STALL) and new in moving:
+        failures.append((STATES[state],EVENTS[event],"still moving after it stopped"))
+
+  # everything can be reached from a cold boot
+  seen = [BETWEEN]
+  for state in seen:
+    for event in range(len(EVENTS)):
+      new = TABLE[state * len(EVENTS) + event]
+      if new not in seen:
+        seen.append(new)
+  for state in range(len(STATES)):
+    if state not in seen:
+      failures.append((STATES[state],None,"unreachable"))
+
+  for target in TARGETS + (None,):
+    for state in range(len(STATES)):
+      for reading in (SW_NONE,SW_CLOSED,SW_OPEN,SW_BOTH):
+        checked += 1
+        machine = DoorState(state)
+        new = machine.feed(reading)
+        result = status(target,new)
+        todo = action(target,new)
+        where = (target,STATES[state],EVENTS[reading])
+        if result is None or result["actual"] not in ACTUAL:
+          failures.append(where + ("no status",))
+          continue
+        actual = result["actual"]
+        if reading == SW_BOTH and (actual != "fault" or todo != HOLD):
+          failures.append(where + ("switch fault not held",))
+        if reading == SW_CLOSED and actual not in ("closed","opening"):
+          failures.append(where + ("close switch made, reported " + actual,))
+        if reading == SW_OPEN and actual not in ("open","closing"):
+          failures.append(where + ("open switch made, reported " + actual,))
+        if todo == DO_OPEN and actual in ("open","opening"):
+          failures.append(where + ("opens an open door",))
+        if todo == DO_CLOSE and actual in ("closed","closing"):
+          failures.append(where + ("closes a closed door",))
+        if target == "closed" and actual == "closed" and todo != NOTHING:
+          failures.append(where + ("moves a door that is where it should be",))
+        if target == "open" and actual == "open" and todo != NOTHING:
+          failures.append(where + ("moves a door that is where it should be",))
+  return checked,failures
+
+
+def main():
+  checked,failures = verify()
+  for failure in failures:
+    print(failure)
+  print("{0} combinations checked, {1} failures".format(checked,len(failures)))
+  sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+  main()
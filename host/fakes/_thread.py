@@ -0,0 +1,65 @@
+'''
+Threads run inline: the firmware's threads either end in deep sleep or
+are background loops (the status server) the simulator skips.
+Locks block by running the virtual clock until a callback releases them,
+but only in a started thread. On the board scheduled callbacks run on
+the main thread, so a lock the main thread blocks on is never released
+and the simulator raises instead.
+'''
+import simworld
+
+# thread functions that loop forever and have no effect on the doors
+SKIP = ("run",)
+# started threads running right now, 0 on the main thread
+_depth = 0
+
+
+def start_new_thread(function,args,kwargs=None):
+  if getattr(function,"__name__",None) in SKIP:
+    return 0
+  global _depth
+  _depth += 1
+  try:
+    function(*args,**(kwargs or {}))
+  finally:
+    _depth -= 1
+  return 0
+
+
+def stack_size(size=0):
+  return 0
+
+
+def get_ident():
+  return 1
+
+
+class LockType:
+
+  def __init__(self):
+    self.locked_ = False
+
+  def acquire(self,waitflag=1,timeout=-1):
+    if self.locked_:
+      if not waitflag:
+        return False
+      if not _depth:
+        raise simworld.SimError("main thread blocked on a lock, its callbacks can never release it")
+      simworld.world.wait(lambda: not self.locked_)
+    self.locked_ = True
+    return True
+
+  def release(self):
+    self.locked_ = False
+
+  def locked(self):
+    return self.locked_
+
+  __enter__ = acquire
+
+  def __exit__(self,*args):
+    self.release()
+
+
+def allocate_lock():
+  return LockType()
@@ -0,0 +1,16 @@
+import simworld
+
+
+class BME280:
+
+  def __init__(self,i2c=None,address=0x76,**kwargs):
+    if "temperature" not in simworld.world.env(simworld.world.now):
+      raise OSError(19)
+
+  def read_compensated_data(self,result=None):
+    env = simworld.world.env(simworld.world.now)
+    values = (env["temperature"],env.get("pressure",101325.0),env.get("humidity",50.0))
+    if result is None:
+      return values
+    result[0],result[1],result[2] = values
+    return result
@@ -0,0 +1,33 @@
+import simworld
+
+WAKEUP_ALL_LOW = False
+WAKEUP_ANY_HIGH = True
+
+
+def wake_on_ext0(pin,level=WAKEUP_ALL_LOW):
+  simworld.world.ext0 = None if pin is None else pin.id
+
+
+def wake_on_ext1(pins,level=WAKEUP_ALL_LOW):
+  simworld.world.ext1 = tuple(pin.id for pin in pins or ())
+
+
+def gpio_deep_sleep_hold(enable):
+  pass
+
+
+class RMT:
+  # the status LED, nothing in the simulation looks at it
+
+  def __init__(self,channel,pin=None,clock_div=8,idle_level=False,tx_carrier=None):
+    self.channel = channel
+    self.pulses = None
+
+  def loop(self,enable):
+    pass
+
+  def write_pulses(self,duration,data=True):
+    self.pulses = (duration,data)
+
+  def deinit(self):
+    pass
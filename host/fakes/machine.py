@@ -0,0 +1,205 @@
+'''
+machine on the simulated hardware.
+'''
+import simworld
+from simworld import DeepSleep
+from simworld import Reset
+from simworld import PWRON_RESET,HARD_RESET,WDT_RESET,DEEPSLEEP_RESET,SOFT_RESET
+from simworld import EXT0_WAKE,EXT1_WAKE,TIMER_WAKE
+
+PIN_WAKE = EXT0_WAKE
+
+
+class Pin:
+  IN = 1
+  OUT = 3
+  OPEN_DRAIN = 7
+  PULL_UP = 2
+  PULL_DOWN = 1
+  PULL_HOLD = 4
+  IRQ_RISING = 1
+  IRQ_FALLING = 2
+
+  def __init__(self,id,mode=-1,pull=-1,value=None,drive=None,hold=None):
+    self.id = id
+    self.mode = mode
+    if value is not None:
+      simworld.world.write(id,value)
+
+  def init(self,mode=-1,pull=-1,value=None,drive=None,hold=None):
+    if value is not None:
+      simworld.world.write(self.id,value)
+
+  def value(self,value=None):
+    if value is None:
+      return simworld.world.read(self.id)
+    simworld.world.write(self.id,value)
+
+  __call__ = value
+
+  def on(self):
+    self.value(1)
+
+  def off(self):
+    self.value(0)
+
+  def irq(self,handler=None,trigger=3,hard=False):
+    state = simworld.world.pin(self.id)
+    state.handler = handler
+    state.trigger = trigger
+    state.hard = hard
+    state.pin = self
+
+
+class PWM:
+
+  def __init__(self,pin,freq=0,duty=512):
+    self.gpio = pin.id
+    self._freq = freq
+    self._duty = duty
+    simworld.world.set_pwm(self.gpio,freq)
+
+  def freq(self,value=None):
+    if value is None:
+      return self._freq
+    self._freq = value
+    simworld.world.set_pwm(self.gpio,value)
+
+  def duty(self,value=None):
+    if value is None:
+      return self._duty
+    self._duty = value
+
+  def init(self,freq=None,duty=None):
+    if duty is not None:
+      self._duty = duty
+    if freq is not None:
+      self.freq(freq)
+
+  def deinit(self):
+    simworld.world.set_pwm(self.gpio,0)
+
+
+class _Mem32:
+  # only the two GPIO input registers exist
+
+  def __getitem__(self,addr):
+    if addr == 0x3FF4403C:
+      return simworld.world.word(0)
+    if addr == 0x3FF44040:
+      return simworld.world.word(1)
+    raise simworld.SimError("mem32 read of {0:#x}".format(addr))
+
+
+mem32 = _Mem32()
+
+
+class Timer:
+  ONE_SHOT = 0
+  PERIODIC = 1
+
+  def __init__(self,id=-1):
+    self.id = id
+    self.generation = None
+    self.periodic = False
+    self.period = 0
+    self.due = 0
+    self.callback = None
+
+  def init(self,mode=PERIODIC,period=-1,callback=None,freq=None):
+    if freq:
+      period = 1000 // freq
+    self.periodic = mode == Timer.PERIODIC
+    self.period = max(int(period),1)
+    self.callback = callback
+    self.due = simworld.world.now + self.period
+    simworld.world.add_timer(self)
+
+  def deinit(self):
+    self.generation = None
+
+
+class ADC:
+  ATTN_0DB = 0
+  ATTN_2_5DB = 1
+  ATTN_6DB = 2
+  ATTN_11DB = 3
+
+  def __init__(self,pin,atten=None):
+    self.gpio = pin.id
+
+  def atten(self,value):
+    pass
+
+  def read_uv(self):
+    return int(simworld.world.analog_volts(self.gpio) * 1000000)
+
+  def read_u16(self):
+    return min(int(simworld.world.analog_volts(self.gpio) * 65535 / 3.3),65535)
+
+
+class I2C:
+
+  def __init__(self,id=0,scl=None,sda=None,freq=400000):
+    self.id = id
+
+  def scan(self):
+    return []
+
+
+class RTC:
+
+  # user memory on the ESP32 port
+  MEMORY = 2048
+
+  def memory(self,data=None):
+    if data is None:
+      return simworld.world.rtc_memory
+    if len(data) > self.MEMORY:
+      raise ValueError("buffer too long")
+    simworld.world.rtc_memory = bytes(data) if not isinstance(data,str) else data.encode()
+
+  def datetime(self,value=None):
+    import utime
+    t = utime.localtime()
+    return (t[0],t[1],t[2],t[6],t[3],t[4],t[5],0)
+
+
+def deepsleep(ms=0):
+  raise DeepSleep(ms)
+
+
+def lightsleep(ms=None):
+  simworld.world.lightsleep(ms)
+
+
+def wake_reason():
+  return simworld.world.wake_reason
+
+
+def reset_cause():
+  return simworld.world.reset_cause
+
+
+def reset():
+  raise Reset()
+
+
+def unique_id():
+  return b"\x24\x0a\xc4\x00\x00\x01"
+
+
+def freq(value=None):
+  return 240000000
+
+
+def idle():
+  simworld.world.sleep(1)
+
+
+def disable_irq():
+  return 0
+
+
+def enable_irq(state=0):
+  pass
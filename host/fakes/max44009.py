@@ -0,0 +1,12 @@
+import simworld
+
+
+class MAX44009:
+
+  def __init__(self,i2c,address=0x4a):
+    if "lux" not in simworld.world.env(simworld.world.now):
+      raise OSError(19)
+
+  @property
+  def illuminance_lux(self):
+    return simworld.world.env(simworld.world.now)["lux"]
@@ -0,0 +1,26 @@
+import simworld
+
+
+def const(value):
+  return value
+
+
+def heap_lock():
+  return 0
+
+
+def heap_unlock():
+  return 0
+
+
+def mem_info(verbose=False):
+  return None
+
+
+def alloc_emergency_exception_buf(size):
+  pass
+
+
+def schedule(fn,arg):
+  # runs like a soft irq, after whatever callback is running now
+  simworld.world.dispatch(fn,arg)
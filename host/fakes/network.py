@@ -0,0 +1,40 @@
+'''
+Wi-Fi that connects connect_ms after connect(), unless the trace has the
+network down.
+'''
+import simworld
+
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+
+  def __init__(self,interface=STA_IF):
+    self.interface = interface
+    self._active = False
+
+  def active(self,value=None):
+    if value is None:
+      return self._active
+    self._active = value
+
+  def scan(self):
+    return []
+
+  def connect(self,ssid=None,password=None):
+    simworld.world.wifi_started = simworld.world.now
+
+  def disconnect(self):
+    simworld.world.wifi_started = None
+
+  def isconnected(self):
+    world = simworld.world
+    return (world.wifi_started is not None and world.online()
+            and world.now - world.wifi_started >= world.connect_ms)
+
+  def ifconfig(self,config=None):
+    return ("192.168.1.50","255.255.255.0","192.168.1.1","192.168.1.1")
+
+  def config(self,*args,**kwargs):
+    return None
@@ -0,0 +1,13 @@
+import simworld
+
+host = "pool.ntp.org"
+
+
+def settime():
+  world = simworld.world
+  world.sleep(world.ntp_ms)
+  if world.wifi_started is None or not world.online():
+    # the real one times out after a second
+    world.sleep(1000 - world.ntp_ms)
+    raise OSError(110)
+  world.rtc_offset = 0
@@ -0,0 +1,7 @@
+import simworld
+
+
+def wrap_socket(sock,server_hostname=None,**kwargs):
+  # the handshake is the expensive part of a new connection
+  simworld.world.sleep(simworld.world.tls_ms)
+  return sock
@@ -0,0 +1,8 @@
+'''
+The status server is not run in the simulator, this only satisfies the
+import.
+'''
+
+
+def run(coro):
+  coro.close()
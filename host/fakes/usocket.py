@@ -0,0 +1,78 @@
+'''
+Sockets that answer every HTTP request with 200 while Wi-Fi is on and
+the network is up.
+Requests are recorded on the world so the runner can count notifications,
+and each one takes a round trip plus its bytes at the world's uplink speed.
+'''
+import simworld
+
+AF_INET = 2
+SOCK_STREAM = 1
+
+
+def _up():
+  world = simworld.world
+  return world.wifi_started is not None and world.online()
+
+
+def getaddrinfo(host,port,*args):
+  if not _up():
+    raise OSError(-202)
+  return [(AF_INET,SOCK_STREAM,0,"",("10.0.0.1",port))]
+
+
+class socket:
+
+  def __init__(self,*args):
+    self.rx = b""
+    self.tx = b""
+
+  def settimeout(self,timeout):
+    pass
+
+  def setblocking(self,flag):
+    pass
+
+  def connect(self,addr):
+    if not _up():
+      simworld.world.sleep(1000)
+      raise OSError(113)
+
+  def write(self,data):
+    if not _up():
+      raise OSError(104)
+    self.tx += bytes(data)
+    while b"\r\n\r\n" in self.tx:
+      head,_,rest = self.tx.partition(b"\r\n\r\n")
+      length = 0
+      for line in head.split(b"\r\n"):
+        name,_,value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+          length = int(value)
+      if len(rest) < length:
+        break
+      world = simworld.world
+      world.sleep(world.rtt_ms + (len(head) + 4 + length) * 8000 // world.uplink_bps)
+      simworld.world.requests.append((simworld.world.now,head.split(b"\r\n")[0],rest[:length]))
+      self.tx = rest[length:]
+      self.rx += b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}"
+    return len(data)
+
+  sendall = write
+  send = write
+
+  def readline(self):
+    line,sep,rest = self.rx.partition(b"\n")
+    self.rx = rest
+    return line + sep
+
+  def read(self,n=-1):
+    if n < 0:
+      n = len(self.rx)
+    data,self.rx = self.rx[:n],self.rx[n:]
+    return data
+
+  recv = read
+
+  def close(self):
+    pass
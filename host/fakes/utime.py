@@ -0,0 +1,61 @@
+'''
+utime (and time) on the virtual clock. time() reads the simulated RTC,
+the ticks count from the last reset.
+'''
+import calendar
+import time as _time
+import simworld
+
+
+def time():
+  return simworld.world.rtc_ms() // 1000
+
+
+def time_ns():
+  return simworld.world.rtc_ms() * 1000000
+
+
+def ticks_ms():
+  return simworld.world.ticks_ms()
+
+
+def ticks_us():
+  return simworld.world.ticks_ms() * 1000
+
+
+def ticks_add(ticks,delta):
+  return ticks + delta
+
+
+def ticks_diff(a,b):
+  return a - b
+
+
+def sleep(seconds):
+  simworld.world.sleep(seconds * 1000)
+
+
+def sleep_ms(ms):
+  simworld.world.sleep(ms)
+
+
+def sleep_us(us):
+  simworld.world.sleep(us // 1000)
+
+
+def localtime(secs=None):
+  if secs is None:
+    secs = time()
+  return tuple(_time.gmtime(secs))[:8]
+
+
+gmtime = localtime
+
+
+def mktime(t):
+  return calendar.timegm(tuple(t[:6]) + (0,0,0))
+
+
+def __getattr__(name):
+  # anything else the host's own libraries want from time
+  return getattr(_time,name)
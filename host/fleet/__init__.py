@@ -0,0 +1,21 @@
+'''
+Fleet tools for the host: a collector that takes the doors' upload
+batches (see batch.py) into a columnar store, and analytics over the
+whole fleet on memory mapped NumPy arrays.
+
+  python host/fleet collect STORE --port 8080
+  python host/fleet ingest STORE batch.bin ...
+  python host/fleet analyze STORE [--since 2024-01-01] [--json]
+  python host/fleet synth STORE --doors 300 --days 730
+
+Needs NumPy, the firmware and the simulator do not.
+'''
+import os
+import sys
+
+HOST = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO = os.path.dirname(HOST)
+# batch.py and eventlog.py from the firmware, eventlog wants ustruct
+for path in (REPO,os.path.join(HOST,"fakes")):
+  if path not in sys.path:
+    sys.path.append(path)
@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+
+# python host/fleet runs this file with host/fleet on the path, not host
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fleet
+from fleet import analyze
+from fleet import collector
+from fleet import synth
+from fleet.store import Store
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="fleet",description=fleet.__doc__.strip().splitlines()[0])
+  commands = parser.add_subparsers(dest="command",required=True)
+
+  collect = commands.add_parser("collect",help="take uploads over HTTP")
+  collect.add_argument("store")
+  collect.add_argument("--host",default="")
+  collect.add_argument("--port",type=int,default=8080)
+  collect.add_argument("--path",default="/upload")
+  collect.add_argument("--verbose",action="store_true")
+
+  ingest = commands.add_parser("ingest",help="store batch files")
+  ingest.add_argument("store")
+  ingest.add_argument("batches",nargs="+")
+
+  report = commands.add_parser("analyze",help="fleet statistics")
+  report.add_argument("store")
+  report.add_argument("--since",default=None,help="epoch seconds or a UTC date")
+  report.add_argument("--until",default=None)
+  report.add_argument("--device",default=None,help="only devices whose id contains this")
+  report.add_argument("--json",action="store_true")
+
+  make = commands.add_parser("synth",help="a made up fleet to size the analytics")
+  make.add_argument("store")
+  make.add_argument("--doors",type=int,default=300)
+  make.add_argument("--days",type=int,default=730)
+  make.add_argument("--seed",type=int,default=1)
+
+  args = parser.parse_args()
+  if args.command == "collect":
+    collector.serve(args.store,args.host,args.port,args.path,args.verbose)
+  elif args.command == "ingest":
+    print("{0} records".format(collector.ingest(Store(args.store),args.batches)))
+  elif args.command == "analyze":
+    analyze.run(args.store,args.since,args.until,args.device,args.json)
+  else:
+    synth.run(args.store,args.doors,args.days,args.seed)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,181 @@
+'''
+Fleet analytics over the columnar store: door travel times, how long
+wakes stay up, how long notifications take to go out, and how far the
+moves start from the schedule and whether that is drifting, for every
+door at once. Everything is NumPy over the memory mapped columns, with
+one sort per grouping and no Python loop over the rows.
+'''
+import calendar
+import datetime
+import json
+import time
+
+import numpy as np
+
+from eventlog import EVENTS
+from fleet.store import MISSING
+from fleet.store import Store
+from fleet.store import unique
+
+PERCENTILES = (50,90,99)
+# per door and per device rankings show this many
+TOP = 5
+
+
+def epoch(value):
+  # epoch seconds, or a UTC date / date and time
+  if value is None:
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    return calendar.timegm(datetime.datetime.fromisoformat(value).timetuple())
+
+
+def summary(values):
+  if not len(values):
+    return {"count": 0}
+  result = {"count": int(len(values))}
+  for q,value in zip(PERCENTILES,np.percentile(values,PERCENTILES)):
+    result["p{0}".format(q)] = float(value)
+  result["max"] = float(values.max())
+  return result
+
+
+def grouped(groups,values,q):
+  '''
+  The q percentile of values within each group (nearest rank), as
+  (groups, percentiles, counts).
+  '''
+  order = np.lexsort((values,groups))
+  groups = groups[order]
+  values = values[order]
+  starts = np.flatnonzero(np.r_[True,groups[1:] != groups[:-1]])
+  counts = np.diff(np.r_[starts,len(groups)])
+  picks = starts + np.floor((counts - 1) * q / 100.0 + 0.5).astype(np.int64)
+  return groups[starts],values[picks],counts
+
+
+def slopes(groups,x,y):
+  # least squares slope of y over x within each group, and the group sizes
+  ids,inverse,counts = np.unique(groups,return_inverse=True,return_counts=True)
+  x = x.astype(np.float64)
+  y = y.astype(np.float64)
+  mean_x = np.bincount(inverse,x) / counts
+  mean_y = np.bincount(inverse,y) / counts
+  dx = x - mean_x[inverse]
+  sxx = np.bincount(inverse,dx * dx)
+  sxy = np.bincount(inverse,dx * (y - mean_y[inverse]))
+  with np.errstate(divide="ignore",invalid="ignore"):
+    slope = np.where(sxx > 0,sxy / sxx,0.0)
+  return ids,slope,counts,mean_y
+
+
+def _window(columns,start,end,devices):
+  rows = np.ones(len(columns["time"]),dtype=bool)
+  if start is not None:
+    rows &= columns["time"] >= start
+  if end is not None:
+    rows &= columns["time"] < end
+  if devices is not None:
+    rows &= np.isin(columns["device"],devices)
+  return rows
+
+
+class Fleet:
+
+  def __init__(self,path,start=None,end=None,match=None):
+    self.store = Store(path)
+    self.start = start
+    self.end = end
+    self.devices = None
+    if match:
+      self.devices = [index for index,device in enumerate(self.store.devices) if match in device]
+
+  def table(self,name,*keys):
+    # the rows in the window, one copy of each key, as plain arrays
+    columns = self.store.load(name)
+    rows = unique(columns,*keys)
+    rows = rows[_window({key: columns[key][rows] for key in ("time","device")},self.start,self.end,self.devices)]
+    rows.sort()
+    return {key: np.asarray(column[rows]) for key,column in columns.items()}
+
+  def door_name(self,key):
+    device,door = divmod(int(key),256)
+    return "{0}/{1}".format(self.store.devices[device],door)
+
+  def travel(self):
+    events = self.table("events","device","seq")
+    result = {}
+    for name in ("opened","closed"):
+      rows = (events["event"] == EVENTS.index(name)) & np.isfinite(events["seconds"])
+      seconds = events["seconds"][rows]
+      result[name] = summary(seconds)
+      if len(seconds):
+        doors = events["device"][rows].astype(np.int64) * 256 + events["door"][rows]
+        ids,p90,counts = grouped(doors,seconds,90)
+        slowest = np.argsort(p90)[::-1][:TOP]
+        result[name]["slowest"] = [{"door": self.door_name(ids[i]),"p90": float(p90[i]),"moves": int(counts[i])}
+                                   for i in slowest]
+    return result
+
+  def wakes(self):
+    wakes = self.table("wakes","device","time")
+    result = {"awake_ms": summary(wakes["awake_ms"])}
+    if len(wakes["awake_ms"]):
+      ids,p90,counts = grouped(wakes["device"],wakes["awake_ms"],90)
+      worst = np.argsort(p90)[::-1][:TOP]
+      result["awake_ms"]["worst"] = [{"device": self.store.devices[ids[i]],"p90": int(p90[i]),"wakes": int(counts[i])}
+                                     for i in worst]
+    latency = wakes["latency_ms"][wakes["latency_ms"] != MISSING]
+    result["notification_ms"] = summary(latency)
+
+    rows = wakes["error_ms"] != MISSING
+    errors = wakes["error_ms"][rows]
+    result["schedule_error_ms"] = summary(errors)
+    if len(errors):
+      ids,slope,counts,mean = slopes(wakes["device"][rows],wakes["scheduled"][rows],errors)
+      # ms per 30 days, only for devices with enough moves to say
+      drift = slope * 30 * 86400
+      enough = counts >= 10
+      worst = np.flatnonzero(enough)[np.argsort(np.abs(drift[enough]))[::-1][:TOP]]
+      result["schedule_error_ms"]["drifting"] = [{"device": self.store.devices[ids[i]],"ms_per_30_days": float(drift[i]),
+                                                  "mean": float(mean[i]),"moves": int(counts[i])} for i in worst]
+    return result
+
+  def report(self):
+    return {"devices": len(self.store.devices),"travel_s": self.travel(),**self.wakes()}
+
+
+def _summary_line(name,values,unit):
+  if not values["count"]:
+    return "{0:<22} none".format(name)
+  return "{0:<22} n={1:<9} p50 {2:>9.1f}{6}  p90 {3:>9.1f}{6}  p99 {4:>9.1f}{6}  max {5:>9.1f}{6}".format(
+         name,values["count"],values["p50"],values["p90"],values["p99"],values["max"],unit)
+
+
+def print_report(result):
+  print("{0} devices".format(result["devices"]))
+  for name in ("opened","closed"):
+    values = result["travel_s"][name]
+    print(_summary_line("travel " + name,values,"s"))
+    for door in values.get("slowest",()):
+      print("    {0:<28} p90 {1:.1f}s over {2} moves".format(door["door"],door["p90"],door["moves"]))
+  print(_summary_line("awake",result["awake_ms"],"ms"))
+  for device in result["awake_ms"].get("worst",()):
+    print("    {0:<28} p90 {1}ms over {2} wakes".format(device["device"],device["p90"],device["wakes"]))
+  print(_summary_line("notification latency",result["notification_ms"],"ms"))
+  print(_summary_line("schedule error",result["schedule_error_ms"],"ms"))
+  for device in result["schedule_error_ms"].get("drifting",()):
+    print("    {0:<28} {1:+.0f}ms per 30 days, mean {2:+.0f}ms over {3} moves".format(
+          device["device"],device["ms_per_30_days"],device["mean"],device["moves"]))
+
+
+def run(path,since=None,until=None,match=None,as_json=False):
+  started = time.perf_counter()
+  result = Fleet(path,epoch(since),epoch(until),match).report()
+  if as_json:
+    print(json.dumps(result,indent=2))
+  else:
+    print_report(result)
+    print("analysed in {0:.2f}s".format(time.perf_counter() - started))
@@ -0,0 +1,70 @@
+'''
+The collector the doors upload to ("upload" in config.json points here):
+every POST is a batch, stored in the columnar store before it is
+answered, so a door only moves its cursors once the data is safe.
+Batches saved as files (python host/sim.py --upload --batches DIR, or
+bodies dumped off a proxy) go in with ingest().
+'''
+import http.server
+import sys
+import threading
+import zlib
+
+from fleet.store import Store
+
+
+def ingest(store,paths):
+  # batch files into the store, returns the records stored
+  records = 0
+  for path in paths:
+    with open(path,"rb") as f:
+      records += store.add(f.read(),zlib.decompress)
+  return records
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    if self.path != self.server.upload_path:
+      self.reply(404,b"{}")
+      return
+    length = int(self.headers.get("Content-Length","0"))
+    payload = self.rfile.read(length)
+    try:
+      with self.server.lock:
+        records = self.server.store.add(payload,zlib.decompress)
+    except (ValueError,IndexError,zlib.error) as e:
+      # a batch that can not be read is not going to read better later,
+      # but the door keeps it until something answers 2xx
+      self.log_error("bad batch: %r",e)
+      self.reply(400,b"{}")
+      return
+    self.reply(200,'{{"records": {0}}}'.format(records).encode())
+
+  def reply(self,status,body):
+    self.send_response(status)
+    self.send_header("Content-Type","application/json")
+    self.send_header("Content-Length",str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self,format,*args):
+    if self.server.verbose:
+      http.server.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+def serve(path,host="",port=8080,upload_path="/upload",verbose=False):
+  server = http.server.ThreadingHTTPServer((host,port),Handler)
+  server.store = Store(path)
+  server.lock = threading.Lock()
+  server.upload_path = upload_path
+  server.verbose = verbose
+  print("collecting into {0} on port {1}".format(path,port),file=sys.stderr)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
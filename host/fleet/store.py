@@ -0,0 +1,136 @@
+'''
+Columnar store for the fleet: one directory per table, one file per
+column of raw little endian values, appended to as batches come in.
+Reading maps every column straight into a NumPy array, nothing is
+parsed.
+
+  STORE/devices.json          device ids, a device is its index in here
+  STORE/events/seq.u4 ...     one record per door event
+  STORE/samples/time.i4 ...   one record per sensor bucket
+  STORE/wakes/awake_ms.u4 ... one record per wake
+
+Batches are stored as they come, so a record sent twice (a resent open
+bucket, everything again after a power cycle) is in twice. unique()
+picks the last copy of each key when the tables are read.
+'''
+import json
+import os
+
+import numpy as np
+
+import batch
+from rollup import FIELDS
+
+# int columns without a value
+MISSING = -2 ** 31
+
+TABLES = {
+  "events": (("device","u2"),("seq","u4"),("time","i4"),("door","u1"),("event","u1"),("seconds","f4")),
+  "samples": (("device","u2"),("time","i4"),("seconds","i4"))
+             + tuple((field + "_" + part,"u2" if part == "count" else "f4")
+                     for field in FIELDS for part in ("min","max","mean","count")),
+  "wakes": (("device","u2"),("time","i4"),("awake_ms","u4"),("scheduled","i4"),("error_ms","i4"),("latency_ms","i4")),
+}
+
+
+class Store:
+
+  def __init__(self,path):
+    self.path = path
+    for table in TABLES:
+      os.makedirs(os.path.join(path,table),exist_ok=True)
+    try:
+      with open(os.path.join(path,"devices.json")) as f:
+        self.devices = json.load(f)
+    except FileNotFoundError:
+      self.devices = []
+
+  def _column(self,table,name,dtype):
+    return os.path.join(self.path,table,"{0}.{1}".format(name,dtype))
+
+  def device(self,device_id):
+    # the index of a device, new devices are added
+    if device_id not in self.devices:
+      self.devices.append(device_id)
+      with open(os.path.join(self.path,"devices.json"),"w") as f:
+        json.dump(self.devices,f)
+    return self.devices.index(device_id)
+
+  def append(self,table,columns):
+    '''
+    Appends rows, columns maps every column of the table to a sequence
+    of the same length.
+    '''
+    # drop what an append cut short by a crash left on the longer columns
+    rows = self.rows(table)
+    for name,dtype in TABLES[table]:
+      values = np.asarray(columns[name]).astype("<" + dtype)
+      with open(self._column(table,name,dtype),"ab") as f:
+        f.truncate(rows * np.dtype(dtype).itemsize)
+        values.tofile(f)
+
+  def add(self,payload,decompress):
+    # one upload batch, returns the records stored
+    decoded = batch.decode(payload,decompress)
+    device = self.device(decoded["device"].hex())
+    events = decoded["events"]
+    if events:
+      seq,t,door,event,seconds = zip(*events)
+      self.append("events",{"device": [device] * len(events),"seq": seq,"time": t,"door": door,"event": event,
+                            "seconds": [np.nan if value is None else value for value in seconds]})
+    samples = decoded["samples"]
+    if samples:
+      columns = {"device": [device] * len(samples),"time": [start for start,values in samples],
+                 "seconds": [decoded["seconds"]] * len(samples)}
+      for field in FIELDS:
+        parts = [values.get(field,(np.nan,np.nan,np.nan,0)) for start,values in samples]
+        for index,part in enumerate(("min","max","mean","count")):
+          columns[field + "_" + part] = [values[index] for values in parts]
+      self.append("samples",columns)
+    wakes = decoded["wakes"]
+    if wakes:
+      columns = list(zip(*[[MISSING if value is None else value for value in wake] for wake in wakes]))
+      self.append("wakes",{"device": [device] * len(wakes),"time": columns[0],"awake_ms": columns[1],
+                           "scheduled": columns[2],"error_ms": columns[3],"latency_ms": columns[4]})
+    return len(events) + len(samples) + len(wakes)
+
+  def rows(self,table):
+    # a column cut short by a crash mid append does not count
+    rows = None
+    for name,dtype in TABLES[table]:
+      try:
+        size = os.path.getsize(self._column(table,name,dtype)) // np.dtype(dtype).itemsize
+      except FileNotFoundError:
+        size = 0
+      rows = size if rows is None else min(rows,size)
+    return rows
+
+  def load(self,table):
+    # every column as a read only array mapped from its file
+    rows = self.rows(table)
+    columns = {}
+    for name,dtype in TABLES[table]:
+      if rows:
+        columns[name] = np.memmap(self._column(table,name,dtype),dtype="<" + dtype,mode="r",shape=(rows,))
+      else:
+        columns[name] = np.empty(0,dtype="<" + dtype)
+    return columns
+
+
+def unique(columns,*keys):
+  '''
+  The rows of a table with only the last copy of every key, as indices
+  in key order.
+  '''
+  rows = len(columns[keys[0]])
+  if not rows:
+    return np.empty(0,dtype=np.int64)
+  # newest first, the stable sort then puts the last copy of a key first
+  newest = np.arange(rows - 1,-1,-1)
+  order = newest[np.lexsort([np.asarray(columns[key])[newest] for key in reversed(keys)])]
+  first = np.zeros(rows,dtype=bool)
+  first[0] = True
+  for key in keys:
+    values = np.asarray(columns[key])[order]
+    first[1:] |= values[1:] != values[:-1]
+  return order[first]
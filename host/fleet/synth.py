@@ -0,0 +1,73 @@
+'''
+A made up fleet for sizing the analytics: years of events, daily sensor
+buckets and wakes for hundreds of devices, written straight into a
+store. Some records go in twice, like resent batches do.
+'''
+import time
+
+import numpy as np
+
+from fleet.store import MISSING
+from fleet.store import Store
+from fleet.store import TABLES
+from rollup import FIELDS
+
+DAY = 86400
+WAKES_PER_DAY = 40
+
+
+def _duplicate(columns,rng,share=0.02):
+  rows = len(columns["time"])
+  again = rng.choice(rows,int(rows * share),replace=False)
+  return {key: np.concatenate((values,values[again])) for key,values in columns.items()}
+
+
+def generate(path,doors=300,days=730,start=1704067200,seed=1):
+  rng = np.random.default_rng(seed)
+  store = Store(path)
+  devices = np.array([store.device("{0:012x}".format(value)) for value in rng.integers(0,2 ** 48,doors)])
+  day = np.arange(days)
+
+  # an open and a close a day per door, each door with its own speed
+  travel = rng.normal(4.0,0.4,doors).clip(2.5)
+  device = np.repeat(devices,days * 2)
+  t = start + np.tile(np.repeat(day * DAY,2) + np.tile((7 * 3600,19 * 3600),days),doors)
+  event = np.tile((0,1),days * doors)
+  seconds = np.repeat(travel,days * 2) * rng.lognormal(0,0.05,len(device))
+  seq = np.tile(np.arange(1,days * 2 + 1),doors)
+  store.append("events",_duplicate({"device": device,"seq": seq,"time": t,"door": np.zeros(len(device)),
+                                    "event": event,"seconds": seconds},rng))
+
+  # daily buckets
+  device = np.repeat(devices,days)
+  t = start + np.tile(day * DAY,doors)
+  columns = {"device": device,"time": t,"seconds": np.full(len(device),DAY)}
+  for field in FIELDS:
+    mean = rng.normal(10,8,len(device))
+    columns.update({field + "_min": mean - 5,field + "_max": mean + 5,field + "_mean": mean,
+                    field + "_count": np.full(len(device),WAKES_PER_DAY)})
+  store.append("samples",columns)
+
+  # wakes, every 20th acting on the schedule with an error that drifts
+  # per device, and notifications on those
+  wakes = days * WAKES_PER_DAY
+  device = np.repeat(devices,wakes)
+  t = start + np.tile(np.arange(wakes) * (DAY // WAKES_PER_DAY),doors)
+  awake = rng.lognormal(np.log(2500),0.35,len(device)).astype(np.int64)
+  acted = np.tile(np.arange(wakes) % (WAKES_PER_DAY // 2) == 0,doors)
+  drift = np.repeat(rng.normal(0,40,doors),wakes) / (30 * DAY)
+  error = (rng.normal(150,120,len(device)) + drift * (t - start)).astype(np.int64)
+  latency = rng.lognormal(np.log(900),0.5,len(device)).astype(np.int64)
+  store.append("wakes",_duplicate({"device": device,"time": t,"awake_ms": awake,
+                                   "scheduled": np.where(acted,t + 2,MISSING),
+                                   "error_ms": np.where(acted,error,MISSING),
+                                   "latency_ms": np.where(acted,latency,MISSING)},rng))
+  return {table: store.rows(table) for table in TABLES}
+
+
+def run(path,doors,days,seed=1):
+  started = time.perf_counter()
+  rows = generate(path,doors,days,seed=seed)
+  print("{0} doors, {1} days: {2} in {3:.1f}s".format(
+        doors,days,", ".join("{0} {1}".format(count,table) for table,count in rows.items()),
+        time.perf_counter() - started))
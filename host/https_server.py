@@ -0,0 +1,178 @@
+'''
+A local HTTPS stand-in for the notification service, and a check of
+http_client.HTTPClient against it over real TLS.
+
+  python host/https_server.py
+  python host/https_server.py --queued 20
+
+The server uses a throwaway self-signed certificate (made with the
+openssl command), answers every request 200 on a keep-alive connection
+and counts the TCP connections, TLS handshakes and requests it saw.
+
+The check is one wake as main.py does it: an alert sent at once with
+request(), then --queued routine messages pipelined with flush(). All of
+it must go over one TLS handshake. A second run has the server close
+the connection after every third response (Connection: close), flush()
+must then carry on over new connections and still deliver everything.
+Prints the counts and exits 1 if anything was off.
+'''
+import argparse
+import os
+import shutil
+import socket
+import ssl as host_ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HOST))
+# machine (for rtcmem's DNS cache) and utime from the simulator's fakes,
+# but real sockets and TLS
+sys.path.insert(0,os.path.join(HOST,"fakes"))
+sys.modules["usocket"] = socket
+import simworld
+
+
+def _wrap_socket(sock,server_hostname=None):
+  # ssl.wrap_socket as on MicroPython, which does not verify the server
+  context = host_ssl.SSLContext(host_ssl.PROTOCOL_TLS_CLIENT)
+  context.check_hostname = False
+  context.verify_mode = host_ssl.CERT_NONE
+  return context.wrap_socket(sock,server_hostname=server_hostname)
+
+
+# the firmware imports ssl, give it the MicroPython call on host TLS
+sys.modules["ssl"] = types.SimpleNamespace(wrap_socket=_wrap_socket)
+
+
+class Server:
+
+  def __init__(self,certfile,keyfile):
+    self.context = host_ssl.SSLContext(host_ssl.PROTOCOL_TLS_SERVER)
+    self.context.load_cert_chain(certfile,keyfile)
+    self.listener = socket.socket()
+    self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    self.listener.bind(("127.0.0.1",0))
+    self.listener.listen(4)
+    self.port = self.listener.getsockname()[1]
+    self.connections = 0
+    self.handshakes = 0
+    self.requests = 0
+    # answer with Connection: close after this many responses on one connection
+    self.close_after = None
+    thread = threading.Thread(target=self.serve,daemon=True)
+    thread.start()
+
+  def serve(self):
+    while True:
+      sock,addr = self.listener.accept()
+      self.connections += 1
+      threading.Thread(target=self.handle,args=(sock,),daemon=True).start()
+
+  def handle(self,sock):
+    try:
+      conn = self.context.wrap_socket(sock,server_side=True)
+    except (OSError,host_ssl.SSLError):
+      sock.close()
+      return
+    self.handshakes += 1
+    stream = conn.makefile("rwb")
+    served = 0
+    try:
+      while True:
+        line = stream.readline()
+        if not line:
+          break
+        length = 0
+        while True:
+          header = stream.readline()
+          if not header or header == b"\r\n":
+            break
+          name,_,value = header.partition(b":")
+          if name.strip().lower() == b"content-length":
+            length = int(value)
+        stream.read(length)
+        self.requests += 1
+        served += 1
+        close = self.close_after is not None and served >= self.close_after
+        body = b'{"status":1}'
+        stream.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: " +
+                     str(len(body)).encode() + (b"\r\nConnection: close" if close else b"") + b"\r\n\r\n" + body)
+        stream.flush()
+        if close:
+          break
+    except OSError:
+      pass
+    stream.close()
+    conn.close()
+
+  def reset(self):
+    self.connections = self.handshakes = self.requests = 0
+
+
+def make_cert(directory):
+  certfile = os.path.join(directory,"cert.pem")
+  keyfile = os.path.join(directory,"key.pem")
+  subprocess.run(["openssl","req","-x509","-newkey","rsa:2048","-nodes","-days","1","-subj","/CN=localhost",
+                  "-keyout",keyfile,"-out",certfile],check=True,capture_output=True)
+  return certfile,keyfile
+
+
+def check(name,ok,detail=""):
+  print("{0:<40} {1}{2}".format(name,"ok" if ok else "FAIL",("  " + detail) if detail else ""))
+  return ok
+
+
+def wake(client,queued):
+  # an alert right away, then the routine messages pipelined before sleep
+  statuses = [client.request(b"POST",b"/1/messages.json",b'{"message": "alert"}')[0]]
+  for i in range(queued):
+    client.queue_request(b"POST",b"/1/messages.json",'{{"message": "routine {0}"}}'.format(i).encode())
+  statuses += client.flush()
+  client.close()
+  return statuses
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run http_client.HTTPClient against a local HTTPS stand-in.")
+  parser.add_argument("--queued",type=int,default=5)
+  args = parser.parse_args()
+
+  simworld.world = simworld.World(int(time.time() * 1000))
+  from http_client import HTTPClient
+
+  directory = tempfile.mkdtemp(prefix="httpsstandin")
+  try:
+    server = Server(*make_cert(directory))
+  finally:
+    shutil.rmtree(directory,ignore_errors=True)
+  results = []
+  total = 1 + args.queued
+
+  client = HTTPClient("127.0.0.1",server.port)
+  statuses = wake(client,args.queued)
+  results.append(check("keep-alive wake delivered",statuses == [200] * total,repr(statuses)))
+  results.append(check("one TLS handshake",client.handshakes == 1 and server.handshakes == 1,
+                       "client {0}, server {1}".format(client.handshakes,server.handshakes)))
+  results.append(check("one connection",server.connections == 1,str(server.connections)))
+  results.append(check("requests counted",client.requests == total and server.requests == total,
+                       "client {0}, server {1}".format(client.requests,server.requests)))
+
+  server.reset()
+  server.close_after = 3
+  client = HTTPClient("127.0.0.1",server.port)
+  statuses = wake(client,args.queued)
+  expected = (total + server.close_after - 1) // server.close_after
+  results.append(check("Connection: close wake delivered",statuses == [200] * total,repr(statuses)))
+  results.append(check("a handshake per closed connection",client.handshakes == expected and server.handshakes == expected,
+                       "client {0}, server {1}, expected {2}".format(client.handshakes,server.handshakes,expected)))
+  results.append(check("nothing left queued",not client.queue))
+  sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+  main()
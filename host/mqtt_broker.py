@@ -0,0 +1,203 @@
+'''
+A local MQTT 3.1.1 broker stand-in, and a check of the firmware's
+mqtt.Telemetry against it over real sockets.
+
+  python host/mqtt_broker.py
+  python host/mqtt_broker.py --publishes 2000
+
+The broker takes one client at a time: CONNECT, SUBSCRIBE, PUBLISH at
+QoS 0/1, PINGREQ and DISCONNECT. It records every publish and can hold
+back its PUBACKs, and send() pushes a message to the client.
+
+The check runs two wakes. The first publishes state, an event and a
+sensor sample with readings missing, takes a command and goes to sleep
+with its event unacked. The second must resend that event (DUP set),
+then the bench publishes --publishes QoS1 messages and all must be
+acked. Prints what it saw and exits 1 if anything was off.
+'''
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HOST))
+# utime, machine (for rtcmem) and friends from the simulator's fakes, but
+# real sockets
+sys.path.insert(0,os.path.join(HOST,"fakes"))
+sys.modules["usocket"] = socket
+import simworld
+
+
+class Broker:
+
+  def __init__(self,port=0):
+    self.server = socket.socket()
+    self.server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    self.server.bind(("127.0.0.1",port))
+    self.server.listen(1)
+    self.port = self.server.getsockname()[1]
+    self.conn = None
+    self.lock = threading.Lock()
+    # (topic, payload, qos, dup, retain) in the order they came in
+    self.published = []
+    self.subscriptions = []
+    self.connects = 0
+    self.hold_acks = False
+    self.thread = threading.Thread(target=self.serve,daemon=True)
+    self.thread.start()
+
+  def _read(self,conn,n):
+    data = b""
+    while len(data) < n:
+      chunk = conn.recv(n - len(data))
+      if not chunk:
+        raise OSError("closed")
+      data += chunk
+    return data
+
+  def _packet(self,conn):
+    first = self._read(conn,1)[0]
+    length = 0
+    shift = 0
+    while True:
+      b = self._read(conn,1)[0]
+      length |= (b & 0x7f) << shift
+      if not b & 0x80:
+        break
+      shift += 7
+    return first,self._read(conn,length)
+
+  def _send(self,data):
+    with self.lock:
+      self.conn.sendall(data)
+
+  def serve(self):
+    while True:
+      conn,addr = self.server.accept()
+      self.conn = conn
+      try:
+        while True:
+          first,body = self._packet(conn)
+          kind = first >> 4
+          if kind == 1:
+            self.connects += 1
+            self._send(b"\x20\x02\x00\x00")
+          elif kind == 8:
+            pid = body[:2]
+            topic_len = struct.unpack("!H",body[2:4])[0]
+            self.subscriptions.append(body[4:4 + topic_len].decode())
+            self._send(b"\x90\x03" + pid + bytes((body[-1],)))
+          elif kind == 3:
+            qos = (first >> 1) & 3
+            topic_len = struct.unpack("!H",body[:2])[0]
+            topic = body[2:2 + topic_len].decode()
+            rest = body[2 + topic_len:]
+            if qos:
+              pid,rest = rest[:2],rest[2:]
+              if not self.hold_acks:
+                self._send(b"\x40\x02" + pid)
+            self.published.append((topic,rest,qos,bool(first & 8),bool(first & 1)))
+          elif kind == 12:
+            self._send(b"\xd0\x00")
+          elif kind == 14:
+            break
+      except OSError:
+        pass
+      conn.close()
+      self.conn = None
+
+  def send(self,topic,msg):
+    # QoS0 PUBLISH to the connected client
+    topic = topic.encode()
+    body = struct.pack("!H",len(topic)) + topic + msg
+    self._send(bytes((0x30,len(body))) + body)
+
+  def wait(self,count,timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(self.published) < count and time.monotonic() < deadline:
+      time.sleep(0.01)
+    return len(self.published) >= count
+
+
+class FakeDoor:
+  # just what Telemetry.state() and event() look at
+
+  class stepper:
+    position = 1234
+
+  name = "big"
+
+
+def check(name,ok,detail=""):
+  print("{0:<40} {1}{2}".format(name,"ok" if ok else "FAIL",("  " + detail) if detail else ""))
+  return ok
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run mqtt.Telemetry against a local broker stand-in.")
+  parser.add_argument("--publishes",type=int,default=500)
+  args = parser.parse_args()
+
+  simworld.world = simworld.World(int(time.time() * 1000))
+  import rtcmem
+  from mqtt import Telemetry
+
+  broker = Broker()
+  config = {"host": "127.0.0.1","port": str(broker.port),"topic": "coop"}
+  commands = []
+  results = []
+
+  # first wake: the event is never acked and has to wait for the next one
+  telemetry = Telemetry(config,commands.append)
+  results.append(check("connect",telemetry.connect()))
+  telemetry.state(FakeDoor,"closed")
+  telemetry.sample({"temperature": 3.5,"pressure": None,"humidity": 61.0,"lux": None})
+  telemetry.power({"level": "normal","battery": 12.4,"solar": None,"charge": None})
+  # everything so far has its PUBACK before they are held back
+  broker.wait(3)
+  broker.hold_acks = True
+  telemetry.event(FakeDoor,"closed",4.2)
+  broker.wait(4)
+  topics = dict((topic,payload) for topic,payload,qos,dup,retain in broker.published)
+  results.append(check("subscribed to the command topic",broker.subscriptions == ["coop/cmd"]))
+  results.append(check("retained state",topics.get("coop/big/state") == b"closed,1234"))
+  results.append(check("missing readings are empty fields",topics.get("coop/sensors") == b"3.5,,61.0,",
+                       repr(topics.get("coop/sensors"))))
+  results.append(check("power",topics.get("coop/power") == b"normal,12.4,,",repr(topics.get("coop/power"))))
+  broker.send("coop/cmd",b"big:open")
+  deadline = time.monotonic() + 5
+  while not commands and time.monotonic() < deadline:
+    telemetry.poll()
+    time.sleep(0.01)
+  results.append(check("command received",commands == ["big:open"],repr(commands)))
+  telemetry.sleep()
+  rtcmem.save()
+  results.append(check("unacked event kept for the next wake",len(rtcmem.get('mqtt_q',[])) == 1))
+
+  # second wake, RTC memory reread like after a deep sleep
+  rtcmem._data = None
+  broker.hold_acks = False
+  before = len(broker.published)
+  telemetry = Telemetry(config,commands.append)
+  results.append(check("reconnect",telemetry.connect()))
+  broker.wait(before + 1)
+  resent = broker.published[before:before + 1]
+  results.append(check("event resent with DUP",resent == [("coop/big/event",b"closed,4.2",1,True,False)],repr(resent)))
+  # bench() times itself on utime, which is the (still) virtual clock here
+  started = time.perf_counter()
+  telemetry.client.bench("coop/bench",count=args.publishes)
+  elapsed = time.perf_counter() - started
+  acked = not telemetry.client.inflight
+  results.append(check("bench publishes all acked",acked,"{0:.0f} msg/s on the host".format(args.publishes / elapsed)))
+  telemetry.sleep()
+  results.append(check("nothing left queued",rtcmem.get('mqtt_q',None) == []))
+  results.append(check("one connection per wake",broker.connects == 2,str(broker.connects)))
+  sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+  main()
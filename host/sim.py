@@ -0,0 +1,569 @@
+'''
+Trace driven simulator for the door firmware. Runs the real ChickenDoor
+code from main.py on a virtual clock with fake pins, doors, Wi-Fi, NTP
+and sensors, one deep sleep wake after another, far faster than real
+time.
+
+  python host/sim.py --days 365
+  python host/sim.py --trace trace.jsonl --start 2024-03-01 --days 30
+
+The trace is JSON lines, "t" is UTC ("2024-03-10T06:30:00") or epoch
+seconds:
+
+  {"t": ..., "type": "button", "op": "open"}
+  {"t": ..., "type": "outage", "until": ...}
+  {"t": ..., "type": "jam", "door": "big", "until": ...}
+  {"t": ..., "type": "obstruction", "until": ...}
+  {"t": ..., "type": "stuck", "door": "big", "switch": "open", "until": ...}
+  {"t": ..., "type": "sensor", "lux": 3.5, "temperature": -2.0}
+  {"t": ..., "type": "mode", "value": "manual"}
+  {"t": ..., "type": "travel", "door": "big", "steps": 4200}
+  {"t": ..., "type": "calibrate"}
+
+"calibrate" power cycles the board with both buttons held, so the motor
+tuning is calibrated (see calibrate.py) against a door that stalls past
+--stall-curve. Those wakes are not held to --awake-budget, and their
+report is printed with the summary.
+
+--battery V,V,... drains (or charges) a battery along those volts over
+the run, with a panel following the sun, and turns on the power policy
+(see power.py). The summary then has the wakes at each level.
+
+--upload turns on the batch upload (see uploader.py) to a collector that
+accepts everything, and the summary adds what it cost: batches, bytes on
+the air and records per day, the Wi-Fi on time per day, and what the
+same records would have cost as one JSON request each. --batches keeps
+the batches as files, for host/fleet to ingest.
+
+Without a trace (or on top of one) a synthetic year is generated from the
+sun and the season, with --outages/--presses/--jams random events.
+
+Prints a summary per local day and exits 1 if an invariant failed: a
+door not closed at --closed-after, not open at --open-after, a wake
+awake longer than --awake-budget, more than --max-overdrive steps into an
+end stop, or the firmware crashing.
+'''
+import argparse
+import calendar
+import contextlib
+import datetime
+import gc
+import importlib.util
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time as real_time
+
+import simworld
+from simworld import DEEPSLEEP_RESET
+from simworld import POWER_CYCLE
+from simworld import PWRON_RESET
+from simworld import SOFT_RESET
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HOST)
+FAKES = os.path.join(HOST,"fakes")
+
+OPEN_BUTTON = 15
+CLOSE_BUTTON = 4
+MODE_SWITCH = 25
+BATTERY_ADC = 36
+SOLAR_ADC = 39
+# request line and headers of a small JSON POST
+JSON_HEAD = 160
+
+
+def install_fakes():
+  sys.path.insert(0,REPO)
+  sys.path.insert(0,FAKES)
+  # builtin modules can't be shadowed through sys.path
+  import utime
+  sys.modules["time"] = utime
+  for name in ("_thread","ssl"):
+    spec = importlib.util.spec_from_file_location(name,os.path.join(FAKES,name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+  gc.mem_free = lambda: 100000
+  gc.mem_alloc = lambda: 20000
+  gc.threshold = lambda *args: None
+
+
+def parse_time(value):
+  if isinstance(value,(int,float)):
+    return int(value * 1000)
+  t = datetime.datetime.fromisoformat(value)
+  return calendar.timegm(t.timetuple()) * 1000
+
+
+def sun_altitude(ms,lat,lng):
+  # degrees, good enough to shape a lux curve
+  days = ms / 86400000.0 - 10957.5
+  g = math.radians((357.529 + 0.98560028 * days) % 360)
+  q = (280.459 + 0.98564736 * days) % 360
+  lam = math.radians(q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g))
+  eps = math.radians(23.439 - 0.00000036 * days)
+  decl = math.asin(math.sin(eps) * math.sin(lam))
+  ra = math.degrees(math.atan2(math.cos(eps) * math.sin(lam),math.cos(lam)))
+  gmst = (280.46061837 + 360.98564736629 * days) % 360
+  hour_angle = math.radians(gmst + lng - ra)
+  lat = math.radians(lat)
+  return math.degrees(math.asin(math.sin(lat) * math.sin(decl) + math.cos(lat) * math.cos(decl) * math.cos(hour_angle)))
+
+
+class Environment:
+  '''
+  Sensor values at a time: synthetic from the sun and the season, replaced
+  by trace "sensor" events where there are any.
+  '''
+
+  def __init__(self,lat,lng,seed):
+    self.lat = lat
+    self.lng = lng
+    self.overrides = []
+    self.rng = random.Random(seed)
+    self.noise = [self.rng.uniform(-3,3) for _ in range(400)]
+
+  def __call__(self,ms):
+    for start,end,values in self.overrides:
+      if start <= ms < end:
+        return values
+    altitude = sun_altitude(ms,self.lat,self.lng)
+    if altitude > 0:
+      lux = 120000 * math.sin(math.radians(altitude))
+    else:
+      # twilight falls off by about a decade per degree
+      lux = 400 * 10 ** (altitude / 1.2)
+    day = int(ms // 86400000)
+    season = -math.cos(2 * math.pi * ((day - 15) % 365) / 365)
+    hour = (ms // 1000 % 86400) / 3600.0 + self.lng / 15
+    temperature = 8 + 16 * season + 5 * math.sin(2 * math.pi * (hour - 9) / 24) + self.noise[day % 400]
+    return {"lux": round(lux,2),"temperature": round(temperature,1),"humidity": 60.0,"pressure": 101325.0}
+
+
+class Simulation:
+
+  def __init__(self,args):
+    self.args = args
+    with open(args.config) as f:
+      self.config = json.load(f)
+    # no broker or status clients in here
+    self.config.pop("mqtt",None)
+    self.config["status"] = {"port": "0"}
+    self.config.pop("upload",None)
+    if args.upload:
+      self.config["upload"] = {"host": "collector.sim","port": "443","path": "/upload"}
+    self.config.pop("power",None)
+    if args.battery:
+      self.config["power"] = {"battery_pin": str(BATTERY_ADC),"battery_scale": "5.0",
+                              "solar_pin": str(SOLAR_ADC),"solar_scale": "8.0"}
+    self.lat = float(self.config["location"]["lat"])
+    self.lng = float(self.config["location"]["lng"])
+    schedule = self.config.get("schedule",{})
+    self.utc_offset = int(args.utc_offset if args.utc_offset is not None else schedule.get("utc_offset","0"))
+    self.start = parse_time(args.start)
+    self.end = self.start + args.days * 86400000
+
+    self.world = simworld.World(self.start,drift_ppm=args.drift,boot_ms=args.boot_ms)
+    simworld.world = self.world
+    self.env = Environment(self.lat,self.lng,args.seed)
+    self.world.env = self.env
+    if args.battery:
+      self.world.analog[BATTERY_ADC] = lambda ms: self.battery(ms) / 5.0
+      self.world.analog[SOLAR_ADC] = lambda ms: 20.0 * max(math.sin(math.radians(sun_altitude(ms,self.lat,self.lng))),0.0) / 8.0
+    self.world.pin(MODE_SWITCH).value = 0 if args.mode == "auto" else 1
+
+    self.workdir = tempfile.mkdtemp(prefix="doorsim")
+    with open(os.path.join(self.workdir,"config.json"),"w") as f:
+      json.dump(self.config,f)
+    os.chdir(self.workdir)
+
+    import door
+    self.models = []
+    for index,pins in enumerate(self.config.get("doors",None) or [door.DEFAULT_PINS]):
+      name = pins.get("name","door{0}".format(index))
+      model = simworld.DoorModel(self.world,name,pins,travel=args.travel,
+                                 invert=pins.get("invert_dir",False),bounce=args.bounce,
+                                 stall=args.stall_curve)
+      self.models.append(model)
+    self.world.doors = self.models
+
+    self.days = {}
+    self.violations = []
+    self.calibrations = []
+    # power level -> [wakes, ms awake, ms with Wi-Fi on]
+    self.levels = {}
+    self.rtc_peak = 0
+    self.events = []
+    self.load_events()
+    self.schedule_checks()
+
+  # inputs
+
+  def load_events(self):
+    args = self.args
+    events = []
+    if args.trace:
+      with open(args.trace) as f:
+        for line in f:
+          line = line.strip()
+          if line:
+            events.append(json.loads(line))
+    rng = random.Random(args.seed)
+    span = self.end - self.start
+    for _ in range(args.outages):
+      t = self.start + rng.randrange(span)
+      events.append({"t": t / 1000,"type": "outage","until": (t + rng.randrange(600000,6 * 3600000)) / 1000})
+    for _ in range(args.presses):
+      t = self.start + rng.randrange(span)
+      events.append({"t": t / 1000,"type": "button","op": rng.choice(("open","close"))})
+    for _ in range(args.jams):
+      t = self.start + rng.randrange(span)
+      events.append({"t": t / 1000,"type": "jam","until": (t + rng.randrange(60000,3600000)) / 1000})
+    for event in events:
+      self.add_event(event)
+
+  def _doors(self,event):
+    name = event.get("door",None)
+    return [model for model in self.models if name is None or model.name == name]
+
+  def add_event(self,event):
+    world = self.world
+    t = parse_time(event["t"])
+    kind = event["type"]
+    until = parse_time(event["until"]) if "until" in event else None
+    if kind == "button":
+      gpio = OPEN_BUTTON if event["op"] == "open" else CLOSE_BUTTON
+      world.at(t,lambda: world.press(gpio))
+    elif kind == "outage":
+      world.outages.append((t,until))
+    elif kind in ("jam","obstruction"):
+      for model in self._doors(event):
+        windows = model.jams if kind == "jam" else model.obstructions
+        windows.append((t,until))
+        windows.sort()
+    elif kind == "stuck":
+      for model in self._doors(event):
+        gpio = model.open_limit if event["switch"] == "open" else model.close_limit
+        model.stuck.append((t,until,gpio))
+    elif kind == "sensor":
+      values = dict(self.env(t))
+      values.update({k: v for k,v in event.items() if k not in ("t","type","until")})
+      self.env.overrides.append((t,until or self.end,values))
+    elif kind == "mode":
+      value = 0 if event["value"] == "auto" else 1
+      world.at(t,lambda: world.set_input(MODE_SWITCH,value))
+    elif kind == "calibrate":
+      world.at(t,lambda: world.power_cycle(hold=(OPEN_BUTTON,CLOSE_BUTTON)))
+    elif kind == "travel":
+      def travel(models=self._doors(event),steps=int(event["steps"])):
+        for model in models:
+          model.travel = steps
+      world.at(t,travel)
+    else:
+      raise ValueError("unknown trace event " + kind)
+    self.events.append((t,kind))
+
+  def schedule_checks(self):
+    import rules
+    from solar import Solar
+    solar = Solar(self.lat,self.lng)
+    checks = []
+    for name,rule,want in (("closed",self.args.closed_after,"closed"),("open",self.args.open_after,"opened")):
+      if rule and rule != "none":
+        checks.append((name,rules.compile_rule(rule),want))
+    day = self.start - self.start % 86400000
+    while day < self.end:
+      date = datetime.datetime.utcfromtimestamp(day / 1000)
+      midnight = day // 1000
+      anchors = [None if m is None else midnight + int(m * 60) for m in solar.events(date.year,date.month,date.day)]
+      anchors.append(midnight - self.utc_offset)
+      for name,rule,want in checks:
+        t = rules.evaluate(rule,anchors)
+        if t is not None and self.start <= t * 1000 < self.end:
+          self.world.at(t * 1000,lambda name=name,want=want: self.check_doors(name,want))
+      day += 86400000
+
+  # invariants and the summary
+
+  def battery(self,ms):
+    # volts, a straight line from the first to the last --battery value
+    points = self.args.battery
+    if len(points) == 1:
+      return points[0]
+    share = (ms - self.start) / max(self.end - self.start,1) * (len(points) - 1)
+    index = min(int(share),len(points) - 2)
+    return points[index] + (points[index + 1] - points[index]) * (share - index)
+
+  def local_day(self,ms):
+    return datetime.datetime.utcfromtimestamp(ms / 1000 + self.utc_offset).date().isoformat()
+
+  def day(self,ms):
+    key = self.local_day(ms)
+    day = self.days.get(key,None)
+    if day is None:
+      day = self.days[key] = {"wakes": 0,"awake": 0,"longest": 0,"events": [],"requests": 0,
+                              "overdrive": 0.0,"violations": []}
+    return day
+
+  def violation(self,ms,text):
+    self.day(ms)["violations"].append(text)
+    self.violations.append((ms,text))
+
+  def check_doors(self,name,want):
+    for model in self.models:
+      ok = model.closed() if want == "closed" else model.opened()
+      if not ok:
+        self.violation(self.world.now,"{0} not {1} at {2}".format(model.name,name,self.clock(self.world.now)))
+
+  def clock(self,ms):
+    t = datetime.datetime.utcfromtimestamp(ms / 1000 + self.utc_offset)
+    return t.strftime("%H:%M")
+
+  # the run
+
+  def boot_once(self,cause,reason):
+    world = self.world
+    world.boot(cause,reason)
+    import rtcmem
+    # RTC memory is reread after a reset, like on the board
+    rtcmem._data = None
+    import main
+    try:
+      with contextlib.redirect_stdout(self.quiet or sys.stdout):
+        main.ChickenDoor()
+      raise simworld.SimError("ChickenDoor returned instead of sleeping")
+    except simworld.DeepSleep as e:
+      return e.ms,DEEPSLEEP_RESET
+    except simworld.Reset:
+      return None,SOFT_RESET
+    except (Exception,SystemExit) as e:
+      self.violation(world.now,"crash: {0!r}".format(e))
+      if self.args.verbose or self.args.stop_on_fail:
+        raise
+      # a hung board gets power cycled by the owner an hour later
+      world.sleeping = True
+      world.run_until(min(world.now + 3600000,self.end))
+      world.sleeping = False
+      return None,PWRON_RESET
+
+  def run(self):
+    world = self.world
+    import main
+    # watch door events without changing what the firmware does
+    door_event = main.ChickenDoor.door_event
+
+    def record(controller,door,event,seconds=None):
+      self.day(world.now)["events"].append((world.now,door.name,event))
+      return door_event(controller,door,event,seconds)
+    main.ChickenDoor.door_event = record
+
+    # the firmware's prints and log lines, unless --verbose
+    self.quiet = None
+    if not self.args.verbose:
+      import logging
+      self.quiet = open(os.devnull,"w")
+      logging.basicConfig(stream=self.quiet)
+
+    started = real_time.perf_counter()
+    cause = PWRON_RESET
+    reason = 0
+    wakes = 0
+    while world.now < self.end:
+      woke = world.now
+      requests = len(world.requests)
+      ms,next_cause = self.boot_once(cause,reason)
+      awake = world.now - woke
+      self.check_rtc(woke)
+      wakes += 1
+      day = self.day(woke)
+      day["wakes"] += 1
+      day["awake"] += awake
+      day["longest"] = max(day["longest"],awake)
+      day["requests"] += len(world.requests) - requests
+      calibrated = self.calibration(woke)
+      level = self.power_level()
+      if level:
+        self.levels[level][0] += 1
+        self.levels[level][1] += awake
+      if awake > self.args.awake_budget * 1000 and not calibrated:
+        self.violation(woke,"awake {0:.1f}s from {1}".format(awake / 1000,self.clock(woke)))
+      if self.args.stop_on_fail and self.violations:
+        break
+      cause = next_cause
+      if next_cause == DEEPSLEEP_RESET:
+        radio = world.radio_ms
+        reason = world.deep_sleep(ms,self.end)
+        if level:
+          self.levels[level][2] += world.radio_ms - radio
+        if reason is None:
+          break
+        if reason == POWER_CYCLE:
+          cause = PWRON_RESET
+          reason = 0
+      else:
+        reason = 0
+    elapsed = real_time.perf_counter() - started
+
+    for model in self.models:
+      # overdrive per day from the door logs isn't kept, report the total
+      self.day(self.end - 1)["overdrive"] += model.overdrive
+    self.report(wakes,elapsed)
+    shutil.rmtree(self.workdir,ignore_errors=True)
+    return not self.violations
+
+  def check_rtc(self,woke):
+    # RTC.memory() raises past the 2048 bytes, rtcmem.save() drops entries first
+    import rtcmem
+    self.rtc_peak = max(self.rtc_peak,len(self.world.rtc_memory or b""))
+    if rtcmem.dropped:
+      self.violation(woke,"RTC memory full, {0} entries dropped".format(rtcmem.dropped))
+      rtcmem.dropped = 0
+
+  def power_level(self):
+    # the level the wake ran at, None without --battery
+    if not self.args.battery:
+      return None
+    import power
+    import rtcmem
+    state = rtcmem.get('power',None)
+    level = power.LEVELS[state[0]] if state else "normal"
+    self.levels.setdefault(level,[0,0,0])
+    return level
+
+  def calibration(self,woke):
+    # picks up the report a calibration wake leaves behind
+    try:
+      with open("calibration.json") as f:
+        report = json.load(f)
+    except OSError:
+      return False
+    os.remove("calibration.json")
+    self.calibrations.append((woke,report["report"]))
+    return True
+
+  def report(self,wakes,elapsed):
+    print("{0:<10} {1:>5} {2:>8} {3:>7}  {4:<24} {5:>4}  {6}".format(
+          "day","wakes","awake s","max s","opened/closed","msgs","violations"))
+    for key in sorted(self.days):
+      day = self.days[key]
+      moves = " ".join("{0}{1}".format("o" if event == "opened" else "c",self.clock(t))
+                       for t,name,event in day["events"] if event in ("opened","closed") and name == self.models[0].name)
+      print("{0:<10} {1:>5} {2:>8.1f} {3:>7.1f}  {4:<24} {5:>4}  {6}".format(
+            key,day["wakes"],day["awake"] / 1000,day["longest"] / 1000,moves[:24],day["requests"],
+            "; ".join(day["violations"])))
+    overdrive = sum(model.overdrive for model in self.models)
+    for t,lines in self.calibrations:
+      print("")
+      print("calibrated {0} {1}".format(self.local_day(t),self.clock(t)))
+      for line in lines:
+        print("  " + line)
+    print("")
+    print("{0} days, {1} wakes, {2} violations, simulated in {3:.1f}s".format(
+          len(self.days),wakes,len(self.violations),elapsed))
+    import rtcmem
+    print("RTC memory peak: {0} of {1} bytes".format(self.rtc_peak,rtcmem.SIZE))
+    print("steps driven into end stops: {0:.0f} ({1:.1f} per move)".format(
+          overdrive,overdrive / max(sum(len(model.log) for model in self.models),1)))
+    if self.args.upload:
+      self.upload_report()
+    if self.args.battery:
+      import power
+      for level in power.LEVELS:
+        if level in self.levels:
+          wakes,awake,radio = self.levels[level]
+          print("power {0:<8} {1:>6} wakes, {2:>6.1f}s awake and {3:>6.1f}s Wi-Fi per wake".format(
+                level,wakes,awake / 1000 / max(wakes,1),radio / 1000 / max(wakes,1)))
+    if self.args.max_overdrive is not None:
+      for model in self.models:
+        moves = max(len(model.log),1)
+        if model.overdrive / moves > self.args.max_overdrive:
+          self.violations.append((self.end,"{0}: {1:.0f} steps into the stops per move".format(model.name,model.overdrive / moves)))
+          print("FAIL {0}: {1:.0f} steps into the stops per move".format(model.name,model.overdrive / moves))
+
+  def upload_report(self):
+    import zlib
+    import batch
+    world = self.world
+    days = max(len(self.days),1)
+    batches = payload = records = single = 0
+    for t,line,body in world.requests:
+      if b" /upload " not in line:
+        continue
+      # every batch has to decode, or the run fails
+      try:
+        decoded = batch.decode(body,zlib.decompress)
+      except Exception as e:
+        self.violations.append((t,"batch does not decode: {0!r}".format(e)))
+        continue
+      batches += 1
+      payload += len(body)
+      device = decoded["device"].hex()
+      for record in decoded["events"]:
+        single += JSON_HEAD + len(json.dumps({"device": device,"seq": record[0],"time": record[1],"door": record[2],
+                                              "event": record[3],"seconds": record[4]}))
+      for start,values in decoded["samples"]:
+        single += JSON_HEAD + len(json.dumps({"device": device,"time": start,"seconds": decoded["seconds"],"values": values}))
+      for woke,awake,scheduled,error,latency in decoded["wakes"]:
+        single += JSON_HEAD + len(json.dumps({"device": device,"time": woke,"awake": awake,"scheduled": scheduled,
+                                              "error": error,"latency": latency}))
+      records += len(decoded["events"]) + len(decoded["samples"]) + len(decoded["wakes"])
+      if self.args.batches:
+        with open(os.path.join(self.args.batches,"{0:06d}.bin".format(batches)),"wb") as f:
+          f.write(body)
+    # one request per record: a round trip each and the bigger bodies
+    extra = (records - batches) * world.rtt_ms + (single - payload) * 8000 / world.uplink_bps
+    print("uploads: {0:.1f} batches, {1:.0f} bytes, {2:.0f} records a day; Wi-Fi on {3:.1f}s a day".format(
+          batches / days,payload / days,records / days,world.radio_ms / 1000 / days))
+    print("  as one JSON request per record: {0:.0f} bytes and {1:.1f}s more on the air a day".format(
+          single / days,extra / 1000 / days))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run the door firmware on a virtual clock.")
+  parser.add_argument("--config",default=os.path.join(REPO,"example_config.json"))
+  parser.add_argument("--trace",default=None)
+  parser.add_argument("--start",default="2024-01-01T00:00:00")
+  parser.add_argument("--days",type=int,default=365)
+  parser.add_argument("--mode",choices=("auto","manual"),default="auto")
+  parser.add_argument("--utc-offset",default=None,help="seconds, defaults to the schedule's")
+  parser.add_argument("--seed",type=int,default=1)
+  parser.add_argument("--outages",type=int,default=0)
+  parser.add_argument("--presses",type=int,default=0)
+  parser.add_argument("--jams",type=int,default=0)
+  parser.add_argument("--travel",type=int,default=4000,help="door travel in steps")
+  parser.add_argument("--bounce",type=int,default=0,help="extra limit switch edges per contact")
+  parser.add_argument("--stall-curve",default=None,type=lambda value: tuple(float(part) for part in value.split(",")),
+                      help="HZ,HZ_PER_S: the motor stalls past this top speed, and past this acceleration "
+                           "falling to none at the top speed. Never stalls without it")
+  parser.add_argument("--drift",type=int,default=0,help="RTC drift in deep sleep, ppm")
+  parser.add_argument("--boot-ms",type=int,default=300)
+  parser.add_argument("--closed-after",default="civil_dusk+30m")
+  parser.add_argument("--open-after",default="none")
+  parser.add_argument("--awake-budget",type=float,default=60)
+  parser.add_argument("--max-overdrive",type=float,default=None)
+  parser.add_argument("--stop-on-fail",action="store_true")
+  parser.add_argument("--upload",action="store_true",help="upload batches and report their cost")
+  parser.add_argument("--batches",default=None,help="with --upload, save every batch in this directory")
+  parser.add_argument("--battery",default=None,type=lambda value: tuple(float(part) for part in value.split(",")),
+                      help="battery volts over the run, V[,V...] evenly spaced, turns on the power policy")
+  parser.add_argument("--verbose",action="store_true")
+  args = parser.parse_args()
+  args.config = os.path.abspath(args.config)
+  if args.trace:
+    args.trace = os.path.abspath(args.trace)
+  if args.batches:
+    args.batches = os.path.abspath(args.batches)
+    os.makedirs(args.batches,exist_ok=True)
+
+  install_fakes()
+  ok = Simulation(args).run()
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+  main()
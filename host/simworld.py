@@ -0,0 +1,517 @@
+'''
+Virtual clock and hardware for the host simulator. The fake MicroPython
+modules in host/fakes all talk to the one World instance here.
+
+Time only moves when the firmware sleeps, waits on a lock or the runner
+lets a deep sleep pass, so a year of wakes runs in seconds. Timer and pin
+callbacks are soft, like on the ESP32: they run between other code, and
+one raised while another is running waits for it to return.
+'''
+import heapq
+import math
+
+# machine.reset_cause() / wake_reason() values, as on the ESP32 port
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+EXT0_WAKE = 2
+EXT1_WAKE = 3
+TIMER_WAKE = 4
+# not a wake reason on the board, the owner pulled the plug
+POWER_CYCLE = 100
+
+
+class DeepSleep(Exception):
+  # raised by machine.deepsleep(), the runner starts the next wake
+  def __init__(self,ms):
+    Exception.__init__(self,ms)
+    self.ms = ms
+
+
+class Reset(Exception):
+  # machine.reset()
+  pass
+
+
+class SimError(Exception):
+  pass
+
+
+class PinState:
+
+  def __init__(self,gpio):
+    self.gpio = gpio
+    self.value = 1
+    self.output = False
+    self.pwm_freq = 0
+    self.handler = None
+    self.trigger = 0
+    # hard irqs run right away, even in the middle of a callback
+    self.hard = False
+    # the Pin object that registered the irq, handlers compare against it
+    self.pin = None
+
+
+class World:
+
+  def __init__(self,start_ms,drift_ppm=0,boot_ms=300,connect_ms=1500,ntp_ms=80,max_awake_ms=6 * 3600 * 1000,
+               rtt_ms=40,tls_ms=400,uplink_bps=1000000):
+    self.now = start_ms        # true time, ms since the epoch
+    self.rtc_offset = 0        # RTC reading minus true time, ms
+    self.drift_ppm = drift_ppm
+    self.boot_ms = boot_ms
+    self.connect_ms = connect_ms
+    self.ntp_ms = ntp_ms
+    # what a request costs on the air: a round trip, the TLS handshake on
+    # a new connection, and the bytes at uplink_bps
+    self.rtt_ms = rtt_ms
+    self.tls_ms = tls_ms
+    self.uplink_bps = uplink_bps
+    self.max_awake_ms = max_awake_ms
+    self.reset_at = start_ms
+    self.pins = {}
+    self.timers = []
+    self.events = []
+    self.seq = 0
+    self.doors = []
+    self.outages = []
+    self.env = lambda ms: {}
+    # volts at an ADC pin, gpio -> fn(ms)
+    self.analog = {}
+    self.rtc_memory = b""
+    self.reset_cause = PWRON_RESET
+    self.wake_reason = 0
+    self.ext0 = None
+    self.ext1 = ()
+    self.wifi_started = None
+    self.depth = 0
+    self.deferred = []
+    self.woken_by = None
+    self.sleeping = False
+    self.deep = False
+    self.requests = []
+    # Wi-Fi on, from connect() to deep sleep, over the whole run
+    self.radio_ms = 0
+
+  # time
+
+  def rtc_ms(self):
+    return self.now + self.rtc_offset
+
+  def ticks_ms(self):
+    return self.now - self.reset_at
+
+  def online(self):
+    for start,end in self.outages:
+      if start <= self.now < end:
+        return False
+    return True
+
+  def at(self,t,fn):
+    # one shot world event, fn() runs at true time t
+    self.seq += 1
+    heapq.heappush(self.events,(t,self.seq,fn))
+
+  def add_timer(self,timer):
+    self.seq += 1
+    timer.generation = self.seq
+    heapq.heappush(self.timers,(timer.due,self.seq,timer))
+
+  def _next_time(self):
+    t = None
+    while self.timers and self.timers[0][2].generation != self.timers[0][1]:
+      heapq.heappop(self.timers)
+    if self.timers:
+      t = self.timers[0][0]
+    if self.events and (t is None or self.events[0][0] < t):
+      t = self.events[0][0]
+    for door in self.doors:
+      crossing = door.next_change()
+      if crossing is not None and (t is None or crossing < t):
+        t = crossing
+    return t
+
+  def _refresh(self):
+    for door in self.doors:
+      door.update()
+
+  def run_until(self,until,stop=None):
+    '''
+    Moves the clock to until (or forever if None), running everything
+    that comes due on the way. Returns early once stop() is true.
+    '''
+    while True:
+      if stop and stop():
+        return True
+      t = self._next_time()
+      if t is None or (until is not None and t > until):
+        break
+      if t > self.now:
+        self.now = t
+      self._refresh()
+      while self.events and self.events[0][0] <= self.now:
+        heapq.heappop(self.events)[2]()
+      while self.timers and self.timers[0][0] <= self.now:
+        due,generation,timer = heapq.heappop(self.timers)
+        if timer.generation != generation:
+          continue
+        if timer.periodic:
+          # a callback held up by a long one does not run twice to catch up
+          timer.due = max(due + timer.period,self.now + 1)
+          self.add_timer(timer)
+        else:
+          timer.generation = None
+        self.dispatch(timer.callback,timer)
+      if self.now - self.reset_at > self.max_awake_ms and not self.sleeping:
+        raise SimError("awake for more than {0}s".format(self.max_awake_ms // 1000))
+    if until is None:
+      raise SimError("nothing left to wake up for")
+    if stop and stop():
+      return True
+    self.now = max(self.now,until)
+    self._refresh()
+    return False
+
+  def sleep(self,ms):
+    self.run_until(self.now + int(ms))
+
+  def wait(self,ready):
+    # a blocked lock, only callbacks can release it
+    if self.depth:
+      raise SimError("blocking wait inside a callback")
+    self.run_until(None,ready)
+
+  def dispatch(self,fn,arg):
+    if self.depth:
+      self.deferred.append((fn,arg))
+      return
+    self.depth += 1
+    try:
+      fn(arg)
+    finally:
+      self.depth -= 1
+    while self.deferred and not self.depth:
+      fn,arg = self.deferred.pop(0)
+      self.depth += 1
+      try:
+        fn(arg)
+      finally:
+        self.depth -= 1
+
+  # pins
+
+  def pin(self,gpio):
+    state = self.pins.get(gpio,None)
+    if state is None:
+      state = self.pins[gpio] = PinState(gpio)
+    return state
+
+  def read(self,gpio):
+    self._refresh()
+    return self.pin(gpio).value
+
+  def word(self,bank):
+    # GPIO_IN_REG (bank 0) or GPIO_IN1_REG (bank 1), every pin at once
+    self._refresh()
+    word = 0
+    for gpio,state in self.pins.items():
+      if (gpio >> 5) == bank and state.value:
+        word |= 1 << (gpio & 31)
+    return word
+
+  def write(self,gpio,value):
+    # outputs change the door physics, integrate up to now first
+    self._refresh()
+    state = self.pin(gpio)
+    state.output = True
+    state.value = 1 if value else 0
+    self._changed()
+
+  def set_pwm(self,gpio,freq):
+    self._refresh()
+    self.pin(gpio).pwm_freq = freq
+    self._changed()
+
+  def _changed(self):
+    for door in self.doors:
+      door.recompute()
+
+  def set_input(self,gpio,value):
+    state = self.pin(gpio)
+    old = state.value
+    state.value = value
+    if state.handler and old != value:
+      rising = value and state.trigger & 1
+      falling = (not value) and state.trigger & 2
+      if rising or falling:
+        if state.hard:
+          state.handler(state.pin)
+        else:
+          self.dispatch(state.handler,state.pin)
+
+  # buttons
+
+  def press(self,gpio,hold_ms=150):
+    '''
+    Presses a pull-up button now. Ends a light or deep sleep if the pin is
+    armed for ext0/ext1 wake.
+    '''
+    self.set_input(gpio,0)
+    self.at(self.now + hold_ms,lambda: self.set_input(gpio,1))
+    if self.ext0 == gpio:
+      self.woken_by = EXT0_WAKE
+    elif gpio in self.ext1:
+      self.woken_by = EXT1_WAKE
+
+  def analog_volts(self,gpio):
+    source = self.analog.get(gpio,None)
+    # the ESP32 ADC tops out a little past 3.1V at 11dB
+    return 0.0 if source is None else min(max(source(self.now),0.0),3.1)
+
+  def power_cycle(self,hold=(),hold_ms=3000):
+    '''
+    Cuts the power during the next deep sleep and boots with the hold
+    buttons down for hold_ms. A wake in progress finishes first.
+    '''
+    if not self.deep:
+      self.at(self.now + 1000,lambda: self.power_cycle(hold,hold_ms))
+      return
+    for gpio in hold:
+      self.set_input(gpio,0)
+      self.at(self.now + hold_ms,lambda gpio=gpio: self.set_input(gpio,1))
+    self.rtc_memory = b""
+    self.woken_by = POWER_CYCLE
+
+  def lightsleep(self,ms):
+    self.woken_by = None
+    self.sleeping = True
+    try:
+      self.run_until(None if ms is None else self.now + ms,lambda: self.woken_by is not None)
+    finally:
+      self.sleeping = False
+    self.wake_reason = self.woken_by or TIMER_WAKE
+
+  def deep_sleep(self,ms,limit):
+    '''
+    Lets a deep sleep pass, at most up to limit. The RTC runs drift_ppm
+    slow while asleep. Returns the wake reason (a button can cut the sleep
+    short), None if limit came first.
+    '''
+    for state in self.pins.values():
+      state.handler = None
+      if state.output:
+        state.value = 0
+      state.pwm_freq = 0
+    self._changed()
+    start = self.now
+    if self.wifi_started is not None:
+      self.radio_ms += start - self.wifi_started
+      self.wifi_started = None
+    until = limit
+    if ms:
+      until = min(start + (ms * (1000000 + self.drift_ppm)) // 1000000,limit)
+    self.woken_by = None
+    self.sleeping = True
+    self.deep = True
+    try:
+      self.run_until(until,lambda: self.woken_by is not None)
+    finally:
+      self.sleeping = False
+      self.deep = False
+    slept = self.now - start
+    self.rtc_offset -= (slept * self.drift_ppm) // (1000000 + self.drift_ppm)
+    if self.woken_by:
+      return self.woken_by
+    if self.now >= limit:
+      return None
+    return TIMER_WAKE
+
+  def boot(self,reset_cause,wake_reason):
+    # everything a reset clears. RTC memory and the flash files stay
+    self.reset_at = self.now
+    self.now += self.boot_ms
+    self.reset_cause = reset_cause
+    self.wake_reason = wake_reason
+    self.timers = []
+    self.deferred = []
+    self.depth = 0
+    self.ext0 = None
+    self.ext1 = ()
+    self.wifi_started = None
+    for state in self.pins.values():
+      state.handler = None
+      state.pin = None
+      if state.output:
+        state.value = 0
+        state.output = False
+      state.pwm_freq = 0
+    self._changed()
+
+
+class DoorModel:
+  '''
+  A door on the fake hardware. It moves at the step frequency while the
+  driver is awake, the limit switches follow its position, and jams or
+  obstructions from the trace stop it.
+  '''
+
+  def __init__(self,world,name,pins,travel=4000,invert=False,bounce=0,stall=None):
+    self.world = world
+    self.name = name
+    self.stp = pins["stp"]
+    self.dir = pins["dir"]
+    self.slp = pins["slp"]
+    self.close_limit = pins["close_limit"]
+    self.open_limit = pins["open_limit"]
+    self.obstruction_limit = pins["obstruction_limit"]
+    self.travel = travel
+    self.invert = invert
+    self.bounce = bounce
+    # (Hz, Hz/s) the motor keeps up with at no speed, see _slips()
+    self.stall = stall
+    self.stalled = False
+    self.freq = 0
+    self.freq_ms = world.now
+    self.position = 0.0
+    self.velocity = 0.0
+    self.last = world.now
+    self.jams = []
+    self.obstructions = []
+    # (start, end, gpio) a limit switch reads made whatever the door does
+    self.stuck = []
+    # steps driven into an end stop, and a (time, "opened"/"closed") log
+    self.overdrive = 0.0
+    self.log = []
+    world.pin(self.close_limit).value = 1
+    world.pin(self.open_limit).value = 0
+    world.pin(self.obstruction_limit).value = 0
+
+  def _window(self,windows):
+    now = self.world.now
+    for start,end in windows:
+      if start <= now < end:
+        return True
+    return False
+
+  def closed(self):
+    return self.position <= 0.5
+
+  def opened(self):
+    return self.position >= self.travel - 0.5
+
+  def _slips(self,freq):
+    '''
+    A straight line torque/speed curve: all the torque is there at a
+    standstill and none is left at the top speed, so the acceleration the
+    motor can follow falls off the same way. Past the curve the rotor
+    loses the step sequence and the door stops dead until the pulses do.
+    '''
+    top,accel = self.stall
+    if freq >= top:
+      return True
+    now = self.world.now
+    if self.freq and freq > self.freq:
+      rate = (freq - self.freq) * 1000.0 / max(now - self.freq_ms,1)
+      if rate > accel * (1 - freq / float(top)):
+        return True
+    return False
+
+  def recompute(self):
+    world = self.world
+    freq = world.pin(self.stp).pwm_freq
+    velocity = 0.0
+    obstructed = False
+    if not world.pin(self.slp).value:
+      freq = 0
+    if freq != self.freq:
+      if not freq:
+        self.stalled = False
+      elif self.stall and not self.stalled:
+        self.stalled = self._slips(freq)
+      self.freq = freq
+      self.freq_ms = world.now
+    if freq:
+      opening = world.pin(self.dir).value == (1 if self.invert else 0)
+      if self.stalled:
+        velocity = 0.0
+      elif self._window(self.jams):
+        velocity = 0.0
+      elif not opening and self._window(self.obstructions):
+        obstructed = True
+      else:
+        velocity = freq if opening else -freq
+    self.velocity = velocity
+    world.set_input(self.obstruction_limit,1 if obstructed else 0)
+
+  def update(self):
+    world = self.world
+    dt = world.now - self.last
+    self.last = world.now
+    if dt <= 0:
+      return
+    if self.velocity:
+      position = self.position + self.velocity * dt / 1000
+      if position > self.travel:
+        self.overdrive += position - self.travel
+        position = float(self.travel)
+      elif position < 0:
+        self.overdrive += -position
+        position = 0.0
+      self.position = position
+    self._switches()
+    # jams and obstructions start and end on their own
+    if self.jams and self.jams[0][1] <= world.now:
+      self.jams.pop(0)
+    if self.obstructions and self.obstructions[0][1] <= world.now:
+      self.obstructions.pop(0)
+    self.recompute()
+
+  def _stuck(self,gpio):
+    now = self.world.now
+    for start,end,switch in self.stuck:
+      if switch == gpio and start <= now < end:
+        return True
+    return False
+
+  def _switches(self):
+    world = self.world
+    closed = 1 if self.closed() or self._stuck(self.close_limit) else 0
+    opened = 1 if self.opened() or self._stuck(self.open_limit) else 0
+    if world.pin(self.close_limit).value != closed:
+      if closed and self.closed():
+        self.log.append((world.now,"closed"))
+      self._edge(self.close_limit,closed)
+    if world.pin(self.open_limit).value != opened:
+      if opened and self.opened():
+        self.log.append((world.now,"opened"))
+      self._edge(self.open_limit,opened)
+
+  def _edge(self,gpio,value):
+    world = self.world
+    if value and self.bounce:
+      # contact bounce, a few extra edges a millisecond apart
+      for i in range(self.bounce):
+        world.set_input(gpio,1)
+        world.set_input(gpio,0)
+    world.set_input(gpio,value)
+
+  def next_change(self):
+    # the next time something about this door changes on its own
+    now = self.world.now
+    t = None
+    if self.velocity > 0 and not self.opened():
+      t = now + max(int(math.ceil((self.travel - 0.5 - self.position) * 1000 / self.velocity)),1)
+    elif self.velocity < 0 and not self.closed():
+      t = now + max(int(math.ceil((self.position - 0.5) * 1000 / -self.velocity)),1)
+    for start,end in self.jams + self.obstructions + [window[:2] for window in self.stuck]:
+      for edge in (start,end):
+        if edge > now and (t is None or edge < t):
+          t = edge
+    return t
+
+
+# the running simulation, set by sim.py before the firmware is imported
+world = None
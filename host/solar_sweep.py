@@ -0,0 +1,170 @@
+'''
+Accuracy sweep of solar.py against the full NOAA solar calculator, every
+day of a year over a range of latitudes, all in NumPy.
+
+  python host/solar_sweep.py
+  python host/solar_sweep.py --year 2030 --lng 10 --step 1 --bound 1
+
+The reference is the NOAA spreadsheet algorithm (Meeus) in double
+precision, iterated at each event's own time until it settles. The
+device side is solar.py's algorithm ported to NumPy and run in float32,
+as MicroPython on the ESP32 does. The port is first checked against
+solar.Solar itself, in double precision, so the two cannot drift apart.
+
+Prints the worst error per latitude and event. Days where the event comes
+within GRAZING degrees of hour angle of local solar noon or midnight (the
+sun only just reaches the altitude) are left out of it and shown as the
+worst error among them in brackets, see solar.py. Exits 1 if an error
+inside solar.MAX_LATITUDE is over --bound minutes.
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HOST))
+import solar
+
+# apparent altitude of each event, as solar.py has them
+ZENITH = np.array([102.0,96.0,90.833,90.833,96.0,102.0])
+RISING = np.array([True,True,True,False,False,False])
+# hour angle, degrees from local solar noon or midnight
+GRAZING = 5.0
+
+
+def reference(days,lat,lng,event):
+  '''
+  NOAA minutes after 00:00 UTC for days (since 2000-01-01) x lat, nan
+  where the sun does not cross the altitude, and the hour angle there in
+  degrees.
+  '''
+  rising = RISING[event]
+  zenith = np.radians(ZENITH[event])
+  lat = np.radians(lat)
+  noon = 720 - 4 * lng
+  minutes = np.full(np.broadcast(days,lat).shape,noon - 360.0 if rising else noon + 360.0)
+  for _ in range(6):
+    t = (days + 2451544.5 + minutes / 1440 - 2451545.0) / 36525
+    l0 = np.radians((280.46646 + t * (36000.76983 + t * 0.0003032)) % 360)
+    m = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    c = (np.sin(m) * (1.914602 - t * (0.004817 + 0.000014 * t)) + np.sin(2 * m) * (0.019993 - 0.000101 * t)
+         + np.sin(3 * m) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * t)
+    lam = np.radians(np.degrees(l0) + c - 0.00569 - 0.00478 * np.sin(omega))
+    eps0 = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+    eps = np.radians(eps0 + 0.00256 * np.cos(omega))
+    decl = np.arcsin(np.sin(eps) * np.sin(lam))
+    y = np.tan(eps / 2) ** 2
+    eqtime = 4 * np.degrees(y * np.sin(2 * l0) - 2 * e * np.sin(m) + 4 * e * y * np.sin(m) * np.cos(2 * l0)
+                            - 0.5 * y * y * np.sin(4 * l0) - 1.25 * e * e * np.sin(2 * m))
+    cos_ha = (np.cos(zenith) - np.sin(lat) * np.sin(decl)) / (np.cos(lat) * np.cos(decl))
+    with np.errstate(invalid="ignore"):
+      ha = np.degrees(np.arccos(cos_ha))
+    minutes = noon - 4 * ha - eqtime if rising else noon + 4 * ha - eqtime
+  return minutes,ha
+
+
+def device(days,lat,lng,event,dtype=np.float32):
+  # solar.Solar.event() for days x lat, in dtype
+  f = dtype
+  rising = RISING[event]
+  zenith_cos = f(solar._ZENITH_COS[solar._ZENITH[event]])
+  lat = np.radians(np.clip(np.asarray(lat,dtype=f),-solar.MAX_LATITUDE,solar.MAX_LATITUDE))
+  sin_lat = np.sin(lat)
+  cos_lat = np.cos(lat)
+  days = np.asarray(days,dtype=f)
+  noon = f(720 - 4 * lng)
+  minutes = np.full(np.broadcast(days,lat).shape,noon - 360 if rising else noon + 360,dtype=f)
+  found = np.ones(minutes.shape,dtype=bool)
+  for _ in range(solar.ITERATIONS):
+    n = days - f(0.5) + minutes / f(1440)
+    big_l = (f(280.460) + f(0.9856474) * n) % f(360)
+    g = np.radians((f(357.528) + f(0.9856003) * n) % f(360))
+    sin_g = np.sin(g)
+    lam = np.radians(big_l + f(1.915) * sin_g + f(0.020) * 2 * sin_g * np.cos(g))
+    eps = np.radians(f(23.439) - f(0.0000004) * n)
+    sin_lam = np.sin(lam)
+    ra = np.degrees(np.arctan2(np.cos(eps) * sin_lam,np.cos(lam)))
+    eqtime = ((big_l - ra + 180) % 360 - 180) * 4
+    decl = np.arcsin(np.sin(eps) * sin_lam)
+    cos_ha = (zenith_cos - sin_lat * np.sin(decl)) / (cos_lat * np.cos(decl))
+    found &= (cos_ha <= 1) & (cos_ha >= -1)
+    ha = np.degrees(np.arccos(np.clip(cos_ha,-1,1)))
+    minutes = noon - 4 * ha - eqtime if rising else noon + 4 * ha - eqtime
+  return np.where(found,minutes,np.nan)
+
+
+def check_port(days,lats,lng):
+  # the NumPy port in double precision against solar.Solar on the host
+  worst = 0.0
+  ported = [device(days[:,None],lats[None,:],lng,event,np.float64) for event in range(6)]
+  for j,lat in enumerate(lats):
+    calc = solar.Solar(float(lat),lng)
+    for i,day in enumerate(days):
+      for event in range(6):
+        value = calc.event(int(day),event)
+        port = ported[event][i,j]
+        if (value is None) != bool(np.isnan(port)):
+          return float("inf")
+        if value is not None:
+          worst = max(worst,abs(value - port))
+  return worst
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Sweep solar.py against the NOAA algorithm.")
+  parser.add_argument("--year",type=int,default=2024)
+  parser.add_argument("--lng",type=float,default=-90.0)
+  parser.add_argument("--max-lat",type=float,default=80.0,help="sweep from -max-lat to max-lat")
+  parser.add_argument("--step",type=float,default=5.0,help="latitude step, degrees")
+  parser.add_argument("--bound",type=float,default=1.0,help="minutes")
+  args = parser.parse_args()
+
+  first = solar.days_since_2000(args.year,1,1)
+  days = np.arange(first,solar.days_since_2000(args.year + 1,1,1),dtype=np.float64)
+  lats = np.arange(-args.max_lat,args.max_lat + args.step / 2,args.step)
+
+  port = check_port(days[::30],lats,args.lng)
+  print("NumPy port vs solar.Solar, double precision: {0:.2g} min".format(port))
+  ok = port < 1e-6
+
+  print("")
+  print("{0:>6}  {1}".format("lat","  ".join("{0:>15}".format(name) for name in solar.EVENTS)))
+  worst_inside = 0.0
+  errors = {}
+  for event in range(6):
+    ref,ha = reference(days[:,None],lats[None,:],args.lng,event)
+    dev = device(days[:,None],lats[None,:],args.lng,event)
+    error = np.abs(dev.astype(np.float64) - ref)
+    # days one side has the event and the other not are grazing too
+    both = ~np.isnan(ref) & ~np.isnan(dev)
+    with np.errstate(invalid="ignore"):
+      grazing = (ha < GRAZING) | (ha > 180 - GRAZING)
+    errors[event] = (np.where(both & ~grazing,error,0).max(axis=0),
+                     np.where(both & grazing,error,0).max(axis=0),
+                     (np.isnan(ref) != np.isnan(dev)).any(axis=0))
+  for j,lat in enumerate(lats):
+    cells = []
+    for event in range(6):
+      worst,grazed,edge = errors[event][0][j],errors[event][1][j],errors[event][2][j]
+      extra = ""
+      if grazed or edge:
+        extra = "({0:.1f}{1})".format(grazed,"*" if edge else "")
+      cells.append("{0:>6.2f}{1:>9}".format(worst,extra))
+      if abs(lat) <= solar.MAX_LATITUDE:
+        worst_inside = max(worst_inside,worst)
+    marker = "" if abs(lat) <= solar.MAX_LATITUDE else "  outside MAX_LATITUDE"
+    print("{0:>6.1f}  {1}{2}".format(lat,"  ".join(cells),marker))
+  print("")
+  print("(n) worst error within {0} degrees of hour angle of noon/midnight, * a day where".format(GRAZING))
+  print("only one side has the event")
+  print("worst error inside +/-{0} deg: {1:.2f} min (bound {2})".format(solar.MAX_LATITUDE,worst_inside,args.bound))
+  ok = ok and worst_inside <= args.bound
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,176 @@
+'''
+Keep-alive HTTP(S) client for the notification service. The resolved
+address is cached in RTC memory so later wakes skip DNS, one TLS
+connection is reused for every request in a wake, and queued requests
+are pipelined: all written back to back, then the responses read in order.
+'''
+try:
+  import usocket as socket
+except ImportError:
+  import socket
+try:
+  import ssl
+except ImportError:
+  import ussl as ssl
+import rtcmem
+
+
+class HTTPClient:
+
+  def __init__(self,host,port=443,tls=True,timeout=10):
+    self.host = host
+    self.port = port
+    self.tls = tls
+    self.timeout = timeout
+    self.sock = None
+    self.stream = None
+    # counted so a test server (or the REPL) can see how often we pay for TLS
+    self.handshakes = 0
+    self.requests = 0
+    self.queue = []
+    self._request_head = "Host: {0}\r\nConnection: keep-alive\r\nContent-Length: ".format(host).encode()
+
+  def _address(self,fresh=False):
+    cache = rtcmem.get('dns',{})
+    ip = cache.get(self.host)
+    if fresh or not ip:
+      ip = socket.getaddrinfo(self.host,self.port)[0][-1][0]
+      cache[self.host] = ip
+      rtcmem.set('dns',cache)
+    # a numeric address resolves locally, no DNS round trip
+    return socket.getaddrinfo(ip,self.port)[0][-1]
+
+  def connect(self):
+    for fresh in (False,True):
+      sock = socket.socket()
+      sock.settimeout(self.timeout)
+      try:
+        sock.connect(self._address(fresh))
+        break
+      except OSError:
+        sock.close()
+        if fresh:
+          raise
+    if self.tls:
+      sock = ssl.wrap_socket(sock,server_hostname=self.host)
+      self.handshakes += 1
+    self.sock = sock
+    if hasattr(sock,"readline"):
+      self.stream = sock
+    else:
+      # cpython sockets, when run against a test server on the host
+      self.stream = sock.makefile("rwb")
+
+  def close(self):
+    if self.sock:
+      try:
+        self.sock.close()
+      except OSError:
+        pass
+    self.sock = None
+    self.stream = None
+
+  def _write_request(self,method,path,body,headers):
+    write = self.stream.write
+    write(method)
+    write(b" ")
+    write(path)
+    write(b" HTTP/1.1\r\n")
+    for header in headers:
+      write(header)
+    write(self._request_head)
+    write(str(len(body)).encode())
+    write(b"\r\n\r\n")
+    write(body)
+    self.requests += 1
+
+  def _flush(self):
+    flush = getattr(self.stream,"flush",None)
+    if flush:
+      flush()
+
+  def _read_response(self):
+    line = self.stream.readline()
+    if not line:
+      raise OSError(-1)
+    status = int(line.split(None,2)[1])
+    length = 0
+    chunked = False
+    keep_alive = True
+    while True:
+      line = self.stream.readline()
+      if not line or line == b"\r\n":
+        break
+      name,_,value = line.partition(b":")
+      name = name.strip().lower()
+      value = value.strip()
+      if name == b"content-length":
+        length = int(value)
+      elif name == b"transfer-encoding" and value.lower() == b"chunked":
+        chunked = True
+      elif name == b"connection" and value.lower() == b"close":
+        keep_alive = False
+    if chunked:
+      body = b""
+      while True:
+        size = int(self.stream.readline().split(b";")[0],16)
+        if size == 0:
+          self.stream.readline()
+          break
+        body += self.stream.read(size)
+        self.stream.readline()
+    else:
+      body = self.stream.read(length) if length else b""
+    if not keep_alive:
+      self.close()
+    return status,body
+
+  def request(self,method,path,body=b"",headers=()):
+    '''
+    One request on the shared connection, reconnecting once if the server
+    dropped it while idle. Returns (status, body).
+    '''
+    for retry in (False,True):
+      if not self.sock:
+        self.connect()
+      try:
+        self._write_request(method,path,body,headers)
+        self._flush()
+        return self._read_response()
+      except OSError:
+        self.close()
+        if retry:
+          raise
+
+  def queue_request(self,method,path,body=b"",headers=(),tag=None):
+    # body must not be a buffer that gets reused before flush(), tag is
+    # handed back to flush()'s on_response with the status
+    self.queue.append((method,path,body,headers,tag))
+
+  def flush(self,on_response=None):
+    '''
+    Pipelines everything queued over one connection. Returns the statuses
+    in order, and calls on_response(tag, status) for each if given.
+    Requests whose response never came are left in the queue.
+    '''
+    statuses = []
+    while self.queue:
+      if not self.sock:
+        self.connect()
+      try:
+        for method,path,body,headers,tag in self.queue:
+          self._write_request(method,path,body,headers)
+        self._flush()
+        for _ in range(len(self.queue)):
+          status = self._read_response()[0]
+          statuses.append(status)
+          tag = self.queue.pop(0)[4]
+          if on_response:
+            on_response(tag,status)
+          if not self.sock:
+            # server asked to close, send the rest on a new connection
+            break
+      except OSError:
+        self.close()
+        raise
+    return statuses
@@ -0,0 +1,84 @@
+from machine import lightsleep
+from machine import deepsleep
+from machine import wake_reason
+import machine
+import utime
+import gc
+import rtcmem
+
+
+class IdleManager:
+  '''
+  Spends the time between events in light sleep instead of spinning the
+  CPU. Buttons (ext0/ext1) and the sleep timer wake it up. Garbage is only
+  collected when free heap drops below low_water, and the time spent
+  active, in light sleep and in deep sleep is kept across deep sleeps in
+  RTC memory so it can be reported from the REPL.
+  '''
+
+  def __init__(self,busy=None,on_wake=None,low_water=None):
+    # busy() returns True while something (motor, network) needs the CPU
+    self.busy = busy
+    # on_wake(reason) is called when a light sleep ends on a button
+    self.on_wake = on_wake
+    if low_water is None:
+      low_water = (gc.mem_free() + gc.mem_alloc()) // 4
+    self.low_water = low_water
+    self.collections = 0
+    self.light_ms = 0
+    self.boot_ms = utime.ticks_ms()
+
+    # totals carried over from previous wakes
+    self.totals = rtcmem.get('idle',[0,0,0,0])
+    slept_at = self.totals[3]
+    if slept_at:
+      # the RTC keeps running through deep sleep, so this also counts
+      # sleeps that were cut short by a button
+      self.totals[2] += max(utime.time() - slept_at,0) * 1000
+      self.totals[3] = 0
+
+  def collect(self):
+    if gc.mem_free() < self.low_water:
+      gc.collect()
+      self.collections += 1
+
+  def idle(self,ms):
+    self.collect()
+    if self.busy and self.busy():
+      utime.sleep_ms(ms)
+      return
+    start = utime.ticks_ms()
+    lightsleep(ms)
+    self.light_ms += utime.ticks_diff(utime.ticks_ms(),start)
+    reason = wake_reason()
+    if self.on_wake and reason in (machine.EXT0_WAKE,machine.EXT1_WAKE):
+      self.on_wake(reason)
+
+  def wait_until(self,deadline,step_ms=1000):
+    # deadline is a utime.time() value and may be moved by the caller
+    while utime.time() <= deadline():
+      self.idle(step_ms)
+
+  def active_ms(self):
+    return utime.ticks_diff(utime.ticks_ms(),self.boot_ms) - self.light_ms
+
+  def deepsleep(self,ms=None):
+    self.totals[0] += self.active_ms()
+    self.totals[1] += self.light_ms
+    self.totals[3] = utime.time()
+    rtcmem.set('idle',self.totals)
+    rtcmem.save()
+    if ms:
+      deepsleep(ms)
+    else:
+      deepsleep()
+
+  def report(self):
+    active = self.totals[0] + self.active_ms()
+    light = self.totals[1] + self.light_ms
+    deep = self.totals[2]
+    total = max(active + light + deep,1)
+    print("active: {0}ms ({1}%)".format(active,(active * 100) // total))
+    print("light sleep: {0}ms ({1}%)".format(light,(light * 100) // total))
+    print("deep sleep: {0}ms ({1}%)".format(deep,(deep * 100) // total))
+    print("gc collections this wake: {0}".format(self.collections))
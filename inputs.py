@@ -0,0 +1,259 @@
+'''
+Switch and button inputs, sampled by a hardware timer instead of trusted
+edge by edge. Each scan reads the GPIO input registers, so every pin in
+it is seen at the same instant: GPIO0-31 in one word and GPIO32-39 in
+another, and both limits of a door sit in the same word.
+
+A pin edge only starts the timer. Every watched pin then gets an
+integrating debounce: a count that moves one per scan toward the level
+read, and the debounced level only flips once the count reaches 0 or
+samples. The timer stops again when everything has been settled for
+samples scans, so nothing runs while the switches are quiet. Clean edges
+are queued from the scan and handed to the handlers in one scheduled
+call.
+
+The scan works in arrays allocated for size pins when the scanner is
+built (main.py sizes it from the doors in the config) and does not
+allocate.
+'''
+from machine import Pin
+from machine import Timer
+from machine import mem32
+from array import array
+import micropython
+import utime
+
+# ESP32 GPIO_IN_REG and GPIO_IN1_REG
+GPIO_IN = 0x3FF4403C
+GPIO_IN1 = 0x3FF44040
+
+# pins a scanner takes unless it is sized for more, and the most it can
+# take: a queued event keeps the pin index in 7 bits
+MAX_PINS = 16
+LIMIT = 128
+QUEUE = 32
+
+
+class InputScanner:
+
+  def __init__(self,timer=1,period_ms=1,samples=5,size=MAX_PINS):
+    if size > LIMIT:
+      raise ValueError("too many inputs")
+    self.period_ms = period_ms
+    self.samples = samples
+    self.timer = Timer(timer)
+    self.running = False
+    self.count = 0
+    self.size = size
+    self.pins = [None] * size
+    self.handlers = [None] * size
+    self._bank = bytearray(size)
+    self._mask = array('I',[0] * size)
+    self._trigger = bytearray(size)
+    # pins whose own irq is proof enough of a rising edge, see kick()
+    self._latch = bytearray(size)
+    self._level = bytearray(size)
+    self._integrator = bytearray(size)
+    # ring of (pin index | level << 7), plus the ticks_ms it was queued
+    self._events = bytearray(QUEUE)
+    self._times = array('i',[0] * QUEUE)
+    self._head = 0
+    self._tail = 0
+    self._dispatching = False
+    # watched bits of each register word, and their values at the last scan
+    self._watched = array('I',[0,0])
+    self._last = array('I',[0,0])
+    self._quiet = 0
+    self.scans = 0
+    self.dropped = 0
+    # bound once, a bound method is an allocation
+    self._scan = self.scan
+    self._dispatch = self.dispatch
+
+  def watch(self,gpio,handler=None,trigger=Pin.IRQ_RISING,pull=Pin.PULL_UP,irq=True,latch=False):
+    '''
+    Adds a switch and returns its Pin. handler(pin) is called on the
+    debounced edges in trigger. With irq=False the caller owns the pin
+    irq and has to kick() the scanner from it. Raises ValueError once
+    the scanner's size is used up.
+    '''
+    index = self.count
+    if index >= self.size:
+      raise ValueError("too many inputs")
+    pin = Pin(gpio,Pin.IN,pull)
+    self.pins[index] = pin
+    self.handlers[index] = handler
+    self._bank[index] = 1 if gpio >= 32 else 0
+    self._mask[index] = 1 << (gpio & 31)
+    self._trigger[index] = trigger
+    self._watched[self._bank[index]] |= self._mask[index]
+    self._latch[index] = 1 if latch else 0
+    self.count = index + 1
+    self._settle(index)
+    if irq:
+      pin.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING,handler=self.kick)
+    return pin
+
+  def _word(self,bank):
+    return mem32[GPIO_IN1 if bank else GPIO_IN]
+
+  def _settle(self,index):
+    level = 1 if self._word(self._bank[index]) & self._mask[index] else 0
+    self._level[index] = level
+    self._integrator[index] = self.samples if level else 0
+
+  def sync(self):
+    # take the levels as they are now without reporting any edges, for
+    # an edge that was already handled some other way (a wake button)
+    for index in range(self.count):
+      self._settle(index)
+
+  def pair(self,first,second):
+    '''
+    Raw levels of two pins from the same register read, first << 1 |
+    second. Pins on different banks are read back to back.
+    '''
+    low = mem32[GPIO_IN]
+    high = mem32[GPIO_IN1]
+    index = self.pins.index(first)
+    level = 2 if (high if self._bank[index] else low) & self._mask[index] else 0
+    index = self.pins.index(second)
+    if (high if self._bank[index] else low) & self._mask[index]:
+      level |= 1
+    return level
+
+  def kick(self,pin=None):
+    if pin is not None:
+      index = self.pins.index(pin)
+      if self._latch[index] and not self._level[index]:
+        # this pin's irq already acted on the edge (the motor is stopped),
+        # the switch may let go before a scan ever sees it
+        self._level[index] = 1
+        self._integrator[index] = self.samples
+        self._queue(index,1)
+    if not self.running:
+      self.running = True
+      self._quiet = 0
+      self.timer.init(period=self.period_ms,mode=Timer.PERIODIC,callback=self._scan)
+
+  def scan(self,timer):
+    self.scans += 1
+    low = mem32[GPIO_IN] & self._watched[0]
+    high = mem32[GPIO_IN1] & self._watched[1]
+    last = self._last
+    if low == last[0] and high == last[1] and self._quiet >= self.samples:
+      self._stop()
+      return
+    last[0] = low
+    last[1] = high
+    samples = self.samples
+    integrator = self._integrator
+    level = self._level
+    settling = False
+    for index in range(self.count):
+      word = high if self._bank[index] else low
+      count = integrator[index]
+      if word & self._mask[index]:
+        if count < samples:
+          count += 1
+      elif count:
+        count -= 1
+      integrator[index] = count
+      if count == samples:
+        if not level[index]:
+          level[index] = 1
+          self._queue(index,1)
+      elif count == 0:
+        if level[index]:
+          level[index] = 0
+          self._queue(index,0)
+      else:
+        settling = True
+    if settling:
+      self._quiet = 0
+    else:
+      self._quiet += 1
+
+  def _stop(self):
+    self.timer.deinit()
+    self.running = False
+
+  def _queue(self,index,level):
+    if not self._trigger[index] & (Pin.IRQ_RISING if level else Pin.IRQ_FALLING):
+      return
+    head = (self._head + 1) % QUEUE
+    if head == self._tail:
+      self.dropped += 1
+      return
+    self._events[self._head] = index | (level << 7)
+    self._times[self._head] = utime.ticks_ms()
+    self._head = head
+    if not self._dispatching:
+      self._dispatching = True
+      try:
+        micropython.schedule(self._dispatch,None)
+      except RuntimeError:
+        self._dispatching = False
+
+  def dispatch(self,_):
+    self._dispatching = False
+    while self._tail != self._head:
+      index = self._events[self._tail] & 0x7f
+      self._tail = (self._tail + 1) % QUEUE
+      handler = self.handlers[index]
+      if handler:
+        handler(self.pins[index])
+
+  def age_ms(self):
+    # how long the oldest queued edge has waited, 0 if none
+    if self._tail == self._head:
+      return 0
+    return utime.ticks_diff(utime.ticks_ms(),self._times[self._tail])
+
+
+def bench(out=25,gpio=26,bounces=6,bounce_us=300,runs=20):
+  '''
+  Needs out jumpered to gpio. Returns (scan us with everything settled,
+  scan us while settling, mean edge latency us, worst edge latency us); the
+  latency runs from the first bounce to the handler, bounce included.
+  '''
+  scanner = InputScanner()
+  driver = Pin(out,Pin.OUT,value=0)
+  seen = [0]
+  def handler(pin):
+    seen[0] = utime.ticks_us()
+  scanner.watch(gpio,handler,trigger=Pin.IRQ_RISING,pull=None)
+
+  start = utime.ticks_us()
+  for _ in range(1000):
+    scanner._quiet = 0
+    scanner.scan(None)
+  quiet = utime.ticks_diff(utime.ticks_us(),start) // 1000
+  start = utime.ticks_us()
+  for _ in range(1000):
+    scanner._quiet = 0
+    scanner._integrator[0] = 1
+    scanner._last[0] = 1
+    scanner.scan(None)
+  busy = utime.ticks_diff(utime.ticks_us(),start) // 1000
+  scanner._stop()
+  scanner.sync()
+
+  total = worst = 0
+  for _ in range(runs):
+    seen[0] = 0
+    edge = utime.ticks_us()
+    for _ in range(bounces):
+      driver.value(1)
+      utime.sleep_us(bounce_us)
+      driver.value(0)
+      utime.sleep_us(bounce_us)
+    driver.value(1)
+    utime.sleep_ms(50)
+    latency = utime.ticks_diff(seen[0],edge)
+    total += latency
+    worst = max(worst,latency)
+    driver.value(0)
+    utime.sleep_ms(50)
+  scanner._stop()
+  return quiet,busy,total // runs,worst
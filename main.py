@@ -1,9 +1,27 @@
 from machine import Pin
 from machine import PWM
 from machine import I2C
+from machine import Timer
 from machine import deepsleep
 from machine import reset
-from Suntime import Sun
+from rules import Schedule
+from wake_planner import WakePlanner
+from door import Door
+from door import DEFAULT_PINS
+from door import MSG_OPENED
+from idle import IdleManager
+from inputs import InputScanner
+from mqtt import Telemetry
+from sensors import Sensors
+from rollup import Rollup
+from eventlog import EventLog
+from export import Exporter
+from uploader import Uploader
+from uploader import note_wake
+from status_api import StatusServer
+from status_led import StatusLed
+from power import PowerPolicy
+from notify_policy import NotificationPolicy
 import utime
 import ntptime
 from time import sleep, sleep_ms
@@ -13,11 +31,21 @@ import os
 import esp32
 import network
 import _thread
-import urequests
+from http_client import HTTPClient
 import json
 import gc
+import rtcmem
 import logging
 import micropython
+import machine
+from meminfo import MemProbe
+import meminfo
+
+
+PUSHOVER_PATH = b"/1/messages.json"
+PUSHOVER_HEADERS = (b"Content-Type: application/json\r\n",)
+# what has to run on a timer wake before the doors can move
+WARM_PHASES = ("boot","config","sensors")
 
 
 class ChickenDoor:
@@ -25,235 +53,385 @@ class ChickenDoor:
     # Enable garbage collection
     gc.enable()
     _thread.stack_size(8192)
+    # first, so the boot phase it measures ends as early as possible
+    self.planner = WakePlanner()
+    # a button that woke us from deep sleep, handled before anything slow
+    self.wake_operation = self.button_wake_operation()
+    self.mem = MemProbe()
+    # preallocated buffers for the hot paths, see meminfo.count_allocs
+    self._time_buf = bytearray(b"00:00:00")
+    self._payload = bytearray(256)
+    # one keep-alive TLS connection to pushover per wake
+    self.http = HTTPClient("api.pushover.net")
+    # ticks when the oldest undelivered notification was raised, and how
+    # long the last ones took to get out
+    self._notify_since = None
+    self.notify_latency = None
+    # replaced by load_config when there is a "power" section
+    self.power = PowerPolicy()
+    self.notifications = NotificationPolicy()
+    # set up per wake once the network is there, door events can come first
+    self.telemetry = None
+    self.uploader = None
+    # True once network_up() is through, button wakes and manual mode never get there
+    self.network_ready = False
+    # while network_up() runs
+    self.network_starting = False
+    self.sensors = None
+    self.status = None
+    # bounded long term sensor and door event history in flash
+    self.history = Rollup()
+    self.event_log = EventLog()
 
     # setup pins for esp32-32s
-    self.led = Pin(2,Pin.OUT)
-    self.activity_led = Pin(19,Pin.OUT)
-    self.activity_led.value(1)
-
-    self.slp = Pin(14,Pin.OUT,None)
-    self.stp = Pin(27,Pin.OUT) #step when stepper mode
-    self.dir = Pin(26,Pin.OUT) #dir when stepper mode
+    self.leds = StatusLed(2,19)
+    self.leds.show("boot")
 
     # Determines if the door is in auto mode or manual
     self.mode_switch = Pin(25,Pin.IN,Pin.PULL_UP)
 
-    # close_limit stops the motor when closing - normally closed
-    self.close_limit = Pin(32,Pin.IN,Pin.PULL_UP)
-    # open_limit stops the motor when opening - normally closed
-    self.open_limit = Pin(33,Pin.IN,Pin.PULL_UP)
-    # obstruction_limit stops the motor while closing, but before
-    # the close limit. in case theres an obstruction. The motor mount will flex
-    # and touch the switch. Copied from the "ladies first" door.- normally closed
-    self.obstruction_limit = Pin(35,Pin.IN,Pin.PULL_UP)
-    
-    # Setup interrupts for the limit switches
-    self.open_limit.irq(trigger=Pin.IRQ_RISING, handler=self.limit_handler)
-    self.close_limit.irq(trigger=Pin.IRQ_RISING, handler=self.limit_handler)
-    self.obstruction_limit.irq(trigger=Pin.IRQ_RISING, handler=self.limit_handler)
-
+    # the stepper, limit switch and state pins for each door live in door.Door
+    self.doors = []
+    # one timer ticks the steppers of every moving door
+    self.motion_timer = Timer(0)
+    self.motion_running = False
 
     self.manual_open = Pin(15,Pin.IN,Pin.PULL_UP)
     self.manual_close = Pin(4,Pin.IN,Pin.PULL_UP)
 
 
-    if self.load_config():
+    with self.planner.phase("config"):
+      loaded = self.load_config()
+
+    # every switch and button goes through the one debouncing scanner: the
+    # three limits of each door, the mode switch and the two buttons
+    doors = len(getattr(self,"door_pins",None) or [DEFAULT_PINS])
+    self.inputs = InputScanner(size=3 * doors + 3)
+    if loaded:
       ## Config was successfully loaded
       # Check if the open button is being held at startup...
-      if ((self.manual_open.value() == 0) and (self.manual_close.value() == 1)):
+      # (the button that woke us from deep sleep may still be down, that's not a hold)
+      if (not self.wake_operation) and ((self.manual_open.value() == 0) and (self.manual_close.value() == 1)):
         self.update_config()
       ## holding the close button at startup puts the controller in diag mode.
       ## it will connect to wifi and drop to a repl prompt
-      elif ((self.manual_open.value() == 1) and (self.manual_close.value() == 0)):
+      elif (not self.wake_operation) and ((self.manual_open.value() == 1) and (self.manual_close.value() == 0)):
         self.wifi_connect()
         sys.exit()
-        
+      ## holding both buttons at startup tunes the motors, see calibrate.py
+      elif (not self.wake_operation) and ((self.manual_open.value() == 0) and (self.manual_close.value() == 0)):
+        self.calibrate()
+
       else:
         if self.mode_switch.value() == 0:
           self.mode = "auto"
         elif self.mode_switch.value() == 1:
           self.mode = "manual"
 
+        self.setup_logger()
+
         if self.is_stepper:
-          self.slp_status = False
-          self.close_dir = True
-          self.open_dir = False
+          for index,pins in enumerate(self.door_pins):
+            self.doors.append(Door(self,pins,index))
         else:
           pass
 
+        if self.wake_operation:
+          # the doors start before the threads, the sensors and the network
+          for door in self.doors:
+            door.manual(self.wake_operation)
+          latency = utime.ticks_ms()
+          self.planner.record("button",latency)
 
-        self.mode_switch.irq(trigger=Pin.IRQ_RISING|Pin.IRQ_FALLING, handler=self.mode_callback)
 
-        self.setup_logger()
-        self.blink_freq = 0.1
+        self.mode_switch = self.inputs.watch(25,self.mode_callback,trigger=Pin.IRQ_RISING|Pin.IRQ_FALLING)
+
+        self.idle = IdleManager(busy=self.is_busy,on_wake=self.button_wake)
+        self.last_input_ms = 0
         self.operation = None
+        self.next_operation = None
         self.next_operation_time = None
 
-        _thread.start_new_thread(self.blink,())
+        self.leds.show("idle")
 
         if self.mode == "manual":
-          self.manual_open.irq(trigger=Pin.IRQ_FALLING, handler=self.input_handler)
-          self.manual_close.irq(trigger=Pin.IRQ_FALLING, handler=self.input_handler)
+          self.manual_open = self.inputs.watch(15,self.input_handler,trigger=Pin.IRQ_FALLING)
+          self.manual_close = self.inputs.watch(4,self.input_handler,trigger=Pin.IRQ_FALLING)
           self.log.info("Started monitoring for user input")
+          if self.wake_operation:
+            self.log.info("{0} from button, first step after {1}ms".format(self.wake_operation,latency))
           self.timeout = utime.time() + (60)
-          while utime.time() <= self.timeout:
-            sleep(1)
+          # light sleep between presses, the buttons wake us back up
+          self.arm_wake()
+          self.idle.wait_until(lambda: self.timeout)
 
           self.standby()
 
 
+        elif self.mode == "auto" and self.wake_operation:
+          # a button press overrides the schedule until the next scheduled
+          # wake, so nothing here would undo it. The network waits for then too
+          self.log.info("{0} from button, first step after {1}ms".format(self.wake_operation,latency))
+          # polled, not wait(): the limit, step and stall callbacks that end
+          # the moves only run on this thread, a lock wait here never ends
+          for door in self.doors:
+            while door.operation_done.pending:
+              utime.sleep_ms(20)
+          self.schedule.evaluate(utime.time())
+          wake = self.schedule.next_operation_time or (utime.time() + 3600)
+          self.standby(duration=self.planner.sleep_ms(wake,WARM_PHASES) / 1000)
+
         elif self.mode == "auto":
-          #Connect to Wifi
-          self.wifi_connect()
-          #Set the RTC to NTP...
-          while True:
-            try:
-              ntptime.settime()
-              break
-            except:
-              self.log.info("Error setting RTC. Retrying...")
-              sleep(1)
-          gc.collect()
-  
-
-          #Set the sunrise/sunset attributes
-          _thread.start_new_thread(self.get_sunrise_sunset,())
+          with self.planner.phase("sensors"):
+            # the charge decides what else this wake does
+            self.power.update()
+            self.sensors = Sensors(scl=self.i2c_scl,sda=self.i2c_sda)
+            self.sensors.read()
+            if self.planner.clock_valid():
+              # a sample stamped with an RTC still at 2000 would be dropped anyway
+              self.history.add(self.sensors.sample_time,self.sensors.latest)
+          if not self.planner.clock_valid():
+            # after a power cycle the RTC is wrong, the network has to come first
+            self.network_up()
 
           #Start the thread to watch the clock
           _thread.start_new_thread(self.time_monitor,())
 
-        # check for a state file and set
-        self.target = self.get_target_state()
     else: 
       self.update_config()
 
 
-  def input_handler(self,pin):
-
-    if self.input_sense_time:
-      pass
-    else:
-      self.input_sense_count += 1
-      self.input_sense_time = utime.ticks_ms() + 5
-
-    if ((utime.ticks_ms() < self.input_sense_time) and (self.input_sense_count > 1)):
-      # this irq is detected during debounce time of 5ms
-      pass
-    else:
-      if pin == self.manual_open:
-        if self.manual_open.value() == 0:
-          self.operation = "open"
-          self.slp_status = not self.slp_status
-          if self.slp_status:
-            self.open(notify=False)
-          else:
-            self.disable_motor()
-
-      elif pin == self.manual_close:
-        if self.manual_close.value() == 0:
-          self.operation = "close"
-          self.slp_status = not self.slp_status
-          if self.slp_status:
-            self.close(notify=False)
-          else:
-            self.disable_motor()
-
-      #enable_irq(self.input_irq_status)
-      self.limit_sense_time = None
-      self.limit_sense_count = 0
-      self.timeout = utime.time() + (60)
-
+  def network_up(self):
+    # is_busy() keeps light sleep out of the association and the DNS/NTP waits
+    self.network_starting = True
+    try:
+      if not self.motion_running:
+        self.leds.show("connecting")
+      with self.planner.phase("wifi"):
+        self.wifi_connect()
+      #Set the RTC to NTP...
+      # a deep sleep wake already has a usable RTC, an outage must not keep
+      # it awake past the next operation
+      tries = 3 if self.planner.clock_valid() else None
+      if tries and (not self.sta_if.isconnected() or not self.power.allows("ntp")):
+        tries = 0
+      with self.planner.phase("ntp"):
+        while tries != 0:
+          try:
+            self.planner.sync(ntptime.settime)
+            break
+          except:
+            self.log.info("Error setting RTC. Retrying...")
+            if tries is not None:
+              tries -= 1
+            sleep(1)
+        if tries == 0:
+          self.log.info("No NTP, keeping the RTC time")
+      gc.collect()
 
-  def limit_handler(self,pin):
-    if self.limit_sense_time:
-      pass
-    else:
-      self.limit_sense_count += 1
-      self.limit_sense_time = utime.ticks_ms() + 5
+      now = utime.time()
+      # only counted as sent once it got out, a failed connect tries again next wake
+      telemetry = self.power.telemetry_due(now)
+      if self.mqtt_config and telemetry:
+        # one connection for the whole wake, queued messages go out first
+        self.telemetry = Telemetry(self.mqtt_config,self.command)
+        if self.telemetry.connect():
+          self.power.telemetry_sent(now)
+          self.publish_state()
+          self.telemetry.sample(self.sensors.latest)
+          self.telemetry.power(self.power.status())
+      if self.upload_config and telemetry:
+        self.uploader = Uploader(self.upload_config,self.history,self.event_log)
+      if self.status_port and self.power.allows("status"):
+        # local json status for as long as this wake lasts
+        self.status = StatusServer(self,port=self.status_port)
+        _thread.start_new_thread(self.status.run,())
+      self.network_ready = True
+      if not self.motion_running:
+        self.leds.show("idle")
+    finally:
+      self.network_starting = False
+
+  def button_wake_operation(self):
+    # ext0 is armed on the open button and ext1 on the close button
+    reason = machine.wake_reason()
+    if reason == machine.EXT0_WAKE:
+      return "open"
+    if reason == machine.EXT1_WAKE:
+      return "close"
+    return None
+
+  def is_busy(self):
+    # light sleep stops the step timer and the radio, only allow it while no
+    # door moves, no network is coming up and Wi-Fi is off. In auto mode that
+    # is the wait for the next operation before the network comes up, and
+    # button wakes
+    if self.motion_running or self.network_starting:
+      return True
+    for door in self.doors:
+      if door.operation_done.pending:
+        return True
+    sta_if = getattr(self,"sta_if",None)
+    return sta_if is not None and sta_if.active()
+
+  def button_wake(self,reason):
+    # A button ended a light sleep. The pin irq may or may not have seen
+    # the edge while asleep, only handle it here if it didn't.
+    if utime.ticks_diff(utime.ticks_ms(),self.last_input_ms) > 100:
+      if reason == machine.EXT0_WAKE:
+        self.input_handler(self.manual_open)
+      else:
+        self.input_handler(self.manual_close)
+      # the scanner must not report this press a second time
+      self.inputs.sync()
 
-    if ((utime.ticks_ms() < self.limit_sense_time) and (self.limit_sense_count > 1)):
-      # this irq is detected during debounce time of 5ms
-      pass
+  def input_handler(self,pin):
+    # a debounced press from the input scanner, or the button that woke us
+    self.last_input_ms = utime.ticks_ms()
+
+    # the manual buttons drive every door on this controller
+    if pin == self.manual_open:
+      for door in self.doors:
+        door.manual("open")
+
+    elif pin == self.manual_close:
+      for door in self.doors:
+        door.manual("close")
+
+    #enable_irq(self.input_irq_status)
+    self.timeout = utime.time() + (60)
+
+
+  def notify(self,door,message,priority=0,event=None):
+    if not self.power.allows("alert" if priority > 0 else "notify"):
+      return
+    if event and not self.notifications.allow(door.index,event,priority,utime.time()):
+      # rate limited, or routine and waiting for the digest
+      return
+    # with more than one door the message says which one
+    name = None
+    if len(self.doors) > 1:
+      name = door.name_bytes
+    if self._notify_since is None:
+      self._notify_since = utime.ticks_ms()
+    if priority > 0 and self.network_ready:
+      status = self.send(self.app_token,self.group_key,message,priority,name=name)
+      self._delivered((door.index,event) if event else None,status)
     else:
-      if pin == self.open_limit:
-        # The door is open, disable the driver!
-        if self.operation == "open":
-          self.disable_motor()
-          self.log.info("Door has been opened")
-          self.limit_sense_time = None
-          if self.mode == "auto":
-            if not self.notification_sent:
-              #_thread.start_new_thread(self.send,(self.app_token,self.group_key,"Door Opened!"))
-              self.send(self.app_token,self.group_key,"Door Opened!")
-              self.notification_sent = True
-      elif pin == self.close_limit:
-        # The door is closed, disable the driver!
-        if self.operation == "close":
-          self.disable_motor()
-          self.log.info("Door has been closed")
-          self.limit_sense_time = None
-          if self.mode == "auto":
-            if not self.notification_sent:
-              #_thread.start_new_thread(self.send,(self.app_token,self.group_key,"Door Closed!"))
-              self.send(self.app_token,self.group_key,"Door Closed!")
-              self.notification_sent = True
-      elif pin == self.obstruction_limit:
-        if self.obstruction_limit.value() == 1:
-          if self.close_attempts < 2:
-            self.limit_sense_time = None
-            # The door encountered an obstruction while closing!
-            # disable the driver, change direction, and reenable? maybe just change direction??
-            self.log.info("Hit an obstruction")
-            self.disable_motor()
-            self.dir.value(not self.dir.value())
-            self.enable_motor()
-            sleep(3)
-            self.disable_motor()
-            self.dir.value(not self.dir.value())
-            self.enable_motor()
-            self.close_attempts += 1
-          else:
-            if self.mode == "auto":
-              self.disable_motor()
-              if not self.notification_sent:
-                #self.send(self.app_token,self.group_key,"!!! Check the door !!!",1)
-                _thread.start_new_thread(self.send,(self.app_token,self.group_key,"!!! Check the door !!!",1))
-                self.notification_sent = True
-              
-            self.limit_sense_time = None
-            self.open()
-
-  def disable_motor(self):
-    self.pending_operation = False
-    self.pending_operation_time = 0
-
-    motor_freq = self.motor_max
-    if getattr(self,"pwm",None):
-      while motor_freq > self.motor_min:
-        self.pwm.freq(motor_freq)
-        motor_freq -= self.motor_ramp_steps
-        sleep_ms(self.motor_ramp_time)
-
-    if getattr(self,"pwm",None):
-      self.pwm.deinit()
-
-    self.slp.value(0)
-
-  def enable_motor(self):
-    self.slp.value(1)
-    #self.pwm = PWM(self.stp, freq=1200)
-    motor_freq = self.motor_min
-    self.pwm = PWM(self.stp, freq=motor_freq)
-    while motor_freq < self.motor_max:
-      self.pwm.freq(motor_freq)
-      motor_freq += self.motor_ramp_steps
-      sleep_ms(self.motor_ramp_time)
-    self.pending_operation = True
-    self.pending_operation_time = utime.time()
-    if self.operation == "close":
-      self.log.info("closing the door...")
-    elif self.operation == "open":
-      self.log.info("opening the door...")
+      # routine messages, and alerts while Wi-Fi is not up (a button wake,
+      # a low battery, a close before the network), wait for
+      # flush_notifications() and go out pipelined on one connection. The
+      # payload buffer is reused so keep a copy
+      self.http.queue_request(b"POST",PUSHOVER_PATH,bytes(self.build_payload(message,priority,name)),PUSHOVER_HEADERS,
+                              (door.index,event) if event else None)
+
+  def queue_digest(self,now):
+    # the daily digest rides along with this wake's other notifications,
+    # returns the last event sequence number in it (None if not due)
+    if not (self.network_ready and self.power.allows("notify")):
+      return None
+    if not self.notifications.digest_due(now):
+      return None
+    seq = self.event_log.last()
+    text = self.notifications.digest(now,self.event_log,self.history,self.door_names())
+    payload = self._payload_prefix + json.dumps(text)[1:-1].encode() + b'", "priority": -1}'
+    self.http.queue_request(b"POST",PUSHOVER_PATH,payload,PUSHOVER_HEADERS)
+    return seq
+
+  def flush_notifications(self):
+    # True once everything queued is out
+    attempts = 0
+    if self.http.queue and not self.network_ready:
+      # a button wake or a low battery one skipped Wi-Fi, up just for these
+      self.wifi_connect()
+      if not self.sta_if.isconnected():
+        # no network, the retries would only keep the board awake
+        attempts = 5
+    while self.http.queue and attempts < 5:
+      with self.mem.track("send"):
+        try:
+          print(self.http.flush(self._delivered))
+        except:
+          print(micropython.mem_info())
+      attempts += 1
+      if self.http.queue:
+        sleep(5)
+    delivered = not self.http.queue
+    if delivered:
+      self.notified()
+    for request in self.http.queue:
+      self._delivered(request[4],None)
+    self.http.queue = []
+    self.http.close()
+    return delivered
+
+  def _delivered(self,tag,status):
+    # flush() callback, the policy's rate limit counts from a 2xx
+    if tag:
+      self.notifications.delivered(tag[0],tag[1],utime.time(),status is not None and 200 <= status < 300)
+
+  def notified(self):
+    # everything raised so far is out
+    if self._notify_since is not None:
+      self.notify_latency = utime.ticks_diff(utime.ticks_ms(),self._notify_since)
+      self._notify_since = None
+
+  def door_event(self,door,event,seconds=None):
+    if event in ("obstructed","stalled"):
+      self.leds.show("fault")
+    self.event_log.add(utime.time(),door.index,event,seconds)
+    if self.telemetry:
+      self.telemetry.event(door,event,seconds)
+    if self.status:
+      self.status.events.add(door.name,event,seconds)
+      self.status.update()
+
+  def door_names(self):
+    # by door index, from the config as config mode has no Door objects
+    pins = getattr(self,"door_pins",None) or [DEFAULT_PINS]
+    return [door.get("name","door{0}".format(index)) for index,door in enumerate(pins)]
+
+  def exporter(self):
+    return Exporter(self.history,self.event_log,self.door_names())
+
+  def publish_state(self):
+    if self.telemetry:
+      for door in self.doors:
+        self.telemetry.state(door,door.check_limits()['actual'])
+    if self.status:
+      self.status.update()
+
+  def command(self,command):
+    # "open", "close" or "resync" for every door, "<door>:open" for one of them
+    name,_,operation = command.rpartition(":")
+    self.log.info("Received command {0}".format(command))
+    for door in self.doors:
+      if name and name != door.name:
+        continue
+      if operation == "open":
+        door.open()
+      elif operation == "close":
+        door.close()
+      elif operation == "resync":
+        door.sync_state()
+    self.publish_state()
+
+  def motion_started(self):
+    if not self.motion_running:
+      self.motion_running = True
+      self.leds.show("moving")
+      self.motion_timer.init(period=20, mode=Timer.PERIODIC, callback=self.motion_tick)
+
+  def motion_tick(self,timer):
+    moving = False
+    for door in self.doors:
+      if door.moving():
+        door.tick()
+        moving = moving or door.moving()
+    if not moving:
+      self.motion_timer.deinit()
+      self.motion_running = False
+      self.leds.show("idle")
 
   def build_html_form(self,message=""):
     config = {} 
@@ -291,11 +469,15 @@ class ChickenDoor:
         motor_max = int(self.json_config['motor_tuning'].get('motor_max',"1100"))
         ramp_time = int(self.json_config['motor_tuning'].get('ramp_time',"5"))
         ramp_steps = int(self.json_config['motor_tuning'].get('ramp_steps',"10"))
+        approach_steps = int(self.json_config['motor_tuning'].get('approach_steps',"400"))
+        open_percent = int(self.json_config['motor_tuning'].get('open_percent',"100"))
       else:
         motor_min = 500
         motor_max = 1100
         ramp_time = 5
         ramp_steps = 10
+        approach_steps = 400
+        open_percent = 100
 
     else:
       ssid = ""
@@ -306,6 +488,12 @@ class ChickenDoor:
       sunset_offset = "0"
       app_token = ""
       group_key = ""
+      motor_min = 500
+      motor_max = 1100
+      ramp_time = 5
+      ramp_steps = 10
+      approach_steps = 400
+      open_percent = 100
 
 
     html_list = [
@@ -366,6 +554,14 @@ class ChickenDoor:
           "<td align='right'>Motor ramp time:</td>",
           "<td><input type='text' name='ramp_time' placeholder='Time in ms between ramp increments' value='{0}'></td><br>".format(ramp_time),
         "</tr>",
+        "<tr>",
+          "<td align='right'>Motor approach steps:</td>",
+          "<td><input type='text' name='approach_steps' placeholder='Steps run slowly before each end stop' value='{0}'></td><br>".format(approach_steps),
+        "</tr>",
+        "<tr>",
+          "<td align='right'>Open position (%):</td>",
+          "<td><input type='text' name='open_percent' placeholder='100 opens fully' value='{0}'></td><br>".format(open_percent),
+        "</tr>",
         "<tr>",
           "<td><button type='submit' name='save' value='save'>Save Configuration</button></td>",
           "<td><button type='submit' name='reset' value='reset'>Reset Device</button></td>",
@@ -385,6 +581,7 @@ class ChickenDoor:
     
 
   def update_config(self):
+    self.leds.show("configuring")
     _thread.start_new_thread(self.update_reset_monitor,())
     from microdot import Microdot,redirect,send_file,Response
     app = Microdot()
@@ -396,6 +593,17 @@ class ChickenDoor:
     ap.active(True)
     ap.config(essid=ap_ssid, password=ap_password)
 
+    exporter = self.exporter()
+
+    @app.route("/export")
+    def export(request):
+      # the stored history, streamed a chunk at a time, see export.py
+      try:
+        content_type,cursor,chunks = exporter.open(request.query_string or "")
+      except ValueError:
+        return Response(body="bad export query",status_code=400)
+      return Response(body=chunks,headers={"Content-Type": content_type,"X-Cursor": str(cursor)})
+
     @app.route("/", methods=['GET','POST'])    
     def index(request):
       #form_cookie= None
@@ -431,9 +639,16 @@ class ChickenDoor:
                "motor_max": request.form['motor_max'],
                "ramp_steps": request.form['ramp_steps'],
                "ramp_time": request.form['ramp_time'],
+               "approach_steps": request.form['approach_steps'],
+               "open_percent": request.form['open_percent'],
              }
           }
 
+          # keep the sections the form doesnt edit (doors, mqtt, i2c...)
+          for key,value in getattr(self,"json_config",{}).items():
+            if key not in new_config:
+              new_config[key] = value
+
           print(new_config)
           with open("config.json",'w',encoding = 'utf-8') as f:
             print("Saving configuration to config.json...")
@@ -453,6 +668,18 @@ class ChickenDoor:
     app.run(debug=True)
 
 
+  def calibrate(self):
+    import calibrate
+    self.leds.show("configuring")
+    # nothing is notified and the schedule stays off while the doors cycle
+    self.mode = "calibrate"
+    self.setup_logger()
+    for index,pins in enumerate(self.door_pins):
+      self.doors.append(Door(self,pins,index))
+    calibrate.run(self)
+    # start over on the new tuning
+    reset()
+
   def update_reset_monitor(self):
     ## only really used by the update config function
     ## this background thread will reset the device 5s after
@@ -468,153 +695,85 @@ class ChickenDoor:
     logging.basicConfig(level=logging.INFO)
     self.log = logging.getLogger("ChickenDoor")
  
-  def blink(self):
-    while True:
-      if self.blink_freq:
-        self.led.value(1)
-        self.activity_led.value(1)
-        #print("led ON")
-        sleep(self.blink_freq)
-        self.led.value(0)
-        self.activity_led.value(0)
-        #print("led OFF")
-        sleep(self.blink_freq)
-      else:
-        self.led.value(0)
-        self.activity_led.value(0)
-
-
   def mode_callback(self,pin):
     reset()
         
 
   def time_monitor(self):
     while True:
-      if self.next_operation_time:
-        time_till_operation = ((self.next_operation_time - utime.time()))
-        door_status = self.check_limits()
-        if utime.time() > self.next_operation_time:
-          if self.next_operation == "open":
-            if door_status['actual'] != "open":
-              self.open()
-            #else:
-            #  self.standby(duration=time_till_operation)
-          elif self.next_operation == "close":
-            if door_status['actual'] != "closed":
-              self.close()
-            #else:
-            #  self.standby(duration=time_till_operation)
-          else:
-            # This shouldnt happen. its here for completeness
-            print("errmagherd, something is wrong")
-
-          ## Update the next_operation_time using this offset...
-          self.calculate_next_operation(offset=1)
-
-          time_till_operation = ((self.next_operation_time - utime.time()))
-
-          #hours,minutes_remainder,seconds_remainder = self.convert_time(time_till_operation)
-          sleep(1)
-
-          while utime.time() < (self.pending_operation_time + self.operation_timeout):
-            if self.pending_operation:
-              sleep(5)
-
-          self.log.info("Its {0} until the next operation".format(self.convert_time(time_till_operation)))
-          self.standby(duration=time_till_operation)
-
-        else:
-          #hours,minutes_remainder,seconds_remainder = self.convert_time(time_till_operation)
-          #print("Its {0}:{1}:{2} until the next operation".format(hours,minutes_remainder,seconds_remainder))
-          self.log.info("Its {0} until the next operation".format(self.convert_time(time_till_operation)))
-          if self.next_operation == "open":
-            if door_status['actual'] != "closed":
-              # The door should be shut right now! Close it!
-              self.close()
-          elif self.next_operation == "close":
-            if door_status['actual'] != "open":
-              # The door should be open right now! Open it!
-              self.open()
-          
-          #hours,minutes_remainder,seconds_remainder = self.convert_time(time_till_operation)
-          #print("Its {0}:{1}:{2} until the next operation".format(hours,minutes_remainder,seconds_remainder))
-          #print("Its {0} until the next operation".format(self.convert_time(time_till_operation)))
-          while utime.time() < (self.pending_operation_time + self.operation_timeout):
-            if self.pending_operation:
-              sleep(5)
-
-          self.standby(duration=time_till_operation)
-
-        sleep(60)
-      else:
-        print("waiting for sunset/sunrise data...")
-        sleep(1)
+      # the compiled schedule says what should be in effect now and when
+      # the next wake has to happen, the rest of the wake follows from it
+      now = utime.time()
+      operation,wake = self.schedule.evaluate(now,self.sensors.latest if self.sensors else None)
+      self.next_operation = self.schedule.next_operation
+      self.next_operation_time = self.schedule.next_operation_time
+      if self.next_operation_time and self.planner.wait_for(self.next_operation_time,WARM_PHASES):
+        # woke early by the boot lead, evaluate again right on time
+        continue
+      moved = False
+      for door in self.doors:
+        door_status = door.check_limits()
+        if door_status['actual'] == "fault":
+          # held where it is until the switches read sensibly again
+          continue
+        if operation == "open":
+          if door_status['actual'] != "open":
+            door.open()
+            moved = True
+        elif door_status['actual'] != "closed":
+          door.close()
+          moved = True
+      if moved and self.schedule.operation_time and now - self.schedule.operation_time < 600:
+        self.planner.acted(self.schedule.operation_time,self.network_ready)
+
+      if not self.network_ready and self.power.wants_network(now,self.planner.clock_valid()):
+        # the RTC was good enough to act on, the network comes up while the
+        # doors travel or after they stop, then the schedule is checked
+        # again against the NTP time
+        if self.schedule.network_after(operation):
+          for door in self.doors:
+            door.operation_done.wait()
+        self.network_up()
+        for door in self.doors:
+          door.operation_done.wait()
+        continue
+
+      # pick up any remote commands, then block until the limit path
+      # (or the stall timer) ends the moves
+      if self.telemetry:
+        self.telemetry.poll()
+      for door in self.doors:
+        door.operation_done.wait()
+      self.publish_state()
+      if self.status:
+        self.status.update()
+
+      wake = self.power.next_wake(now,wake,self.next_operation_time)
+      sleep_ms = self.planner.sleep_ms(wake,WARM_PHASES)
+      self.log.info("Its {0} until the next wake".format(self.convert_time(sleep_ms // 1000)))
+      self.standby(duration=sleep_ms / 1000)
+      sleep(60)
 
  
-  def convert_time(self,seconds):
-    minutes = int(seconds / 60)
-    seconds_remainder = int(seconds % 60)
-    hours = int(minutes / 60)
-    minutes_remainder = int(minutes % 60)
-  
-    time_str = "{:0>2d}:{:0>2d}:{:0>2d}".format(hours,minutes_remainder,seconds_remainder)
+  def format_time(self,seconds):
+    # HH:MM:SS written into the preallocated buffer, no allocation
+    seconds = int(seconds)
+    buf = self._time_buf
+    value = seconds // 3600
+    buf[0] = 48 + ((value // 10) % 10)
+    buf[1] = 48 + (value % 10)
+    value = (seconds // 60) % 60
+    buf[3] = 48 + (value // 10)
+    buf[4] = 48 + (value % 10)
+    value = seconds % 60
+    buf[6] = 48 + (value // 10)
+    buf[7] = 48 + (value % 10)
+    return buf
 
-    return time_str
+  def convert_time(self,seconds):
+    return self.format_time(seconds).decode()
 
      
-  def calculate_next_operation(self,offset=0):
-      #self.sunrise_dict['current'] = utime.time()
-
-      #print(self.sunrise_dict)
-
-      sorted_dates = sorted(self.sunrise_dict.values())
-      next_operation_index = sorted_dates.index(self.sunrise_dict['current'])+ 1 + offset
-      next_operation_time = sorted_dates[next_operation_index]
-
-      for name,datestamp in self.sunrise_dict.items():
-        if datestamp == next_operation_time:
-          print(name)
-          if name.endswith("sunrise"):
-            ## Open the door 2h after sunrise. allowing time for the chickens to lay eggs and stuff.
-            self.next_operation = "open"
-            self.next_operation_time = next_operation_time
-            #self.next_operation_time = (next_operation_time + self.sunrise_offset)
-          elif name.endswith("sunset"):
-            ## close the door 10m before sunset
-            self.next_operation = "close"
-            self.next_operation_time = next_operation_time
-            #self.next_operation_time = (next_operation_time + self.sunset_offset)
-
-  def get_sunrise_sunset(self):
-    sun = Sun(self.lat,self.lng,0)
-
-    sunrise_sunset_dict = {}
-    current_time = utime.time()
-    today = utime.localtime(current_time)[:3]
-    tomorrow = utime.localtime(current_time + 86400)[:3]
-    yesterday = utime.localtime(current_time - 86400)[:3]
-    days = {
-      'yesterday': yesterday,
-      'today': today,
-      'tomorrow': tomorrow
-    }
-
-    for day in days:
-      sunrise = sun.get_sunrise_time(days[day])
-      sunset = sun.get_sunset_time(days[day])
- 
-
-      ## Adding the sunrise and sunset offsets to these values to make the logic more sane.
-      sunrise_sunset_dict['{0}_sunrise'.format(day)] = (utime.mktime(sunrise+(0,0,0)) + self.sunrise_offset)
-      sunrise_sunset_dict['{0}_sunset'.format(day)] = (utime.mktime(sunset+(0,0,0)) + self.sunset_offset)
-
-    sunrise_sunset_dict['current'] = current_time
-
-    self.sunrise_dict = sunrise_sunset_dict
-    self.calculate_next_operation()
-
-
-
   def load_config(self):
     try:
       with open("config.json","r") as w:
@@ -628,21 +787,31 @@ class ChickenDoor:
         self.sunset_offset = int(self.json_config['time']['sunset_offset'])
         self.app_token = self.json_config['pushover']['app_token']
         self.group_key = self.json_config['pushover']['group_key']
-        self.close_attempts = 0
+        self.set_payload_keys(self.app_token,self.group_key)
         self.is_stepper = True
         self.invert_dir = False
-        self.limit_sense_time = None
-        self.input_sense_time = None
-        self.input_sense_count = 0
-        self.limit_sense_count = 0
-        self.pending_operation = False
-        self.pending_operation_time = 0
         self.operation_timeout = 120
-        self.notification_sent = False
+        # a list of pin maps, one per door. Older configs have one door on the default pins
+        self.door_pins = self.json_config.get('doors',None) or [DEFAULT_PINS]
         self.motor_min = int(self.json_config['motor_tuning']['motor_min'])
         self.motor_max = int(self.json_config['motor_tuning']['motor_max'])
         self.motor_ramp_time = int(self.json_config['motor_tuning']['ramp_time'])
         self.motor_ramp_steps = int(self.json_config['motor_tuning']['ramp_steps'])
+        self.approach_steps = int(self.json_config['motor_tuning'].get('approach_steps',"400"))
+        self.open_percent = int(self.json_config['motor_tuning'].get('open_percent',"100"))
+        # optional parts, missing from older configs
+        self.mqtt_config = self.json_config.get('mqtt',None)
+        self.upload_config = self.json_config.get('upload',None)
+        self.power = PowerPolicy(self.json_config.get('power',None),self.door_pins)
+        self.notifications = NotificationPolicy(self.json_config.get('notifications',None))
+        i2c = self.json_config.get('i2c',{})
+        self.i2c_scl = int(i2c.get('scl',"22"))
+        self.i2c_sda = int(i2c.get('sda',"21"))
+        # port 0 turns the auto mode status endpoint off
+        self.status_port = int(self.json_config.get('status',{}).get('port',"80"))
+        # compiled once, evaluated every wake
+        self.schedule = Schedule(self.json_config.get('schedule',None),self.lat,self.lng,
+                                 self.sunrise_offset,self.sunset_offset)
        
 
         #self.is_stepper = False
@@ -666,19 +835,16 @@ class ChickenDoor:
     print("{0}".format(ap_password.strip()))
     self.sta_if = network.WLAN(network.STA_IF)
     self.sta_if.active(True)
-    self.sta_if.scan()                             # Scan for available access points
     self.sta_if.connect("{0}".format(ap_name.strip()), "{0}".format(ap_password.strip())) # Connect to an AP
     self.sta_if.isconnected()                      # Check for successful connection
     connect_wait = 1
-    while connect_wait <= 30:
+    while connect_wait <= 300:
       #wait for the connection fully activate
-      print("Waiting for connection to activate...")
       if  self.sta_if.isconnected():
         break
-      sleep(1)
+      sleep_ms(100)
       connect_wait += 1
     print(self.sta_if.ifconfig())
-    sleep(5)
     
 
   def reset_state(self):
@@ -698,209 +864,155 @@ class ChickenDoor:
 
       return open1,close1,open2,close2
 
-  def close(self,notify=True,duration=None,attempt=0):
-    gc.collect()
-    if self.is_stepper:
-      #do stepper things...
-      if duration:
-        close_time = utime.time() + duration
-      else:
-        open_time = None
-      #sleep(0.5)
-      with open("state.txt",'w',encoding = 'utf-8') as f:
-        f.write("closed")
-
-      if self.invert_dir:
-        self.dir.value(not self.close_dir)
-      else:
-        self.dir.value(self.close_dir)
-
-      if self.close_limit.value() == 1:
-        self.log.info("Door is already closed!")
-        return
-      else:
-        self.operation = "close"
-        self.enable_motor()
-
-
-  def open(self,notify=True,duration=None):
-    gc.collect()
-
-    if self.is_stepper:
-      #do stepper things...
-      if duration:
-        close_time = utime.time() + duration
-      else:
-        open_time = None
-      #sleep(0.5)
-      with open("state.txt",'w',encoding = 'utf-8') as f:
-        f.write("open")
-      ## maybe set some direction pins here????
-
-      if self.invert_dir:
-        self.dir.value(not self.open_dir)
-      else:
-        self.dir.value(self.open_dir)
-
-      if self.open_limit.value() == 1:
-        self.log.info("Door is already open!")
-        return
-      else:
-        self.operation = "open"
-        self.enable_motor()
-
-
-
-  def send(self,token,user,message,priority=0):
-    attempts = 0
-    while attempts < 5:
-    #while True:
-      gc.collect()
-      try:
-        pushover_url = "https://api.pushover.net/1/messages.json"
-        headers = {'Content-Type': 'application/json'}
-        json_data = json.dumps({'token': token,"user": user,"message": message, "priority": priority})
-        response = urequests.post(url=pushover_url,headers=headers,data=json_data)
-        print(response.status_code)
-        return response
+  def set_payload_keys(self,token,user):
+    # token and user only change with the config, encode them once
+    self._payload_prefix = json.dumps({'token': token,"user": user})[:-1].encode() + b', "message": "'
+
+  def _copy(self,buf,pos,part):
+    for i in range(len(part)):
+      buf[pos + i] = part[i]
+    return pos + len(part)
+
+  def _copy_text(self,buf,pos,part,end):
+    # part as the inside of a json string, cut short rather than run past end
+    start = pos
+    for c in part:
+      if c == 34 or c == 92:
+        if pos + 2 > end:
+          break
+        buf[pos] = 92
+        pos += 1
+      elif pos + 1 > end:
         break
-      except:
-        print(micropython.mem_info())
-        attempts += 1
-        sleep(5)
-
-
-  def get_target_state(self):
-    try:
-      f = open("state.txt",'r',encoding= 'utf-8')
-      target_state = f.read()
-      if target_state == "open":
-        return "open"
-      elif target_state == "closed":
-        return "closed"
-      else:
-        # any other value means something is probably corrupt and needs to be reset
-        return None
-    except OSError:
-       # Couldnt read the file, Probably means it doesnt exist.
-       return None
-
-
-  def check_limits(self):
+      elif c < 32:
+        # control characters would need a \u escape, a space will do
+        c = 32
+      buf[pos] = c
+      pos += 1
+    else:
+      return pos
+    # cut short, don't leave half a utf-8 character behind
+    while pos > start and buf[pos - 1] & 0xC0 == 0x80:
+      pos -= 1
+    if pos > start and buf[pos - 1] >= 0xC0:
+      pos -= 1
+    return pos
+
+  def build_payload(self,message,priority=0,name=None):
     '''
-    One of the limit switches should be open,and one closed. Planning on using normally close
-    switches. If both are closed,that means the door is neither fully open nor fully closed. 
-    if both are open, that condition should not be possible, and probably means some kind of fault.
+    Fills the preallocated payload buffer with the pushover json. The tail
+    is padded with spaces (valid json whitespace) so the whole buffer can be
+    posted without slicing it. message and name are bytes, escaped here and
+    cut short if they don't fit, priority -2..2.
     '''
-
-    # read the values from the limit switches
-    open_limit = self.open_limit.value()
-    close_limit = self.close_limit.value()
-
-    # simple check that the limits arent both open or both closed
-    if close_limit != open_limit:
-      if self.target != None:
-        if self.target == "closed":
-          if close_limit == 1:
-            # the target state is closed and the limit switch says the door is closed.
-            return {"target":"closed","actual":"closed"}
-          else:
-            # the target state is closed and the limit switch says the door is open
-            return {"target":"closed","actual":"open"}
-        elif self.target == "open":
-          if open_limit == 1:
-            # the target state is open and the limit switch says the door is open.
-            return {"target":"open","actual":"open"}
+    buf = self._payload
+    pos = self._copy(buf,0,self._payload_prefix)
+    # room for '", "priority": -2}'
+    end = len(buf) - 18
+    if name:
+      # a long name is cut to leave the message its room
+      pos = self._copy_text(buf,pos,name,end - len(message) - 2)
+      pos = self._copy_text(buf,pos,b": ",end)
+    pos = self._copy_text(buf,pos,message,end)
+    pos = self._copy(buf,pos,b'", "priority": ')
+    if priority < 0:
+      buf[pos] = 45
+      pos += 1
+    buf[pos] = 48 + abs(priority)
+    buf[pos + 1] = 125
+    pos += 2
+    for i in range(pos,len(buf)):
+      buf[i] = 32
+    return buf
+
+  def send(self,token,user,message,priority=0,name=None):
+    if isinstance(message,str):
+      message = message.encode()
+    if token != self.app_token or user != self.group_key:
+      self.set_payload_keys(token,user)
+    attempts = 0
+    while attempts < 5:
+    #while True:
+      with self.mem.track("send"):
+        try:
+          json_data = self.build_payload(message,priority,name)
+          status,body = self.http.request(b"POST",PUSHOVER_PATH,json_data,PUSHOVER_HEADERS)
+          print(status)
+          if not self.http.queue:
+            self.notified()
+          return status
+        except:
+          if self.mem.enabled:
+            self.mem.report()
           else:
-            # the target state is open and the limit switch says the door is closed
-            return {"target":"open","actual":"closed"}
-      else:
-        # This runs when there is no state data. probably newly flashed firmware,
-        # or the door has been reset. The door should close by default...
-        #self.close()
-        return {"target":"unknown","actual":"closed"}
-    else:
-      # condition of both switches are closed. could happen if the door is reset
-      # during an operation
-      if open_limit == 1:
-        # Its not really possible that both switches are open unless theres a broken wire
-        sys.exit()
-      else:
-        if self.target == "closed":
-          return {"target":"closed","actual": "unknown"}
-        elif self.target == "open":
-          return {"target":"open","actual": "unknown"}
+            print(micropython.mem_info())
+      attempts += 1
+      sleep(5)
 
-  def sync_state(self):
+  def mem_bench(self):
     '''
-    Ensure the door matches the intended target state.
-    If it doesn't, either open/close as the state.txt file
-    states.
+    Run from the REPL. Prints bytes allocated per call on each hot path and
+    whether it still runs with the heap locked.
     '''
-    door_status = self.check_limits()
-    if door_status['target'] == "closed":
-      if door_status['actual'] == "closed":
-        # door is closed, and matches config. pass
-        print("door is closed, and matches config.")
-        pass
-      elif door_status['actual'] == "open":
-        # door isnt closed, and config says it should be, close it!
-        print("door isnt closed, and config says it should be, close it!")
-        self.close()
-      else:
-        # everything is awful. exit?!
-       sys.exit()
-    
-    elif door_status['target'] == "open":
-      if door_status['actual'] == "open":
-        # door is open, and matches config. pass
-        print("door is open, and matches config.")
-        pass
-      elif door_status['actual'] == "closed":
-        # door isnt open, and config says it should be, open it!
-        print("door isnt open, and config says it should be, open it!")
-        self.open()
-      else:
-        # everything is awful. exit?!
-        sys.exit()
+    for name,fn,args in (("check_limits",self.doors[0].check_limits,()),
+                         ("format_time",self.format_time,(12345,)),
+                         ("build_payload",self.build_payload,(MSG_OPENED,0))):
+      per_call,locked_ok = meminfo.count_allocs(fn,*args)
+      print("{0}: {1} bytes/call, heap locked: {2}".format(name,per_call,"ok" if locked_ok else "allocates"))
 
-    elif door_status['target'] == 'unknown':
-      # This runs when there is no state data. probably newly flashed firmware,
-      # or the door has been reset. The door should close by default...
-      print("Target isn't defined. Closing the door as default.")
-      self.close()
-
-  def standby(self,duration=None):
-    #self.slp.init(Pin.PULL_HOLD)
-    #duration should be in seconds    
 
+  def arm_wake(self):
     #level parameter can be: esp32.WAKEUP_ANY_HIGH or esp32.WAKEUP_ALL_LOW
     esp32.wake_on_ext0(pin = self.manual_open, level = esp32.WAKEUP_ALL_LOW)
     
     # Couldnt get ext1 with two wakeup switches to work. leave it here for knowledge...
     esp32.wake_on_ext1(pins=[self.manual_close], level=esp32.WAKEUP_ALL_LOW)
     #esp32.wake_on_ext1(pins = [self.manual_open, self.manual_close], level = esp32.WAKEUP_ALL_LOW)
-    
+
+  def standby(self,duration=None):
+    #self.slp.init(Pin.PULL_HOLD)
+    #duration should be in seconds    
+    self.arm_wake()
+    now = utime.time()
+    digest = self.queue_digest(now)
+    if self.flush_notifications() and digest is not None:
+      self.notifications.digest_sent(now,digest)
+    if self.uploader and self.network_ready:
+      # one batch a wake, the radio is still on for the notifications
+      with self.mem.track("upload"):
+        now = utime.time()
+        if self.uploader.upload(now):
+          self.power.telemetry_sent(now)
+        else:
+          self.log.info("Upload failed, kept for the next wake")
+    if getattr(self,"upload_config",None) and rtcmem.get('synced',None) is not None:
+      # goes out with the next batch, this wake is not over yet
+      awake = utime.ticks_ms()
+      note_wake(utime.time() - awake // 1000,awake,self.planner.settled,self.notify_latency)
+    self.planner.save()
+    self.leds.hold()
+    if getattr(self,"telemetry",None):
+      self.telemetry.poll()
+      self.telemetry.sleep()
     
     ###  1000 * 60 * 10 = 10m in milliseconds
     if duration:
-      print('Going to sleep in 30s in case there are any pending threads...')
-      sleep(30)
+      # moves signal operation_done only after their notification is out,
+      # so there is nothing left to wait for here
       print('Going to sleep now...')
-      sleepytime =  duration * 1000
-      deepsleep(sleepytime)
+      sleepytime =  int(duration * 1000)
+      self.idle.deepsleep(sleepytime)
     else:
       # no duration specified, go into deepsleep indefinitely
       print('Going to sleep now...')
-      deepsleep()
+      self.idle.deepsleep()
 
 
-door = ChickenDoor()
-door.blink_freq = 0.5
+# the host simulator imports this module and builds ChickenDoor itself
+if __name__ == "__main__":
+  door = ChickenDoor()
 
-while True:
-  # Waiting for things to happen
-  gc.collect()
-  gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
-  sleep(1)
+  while True:
+    # Waiting for things to happen
+    door.idle.idle(1000)
 
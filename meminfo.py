@@ -0,0 +1,111 @@
+'''
+Heap instrumentation. MemProbe records free heap, the largest free block
+and gc pause time around each subsystem call, and count_allocs() proves a
+hot path is allocation free. Both are meant to be driven from the REPL
+(diag mode) or left enabled while chasing an out-of-memory.
+'''
+import gc
+import utime
+import micropython
+
+
+def largest_free_block(limit=None):
+  # binary search for the biggest bytearray the heap will still give us
+  low = 0
+  high = limit or gc.mem_free()
+  while low < high:
+    size = (low + high + 1) // 2
+    try:
+      block = bytearray(size)
+      del block
+      low = size
+    except MemoryError:
+      high = size - 1
+  return low
+
+
+def count_allocs(fn,*args,runs=100):
+  '''
+  Returns (bytes allocated per call, True if fn ran with the heap locked).
+  '''
+  gc.collect()
+  gc.disable()
+  try:
+    before = gc.mem_alloc()
+    for _ in range(runs):
+      fn(*args)
+    per_call = (gc.mem_alloc() - before) // runs
+  finally:
+    gc.enable()
+
+  locked_ok = True
+  micropython.heap_lock()
+  try:
+    fn(*args)
+  except MemoryError:
+    locked_ok = False
+  finally:
+    micropython.heap_unlock()
+  return per_call,locked_ok
+
+
+class _Track:
+  # one per tracked section, so a send inside an open, or the door thread
+  # next to the main one, keep their own mem_free
+  def __init__(self,probe,name):
+    self.probe = probe
+    self.name = name
+    self.free = 0
+
+  def __enter__(self):
+    self.free = gc.mem_free()
+    return self
+
+  def __exit__(self,*exc):
+    self.probe.record(self.name,self.free)
+    return False
+
+
+class MemProbe:
+
+  def __init__(self,enabled=False,collect=True):
+    self.enabled = enabled
+    # collect before each tracked call, as open/close/send always did
+    self.collect = collect
+    # name -> [calls, lowest mem_free, smallest largest block, longest gc us, most allocated]
+    self.stats = {}
+
+  def gc(self):
+    start = utime.ticks_us()
+    gc.collect()
+    return utime.ticks_diff(utime.ticks_us(),start)
+
+  def track(self,name):
+    # with probe.track("send"): ...
+    pause = 0
+    if self.collect:
+      pause = self.gc()
+    if self.enabled:
+      stat = self.stats.get(name)
+      if stat is None:
+        stat = self.stats[name] = [0,gc.mem_free(),largest_free_block(),0,0]
+      if pause > stat[3]:
+        stat[3] = pause
+    return _Track(self,name)
+
+  def record(self,name,free_before):
+    if not self.enabled:
+      return
+    stat = self.stats[name]
+    free = gc.mem_free()
+    stat[0] += 1
+    if free < stat[1]:
+      stat[1] = free
+      stat[2] = largest_free_block()
+    used = free_before - free
+    if used > stat[4]:
+      stat[4] = used
+
+  def report(self):
+    for name,stat in self.stats.items():
+      print("{0}: calls={1} min_free={2} min_largest={3} max_gc_us={4} max_alloc={5}".format(name,*stat))
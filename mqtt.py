@@ -0,0 +1,304 @@
+'''
+Minimal MQTT 3.1.1 client plus the door telemetry/command channel built
+on it. One connection is kept for the whole wake. QoS1 messages that were
+not acknowledged before deep sleep are kept in RTC memory and resent on
+the next connect.
+'''
+try:
+  import usocket as socket
+except ImportError:
+  import socket
+try:
+  import ustruct as struct
+except ImportError:
+  import struct
+import utime
+import rtcmem
+
+
+class MQTTException(Exception):
+  pass
+
+
+def _field(value):
+  return "" if value is None else str(value)
+
+
+class MQTTClient:
+
+  def __init__(self,client_id,server,port=1883,user=None,password=None,keepalive=60):
+    self.client_id = client_id
+    self.server = server
+    self.port = port
+    self.user = user
+    self.password = password
+    self.keepalive = keepalive
+    self.sock = None
+    self.pid = 0
+    self.cb = None
+    # QoS1 publishes waiting for their PUBACK: pid -> [topic, msg, retain, sent ms]
+    self.inflight = {}
+    self.ack_ms = []
+    self.last_io = 0
+
+  def set_callback(self,cb):
+    self.cb = cb
+
+  def _write(self,data):
+    self.sock.sendall(data)
+    self.last_io = utime.ticks_ms()
+
+  def _read(self,n):
+    data = b""
+    while len(data) < n:
+      chunk = self.sock.recv(n - len(data))
+      if not chunk:
+        raise OSError(-1)
+      data += chunk
+    return data
+
+  def _send_str(self,s):
+    if isinstance(s,str):
+      s = s.encode()
+    self._write(struct.pack("!H",len(s)))
+    self._write(s)
+
+  def _header(self,first,length):
+    pkt = bytearray(5)
+    pkt[0] = first
+    i = 1
+    while length > 0x7f:
+      pkt[i] = (length & 0x7f) | 0x80
+      length >>= 7
+      i += 1
+    pkt[i] = length
+    self._write(pkt[:i + 1])
+
+  def _recv_len(self):
+    n = 0
+    sh = 0
+    while True:
+      b = self._read(1)[0]
+      n |= (b & 0x7f) << sh
+      if not b & 0x80:
+        return n
+      sh += 7
+
+  def connect(self,clean_session=False):
+    addr = socket.getaddrinfo(self.server,self.port)[0][-1]
+    self.sock = socket.socket()
+    self.sock.connect(addr)
+    flags = 0 if not clean_session else 0x02
+    length = 10 + 2 + len(self.client_id)
+    if self.user is not None:
+      flags |= 0xc0
+      length += 2 + len(self.user) + 2 + len(self.password)
+    self._header(0x10,length)
+    self._write(b"\x00\x04MQTT\x04")
+    self._write(struct.pack("!BH",flags,self.keepalive))
+    self._send_str(self.client_id)
+    if self.user is not None:
+      self._send_str(self.user)
+      self._send_str(self.password)
+    resp = self._read(4)
+    if resp[0] != 0x20 or resp[1] != 0x02:
+      raise MQTTException(resp)
+    if resp[3] != 0:
+      raise MQTTException(resp[3])
+    return resp[2] & 1
+
+  def disconnect(self):
+    try:
+      self._write(b"\xe0\x00")
+    finally:
+      self.sock.close()
+      self.sock = None
+
+  def ping(self):
+    self._write(b"\xc0\x00")
+
+  def publish(self,topic,msg,retain=False,qos=0,dup=False):
+    if isinstance(topic,str):
+      topic = topic.encode()
+    if isinstance(msg,str):
+      msg = msg.encode()
+    length = 2 + len(topic) + len(msg)
+    if qos:
+      length += 2
+    self._header(0x30 | (dup << 3) | (qos << 1) | retain,length)
+    self._send_str(topic)
+    pid = None
+    if qos:
+      self.pid = (self.pid % 65535) + 1
+      pid = self.pid
+      self._write(struct.pack("!H",pid))
+      self.inflight[pid] = [topic,msg,retain,utime.ticks_ms()]
+    self._write(msg)
+    return pid
+
+  def subscribe(self,topic,qos=0):
+    if isinstance(topic,str):
+      topic = topic.encode()
+    self.pid = (self.pid % 65535) + 1
+    self._header(0x82,2 + 2 + len(topic) + 1)
+    self._write(struct.pack("!H",self.pid))
+    self._send_str(topic)
+    self._write(bytes((qos,)))
+
+  def check_msg(self):
+    '''
+    Handles one incoming packet if there is one, without blocking.
+    Returns the packet type, or None when nothing was waiting.
+    '''
+    self.sock.setblocking(False)
+    try:
+      first = self.sock.recv(1)
+    except OSError:
+      first = None
+    finally:
+      self.sock.setblocking(True)
+    if first is None:
+      return None
+    if first == b"":
+      raise OSError(-1)
+    return self._handle(first[0])
+
+  def wait_msg(self):
+    return self._handle(self._read(1)[0])
+
+  def _handle(self,op):
+    length = self._recv_len()
+    if op == 0xd0:
+      # PINGRESP
+      return op
+    if op == 0x40:
+      # PUBACK
+      pid = struct.unpack("!H",self._read(2))[0]
+      sent = self.inflight.pop(pid,None)
+      if sent:
+        self.ack_ms.append(utime.ticks_diff(utime.ticks_ms(),sent[3]))
+      return op
+    if op & 0xf0 == 0x30:
+      # PUBLISH from the broker
+      topic_len = struct.unpack("!H",self._read(2))[0]
+      topic = self._read(topic_len)
+      length -= topic_len + 2
+      pid = None
+      if op & 6:
+        pid = struct.unpack("!H",self._read(2))[0]
+        length -= 2
+      msg = self._read(length)
+      if self.cb:
+        self.cb(topic,msg)
+      if op & 6 == 2:
+        self._write(b"\x40\x02" + struct.pack("!H",pid))
+      return op
+    # SUBACK and anything else we dont care about
+    self._read(length)
+    return op
+
+  def bench(self,topic,count=100,size=16):
+    '''
+    Publishes count QoS1 messages and waits for the acks. Returns
+    (messages per second, mean ack ms, worst ack ms).
+    '''
+    self.ack_ms = []
+    payload = b"x" * size
+    start = utime.ticks_ms()
+    for _ in range(count):
+      self.publish(topic,payload,qos=1)
+    while self.inflight:
+      self.wait_msg()
+    elapsed = max(utime.ticks_diff(utime.ticks_ms(),start),1)
+    return (count * 1000) // elapsed,sum(self.ack_ms) // max(len(self.ack_ms),1),max(self.ack_ms or [0])
+
+
+class Telemetry:
+  '''
+  Door state, events and sensor samples out over MQTT, open/close/resync
+  commands in. Topics are <topic>/<door>/state, <topic>/<door>/event,
+  <topic>/sensors, <topic>/power and <topic>/cmd. Payloads are short comma separated
+  values rather than json to keep them small.
+  '''
+
+  MAX_QUEUE = 32
+
+  def __init__(self,config,on_command,client_id="chickendoor"):
+    self.prefix = config.get('topic','coop')
+    self.on_command = on_command
+    self.client = MQTTClient(config.get('client_id',client_id),config['host'],
+                             port=int(config.get('port',"1883")),
+                             user=config.get('user',None),password=config.get('password',None),
+                             keepalive=int(config.get('keepalive',"60")))
+    self.client.set_callback(self._message)
+    self.connected = False
+    # QoS1 messages not yet acked, carried across deep sleep in RTC memory
+    self.queue = rtcmem.get('mqtt_q',[])
+
+  def connect(self):
+    try:
+      self.client.connect()
+      self.client.subscribe(self.prefix + "/cmd",1)
+      self.connected = True
+      # resend what the last wake couldnt get acked, they move to inflight
+      while self.queue:
+        topic,msg = self.queue[0]
+        self.client.publish(topic,msg,qos=1,dup=True)
+        self.queue.pop(0)
+    except (OSError,MQTTException):
+      self.connected = False
+    return self.connected
+
+  def _message(self,topic,msg):
+    self.on_command(msg.decode())
+
+  def publish(self,subtopic,msg,qos=0,retain=False):
+    topic = self.prefix + "/" + subtopic
+    if self.connected:
+      try:
+        self.client.publish(topic,msg,retain=retain,qos=qos)
+        return
+      except OSError:
+        self.connected = False
+    if qos:
+      if len(self.queue) >= self.MAX_QUEUE:
+        self.queue.pop(0)
+      self.queue.append([topic,msg])
+
+  def state(self,door,actual):
+    position = door.stepper.position
+    self.publish(door.name + "/state","{0},{1}".format(actual,"" if position is None else position),retain=True)
+
+  def event(self,door,event,seconds=None):
+    self.publish(door.name + "/event","{0},{1}".format(event,"" if seconds is None else seconds),qos=1)
+
+  def sample(self,latest):
+    # a sensor that did not answer is an empty field
+    self.publish("sensors",",".join(_field(latest[key]) for key in ("temperature","pressure","humidity","lux")),qos=1)
+
+  def power(self,status):
+    self.publish("power",",".join(_field(status[key]) for key in ("level","battery","solar","charge")),retain=True)
+
+  def poll(self):
+    if not self.connected:
+      return
+    try:
+      while self.client.check_msg() is not None:
+        pass
+      if utime.ticks_diff(utime.ticks_ms(),self.client.last_io) > (self.client.keepalive * 500):
+        self.client.ping()
+    except OSError:
+      self.connected = False
+
+  def sleep(self):
+    # anything still unacked goes to RTC memory for the next wake
+    for topic,msg,retain,sent in self.client.inflight.values():
+      self.queue.append([topic.decode(),msg.decode()])
+    self.client.inflight = {}
+    rtcmem.set('mqtt_q',self.queue[-self.MAX_QUEUE:])
+    if self.connected:
+      try:
+        self.client.disconnect()
+      except OSError:
+        pass
+      self.connected = False
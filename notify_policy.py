@@ -0,0 +1,178 @@
+'''
+Which notifications go out, and when.
+
+Alerts (obstructed, stalled, fault) go out at once, but at most one per
+door and kind every RATES seconds, counted from the last one the service
+took (delivered()). The ones held back are counted for the digest.
+Routine opened/closed messages are not pushed one by one. They go into a
+daily digest, sent with the wake that closes the doors for the night, or
+with any wake once a day has gone by without one:
+
+  Daily: big 1 open 1 close 4.1-4.3s; obstructed 2 (1 held); temp
+  -3.2..4.5 avg 1.1C; humidity 55..70%
+
+The digest is built from the event log and the sensor history, so all
+it keeps itself is when the last one went out and the held back counts
+(in RTC memory).
+
+  "notifications": {"routine": "digest", "rate": {"obstructed": "600"}}
+
+routine is "digest", "each" (every move pushed, rate limited like the
+alerts) or "off".
+'''
+from eventlog import EVENTS
+import rtcmem
+
+ALERTS = ("obstructed","stalled","fault")
+# seconds between two notifications of a kind for one door
+RATES = {"opened": 0,"closed": 0,"obstructed": 600,"stalled": 600,"fault": 3600}
+# a digest goes with the evening close once this long after the last one
+DIGEST_AFTER = 12 * 3600
+# and with whatever wake comes first once this long
+DIGEST_LATEST = 26 * 3600
+
+
+def _range(low,high,fmt,sep="-"):
+  if fmt.format(low) == fmt.format(high):
+    return fmt.format(low)
+  return fmt.format(low) + sep + fmt.format(high)
+
+
+class NotificationPolicy:
+
+  def __init__(self,config=None):
+    config = config or {}
+    self.routine = config.get("routine","digest")
+    self.rates = dict(RATES)
+    for kind,seconds in config.get("rate",{}).items():
+      self.rates[kind] = int(seconds)
+    # {"sent": {"<kind><door>": t}, "held": {kind: n}, "digest": t,
+    #  "seq": last event in the digest}
+    self.state = rtcmem.get('notify',None) or {"sent": {},"held": {},"digest": None,"seq": None}
+    # the doors were closed this wake, the digest goes now if it is due
+    self.closed = False
+    # allowed this wake but not delivered yet, see delivered()
+    self.pending = set()
+
+  def allow(self,door,event,priority,now):
+    '''
+    True if a notification for event on door (its index) goes out now.
+    '''
+    if event == "closed":
+      self.closed = True
+    if priority <= 0 and event not in ALERTS:
+      if self.routine != "each":
+        return False
+    key = "{0}{1}".format(event,door)
+    last = self.state["sent"].get(key,None)
+    rate = self.rates.get(event,0)
+    if rate and key in self.pending:
+      # the one waiting to go out says the same
+      return False
+    if last is not None and 0 <= now - last < rate:
+      held = self.state["held"]
+      held[event] = held.get(event,0) + 1
+      rtcmem.set('notify',self.state)
+      return False
+    self.pending.add(key)
+    return True
+
+  def delivered(self,door,event,now,ok=True):
+    '''
+    The outcome of a notification allow() let through. The rate limit
+    only counts it from when the service took it (ok, a 2xx).
+    '''
+    key = "{0}{1}".format(event,door)
+    self.pending.discard(key)
+    if ok:
+      self.state["sent"][key] = now
+      rtcmem.set('notify',self.state)
+
+  def digest_due(self,now):
+    if self.routine != "digest":
+      return False
+    last = self.state["digest"]
+    if last is None or now < last:
+      # after a power cycle, the next evening close
+      return self.closed
+    if now - last >= DIGEST_LATEST:
+      return True
+    return self.closed and now - last >= DIGEST_AFTER
+
+  def digest(self,now,events,history,names):
+    '''
+    The digest text for everything since the last one (the last day after
+    a power cycle), from the event log and the sensor history.
+    '''
+    last = self.state["digest"]
+    since = now - 86400 if last is None or now < last else last
+    seq = self.state.get("seq",None)
+    doors = {}
+    alerts = {}
+    # the events by sequence number, one logged in the same second as the
+    # last digest went out is in that one or this one, not both
+    records = events.records(start=since) if seq is None else events.records(since=seq)
+    for seq,t,door,event,seconds in records:
+      name = EVENTS[event] if event < len(EVENTS) else None
+      if name in ALERTS:
+        alerts[name] = alerts.get(name,0) + 1
+        continue
+      if name not in ("opened","closed"):
+        continue
+      stats = doors.get(door,None)
+      if stats is None:
+        # opens, closes, fastest, slowest
+        stats = doors[door] = [0,0,None,None]
+      stats[0 if name == "opened" else 1] += 1
+      if seconds == seconds:
+        if stats[2] is None or seconds < stats[2]:
+          stats[2] = seconds
+        if stats[3] is None or seconds > stats[3]:
+          stats[3] = seconds
+
+    parts = []
+    for door in sorted(doors):
+      opens,closes,fastest,slowest = doors[door]
+      name = names[door] if door < len(names) else str(door)
+      part = "{0} {1} open {2} close".format(name,opens,closes)
+      if fastest is not None:
+        part += " " + _range(fastest,slowest,"{0:.1f}") + "s"
+      parts.append(part)
+    if not doors:
+      parts.append("no moves")
+    held = self.state["held"]
+    for kind in ALERTS:
+      if alerts.get(kind,0) or held.get(kind,0):
+        part = "{0} {1}".format(kind,alerts.get(kind,0))
+        if held.get(kind,0):
+          part += " ({0} held)".format(held[kind])
+        parts.append(part)
+    for field,label,fmt,unit in (("temperature","temp","{0:.1f}","C"),("humidity","humidity","{0:.0f}","%")):
+      low,high,mean = self._summary(history,field,since,now)
+      if low is None:
+        continue
+      part = label + " " + _range(low,high,fmt,"..")
+      if field == "temperature":
+        part += " avg " + fmt.format(mean)
+      parts.append(part + unit)
+    return "Daily: " + "; ".join(parts)
+
+  def _summary(self,history,field,start,end):
+    # min, max and mean of a field over the period, Nones without readings
+    seconds,rows = history.query(field,start,end,3600)
+    low = high = None
+    total = count = 0
+    for bucket,minimum,maximum,mean,n in rows:
+      if low is None or minimum < low:
+        low = minimum
+      if high is None or maximum > high:
+        high = maximum
+      total += mean * n
+      count += n
+    return low,high,(total / count if count else None)
+
+  def digest_sent(self,now,seq):
+    self.state["digest"] = now
+    self.state["seq"] = seq
+    self.state["held"] = {}
+    rtcmem.set('notify',self.state)
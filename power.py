@@ -0,0 +1,177 @@
+'''
+Battery and solar voltage from the ADC, and what the wake may spend
+given the charge left.
+
+  "power": {"battery_pin": "36", "battery_scale": "4.03",
+            "solar_pin": "39", "solar_scale": "8.0",
+            "empty": "11.6", "full": "12.7",
+            "saving_below": "50", "low_below": "25", "critical_below": "10"}
+
+A reading is the mean of SAMPLES ADC conversions with the highest and
+lowest left out, in volts at the pin (read_uv() is calibrated against
+the chip's own reference where the firmware has it), times scale (the
+divider ratio) plus offset. calibrate() works out the scale from a
+multimeter reading. The pins have to be ADC1 (32-39, ADC2 stops working
+with Wi-Fi on) and not one of the doors' pins, PowerPolicy refuses those.
+
+The charge is a straight line from empty to full volts, rough but good
+enough to pick a level:
+
+  normal    everything
+  saving    telemetry (MQTT, uploads) at most every half hour, the wakes
+            between operations at least 5 minutes apart
+  low       no NTP, no routine notifications, no status server, Wi-Fi
+            only for alerts and telemetry every 6 hours
+  critical  the doors only, no Wi-Fi unless the clock is lost
+
+A level is left downwards as soon as the charge is below it and upwards
+only HYSTERESIS percent above it, so a battery sagging under the motor
+does not flip the level every wake. Without a "power" section the level
+stays normal.
+'''
+from machine import ADC
+from machine import Pin
+import rtcmem
+
+LEVELS = ("normal","saving","low","critical")
+SAMPLES = 16
+HYSTERESIS = 5
+
+ALLOWS = {
+  "normal": ("network","ntp","status","notify","alert"),
+  "saving": ("network","ntp","status","notify","alert"),
+  "low": ("alert",),
+  "critical": (),
+}
+# seconds between telemetry wakes, None for never
+TELEMETRY_EVERY = {"normal": 0,"saving": 1800,"low": 6 * 3600,"critical": None}
+# shortest sleep between wakes that are not an operation
+WAKE_GAP = {"normal": 0,"saving": 300,"low": 900,"critical": 1800}
+
+
+class PowerMonitor:
+
+  def __init__(self,pin,scale=1.0,offset=0.0,samples=SAMPLES):
+    self.adc = ADC(Pin(pin))
+    try:
+      # the full 0..3.3V range
+      self.adc.atten(ADC.ATTN_11DB)
+    except (AttributeError,ValueError):
+      pass
+    self.scale = scale
+    self.offset = offset
+    self.samples = max(samples,3)
+
+  def _pin_volts(self):
+    if hasattr(self.adc,"read_uv"):
+      return self.adc.read_uv() / 1000000
+    return self.adc.read_u16() * 3.3 / 65535
+
+  def pin_volts(self):
+    total = 0
+    low = high = None
+    for _ in range(self.samples):
+      value = self._pin_volts()
+      total += value
+      if low is None or value < low:
+        low = value
+      if high is None or value > high:
+        high = value
+    return (total - low - high) / (self.samples - 2)
+
+  def read(self):
+    return self.pin_volts() * self.scale + self.offset
+
+  def calibrate(self,volts):
+    # the scale that makes read() say volts now, for the config
+    self.scale = (volts - self.offset) / self.pin_volts()
+    return self.scale
+
+
+# the pins of a door in config.json, see door.DEFAULT_PINS
+DOOR_PINS = ("stp","dir","slp","close_limit","open_limit","obstruction_limit")
+
+
+class PowerPolicy:
+
+  def __init__(self,config=None,door_pins=()):
+    config = config or {}
+    self.battery = None
+    self.solar = None
+    # an ADC on a door pin would take it over from the door
+    used = set(int(pins[key]) for pins in door_pins for key in DOOR_PINS if key in pins)
+    for key in ("battery_pin","solar_pin"):
+      if config.get(key,None) and int(config[key]) in used:
+        raise ValueError("{0} {1} is a door pin".format(key,config[key]))
+    if config.get("battery_pin",None):
+      self.battery = PowerMonitor(int(config["battery_pin"]),float(config.get("battery_scale","1")),
+                                  float(config.get("battery_offset","0")))
+    if config.get("solar_pin",None):
+      self.solar = PowerMonitor(int(config["solar_pin"]),float(config.get("solar_scale","1")),
+                                float(config.get("solar_offset","0")))
+    self.empty = float(config.get("empty","11.6"))
+    self.full = float(config.get("full","12.7"))
+    # charge percent below which each level after normal starts
+    self.below = [float(config.get(level + "_below",default)) for level,default in
+                  (("saving","50"),("low","25"),("critical","10"))]
+    # [level index, epoch s of the last telemetry]
+    self.state = rtcmem.get('power',None) or [0,None]
+    self.level = LEVELS[self.state[0]]
+    self.volts = None
+    self.solar_volts = None
+    self.charge = None
+
+  def update(self):
+    '''
+    Reads the voltages and moves the level, returns it.
+    '''
+    if self.solar:
+      self.solar_volts = self.solar.read()
+    if not self.battery:
+      return self.level
+    self.volts = self.battery.read()
+    charge = (self.volts - self.empty) * 100 / (self.full - self.empty)
+    self.charge = min(max(charge,0),100)
+    level = 0
+    while level < len(self.below) and self.charge < self.below[level]:
+      level += 1
+    current = self.state[0]
+    if level < current and self.charge < self.below[current - 1] + HYSTERESIS:
+      # not clearly back above the level it is in
+      level = current
+    self.state[0] = level
+    self.level = LEVELS[level]
+    rtcmem.set('power',self.state)
+    return self.level
+
+  def allows(self,what):
+    return what in ALLOWS[self.level]
+
+  def telemetry_due(self,now):
+    every = TELEMETRY_EVERY[self.level]
+    if every is None:
+      return False
+    last = self.state[1]
+    return last is None or now - last >= every or now < last
+
+  def telemetry_sent(self,now):
+    self.state[1] = now
+    rtcmem.set('power',self.state)
+
+  def wants_network(self,now,clock_valid):
+    # Wi-Fi this wake: the clock has to be set, or it is allowed and useful
+    if not clock_valid:
+      return True
+    return self.allows("network") or self.telemetry_due(now)
+
+  def next_wake(self,now,wake,operation_time):
+    # wakes between operations spaced out, never past the next operation
+    gap = WAKE_GAP[self.level]
+    if gap and wake - now < gap:
+      wake = now + gap
+      if operation_time and operation_time < wake:
+        wake = operation_time
+    return wake
+
+  def status(self):
+    return {"level": self.level,"battery": self.volts,"solar": self.solar_volts,"charge": self.charge}
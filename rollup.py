@@ -0,0 +1,252 @@
+'''
+Long term sensor history in a file that never grows. Samples are folded
+into 1 minute, 1 hour and 1 day buckets that keep the min, max, mean
+and count of every reading. Each tier is a ring of buckets in its own
+part of rollup.bin, and once it is full the newest bucket takes the
+place of the oldest.
+
+add() does the same small amount of work for every sample, however long
+the history: per tier the open bucket (kept in arrays) is updated and
+written back over its one slot. Nothing else in the file is touched.
+
+query() answers from the coarsest tier that still has the resolution
+asked for and reaches back far enough.
+'''
+import ustruct
+from array import array
+
+FIELDS = ("temperature","pressure","humidity","lux")
+# (seconds per bucket, buckets kept) finest first
+TIERS = ((60,120),(3600,336),(86400,400))
+
+MAGIC = 0x5231
+
+
+class Rollup:
+
+  def __init__(self,filename="rollup.bin",tiers=TIERS,fields=FIELDS):
+    self.filename = filename
+    self.tiers = tiers
+    self.fields = fields
+    # bucket start, then min, max, sum and count of every field
+    self.entry = "<l" + "fffH" * len(fields)
+    self.entry_size = ustruct.calcsize(self.entry)
+    self.header = "<H" + "HH" * len(tiers)
+    self.offsets = []
+    offset = ustruct.calcsize(self.header)
+    for seconds,size in tiers:
+      self.offsets.append(offset)
+      offset += size * self.entry_size
+    self.file_size = offset
+
+    # ring position and fill of every tier, and its open bucket
+    self.head = array('H',[0] * len(tiers))
+    self.used = array('H',[0] * len(tiers))
+    self.start = array('l',[0] * len(tiers))
+    self.values = [array('f',[0] * (3 * len(fields))) for _ in tiers]
+    self.counts = [array('H',[0] * len(fields)) for _ in tiers]
+    self._buf = bytearray(self.entry_size)
+    self.loaded = False
+
+  def _open(self):
+    try:
+      f = open(self.filename,"r+b")
+    except OSError:
+      f = open(self.filename,"w+b")
+    if not self.loaded:
+      self._load(f)
+    return f
+
+  def _load(self,f):
+    f.seek(0,2)
+    size = f.tell()
+    f.seek(0)
+    data = f.read(ustruct.calcsize(self.header))
+    if size != self.file_size or ustruct.unpack_from("<H",data)[0] != MAGIC:
+      # new, or laid out for other tiers, start the history over
+      self._create(f)
+    else:
+      header = ustruct.unpack_from(self.header,data)
+      for tier in range(len(self.tiers)):
+        self.head[tier] = header[1 + tier * 2]
+        self.used[tier] = header[2 + tier * 2]
+        if self.used[tier]:
+          self._read(f,tier,self.head[tier])
+          entry = ustruct.unpack_from(self.entry,self._buf)
+          self.start[tier] = entry[0]
+          values = self.values[tier]
+          counts = self.counts[tier]
+          for i in range(len(self.fields)):
+            values[i * 3] = entry[1 + i * 4]
+            values[i * 3 + 1] = entry[2 + i * 4]
+            values[i * 3 + 2] = entry[3 + i * 4]
+            counts[i] = entry[4 + i * 4]
+    self.loaded = True
+
+  def _create(self,f):
+    f.seek(0)
+    for i in range(self.entry_size):
+      self._buf[i] = 0
+    written = 0
+    while written < self.file_size:
+      part = min(self.entry_size,self.file_size - written)
+      f.write(self._buf if part == self.entry_size else self._buf[:part])
+      written += part
+    for tier in range(len(self.tiers)):
+      self.head[tier] = 0
+      self.used[tier] = 0
+    self._write_header(f)
+
+  def _write_header(self,f):
+    header = [MAGIC]
+    for tier in range(len(self.tiers)):
+      header.append(self.head[tier])
+      header.append(self.used[tier])
+    f.seek(0)
+    f.write(ustruct.pack(self.header,*header))
+
+  def _read(self,f,tier,slot):
+    f.seek(self.offsets[tier] + slot * self.entry_size)
+    f.readinto(self._buf)
+
+  def add(self,t,latest):
+    '''
+    Folds one sample (the sensors' latest dict, None readings are
+    skipped) taken at t into every tier.
+    '''
+    t = int(t)
+    f = self._open()
+    try:
+      for tier in range(len(self.tiers)):
+        self._fold(f,tier,t,latest)
+      self._write_header(f)
+    finally:
+      f.close()
+
+  def _fold(self,f,tier,t,latest):
+    seconds,size = self.tiers[tier]
+    bucket = t - t % seconds
+    values = self.values[tier]
+    counts = self.counts[tier]
+    if not self.used[tier] or bucket != self.start[tier]:
+      if self.used[tier]:
+        if bucket < self.start[tier]:
+          # older than the open bucket, the clock was set back
+          return
+        self.head[tier] = (self.head[tier] + 1) % size
+      self.used[tier] = min(self.used[tier] + 1,size)
+      self.start[tier] = bucket
+      for i in range(len(self.fields)):
+        counts[i] = 0
+        values[i * 3 + 2] = 0
+    for i in range(len(self.fields)):
+      value = latest.get(self.fields[i],None)
+      if value is None:
+        continue
+      count = counts[i]
+      if count == 0 or value < values[i * 3]:
+        values[i * 3] = value
+      if count == 0 or value > values[i * 3 + 1]:
+        values[i * 3 + 1] = value
+      values[i * 3 + 2] += value
+      if count < 65535:
+        counts[i] = count + 1
+    entry = [bucket]
+    for i in range(len(self.fields)):
+      entry.append(values[i * 3])
+      entry.append(values[i * 3 + 1])
+      entry.append(values[i * 3 + 2])
+      entry.append(counts[i])
+    ustruct.pack_into(self.entry,self._buf,0,*entry)
+    f.seek(self.offsets[tier] + self.head[tier] * self.entry_size)
+    f.write(self._buf)
+
+  def _oldest(self,f,tier):
+    # start of the oldest bucket a tier still holds, None if it is empty
+    if not self.used[tier]:
+      return None
+    seconds,size = self.tiers[tier]
+    self._read(f,tier,(self.head[tier] - self.used[tier] + 1) % size)
+    return ustruct.unpack_from("<l",self._buf)[0]
+
+  def pick(self,f,start,resolution):
+    # the coarsest tier no coarser than resolution that goes back to start,
+    # or failing that the one of those that goes back furthest
+    best = None
+    furthest = 0
+    reach = None
+    for tier in range(len(self.tiers)):
+      if tier and self.tiers[tier][0] > resolution:
+        break
+      oldest = self._oldest(f,tier)
+      if oldest is None:
+        continue
+      if oldest <= start:
+        best = tier
+      if reach is None or oldest <= reach:
+        furthest = tier
+        reach = oldest
+    return furthest if best is None else best
+
+  def select(self,start,resolution):
+    f = self._open()
+    try:
+      return self.pick(f,start,resolution)
+    finally:
+      f.close()
+
+  def covering(self,start):
+    # the finest tier that goes back to start, or failing that the coarsest
+    f = self._open()
+    try:
+      for tier in range(len(self.tiers)):
+        oldest = self._oldest(f,tier)
+        if oldest is not None and oldest <= start:
+          return tier
+    finally:
+      f.close()
+    return len(self.tiers) - 1
+
+  def entries(self,tier,start=None,end=None):
+    '''
+    The buckets of a tier that overlap start to end, oldest first, as
+    (start, min, max, sum, count, min, max, ...) tuples. Read one at a
+    time, the tier is never all in memory.
+    '''
+    seconds,size = self.tiers[tier]
+    # its own buffer, add() can run from another thread meanwhile
+    buf = bytearray(self.entry_size)
+    f = self._open()
+    try:
+      first = self.head[tier] - self.used[tier] + 1
+      for slot in range(first,first + self.used[tier]):
+        f.seek(self.offsets[tier] + (slot % size) * self.entry_size)
+        f.readinto(buf)
+        entry = ustruct.unpack_from(self.entry,buf)
+        if start is not None and entry[0] + seconds <= start:
+          continue
+        if end is not None and entry[0] >= end:
+          break
+        yield entry
+    finally:
+      f.close()
+
+  def newest(self,tier):
+    # start of the open bucket of a tier, None if it is empty
+    return self.start[tier] if self.used[tier] else None
+
+  def query(self,field,start,end=None,resolution=60):
+    '''
+    The history of one field from start (to end, or now) at buckets of
+    at most resolution seconds where the history still has them. Returns
+    (bucket seconds, [(bucket start, min, max, mean, count), ...]) oldest
+    first, buckets without a reading of the field are left out.
+    '''
+    index = self.fields.index(field)
+    tier = self.select(start,resolution)
+    rows = []
+    for entry in self.entries(tier,start,end):
+      count = entry[4 + index * 4]
+      if count:
+        rows.append((entry[0],entry[1 + index * 4],entry[2 + index * 4],entry[3 + index * 4] / count,count))
+    return self.tiers[tier][0],rows
@@ -0,0 +1,49 @@
+'''
+Small key/value store in RTC slow memory. It survives deep sleep (but
+not a power cycle), so it is the place for counters and queues that must
+carry over from one wake to the next without wearing the flash.
+'''
+import json
+from machine import RTC
+
+# RTC user memory on the ESP32, RTC.memory() raises past it
+SIZE = 2048
+
+_rtc = RTC()
+_data = None
+# entries save() had to drop to fit
+dropped = 0
+
+
+def _load():
+  global _data
+  if _data is None:
+    try:
+      _data = json.loads(_rtc.memory())
+    except:
+      # empty after a power cycle, or something else wrote to it
+      _data = {}
+  return _data
+
+
+def get(key,default=None):
+  return _load().get(key,default)
+
+
+def set(key,value):
+  _load()[key] = value
+
+
+def save():
+  # call once before deep sleep, writes everything in one go
+  global dropped
+  data = _load()
+  text = json.dumps(data)
+  while len(text) > SIZE and data:
+    # losing a queue beats failing to sleep, drop the biggest entry
+    key = max(data,key=lambda k: len(json.dumps(data[k])))
+    print("rtcmem: {0} bytes, dropping {1}".format(len(text),key))
+    del data[key]
+    dropped += 1
+    text = json.dumps(data)
+  _rtc.memory(text)
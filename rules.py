@@ -0,0 +1,232 @@
+'''
+Declarative door schedule. The "schedule" config section holds one rule
+per operation, for example
+
+  "schedule": {
+    "utc_offset": "-21600",
+    "open": "max(sunrise+2h, 07:00)",
+    "close": "civil_dusk",
+    "close_lux": {"below": "5", "minutes": "10", "from": "sunset-1h"},
+    "closed_below": "-15"
+  }
+
+A time rule is an event, an event+/-offset or a local HH:MM, or min()/
+max() of several of them. Events are the ones from solar.py, offsets take
+h/m/s (plain numbers are seconds). <op>_lux moves the operation earlier
+once the light has been past the threshold for that many minutes inside
+the window, closed_below holds the doors closed while it is colder.
+
+Rules are parsed once into (combine, terms) tuples. The resulting day
+timeline is kept in RTC memory, so a normal wake just scans a few entries
+and the answer is also how long to deep sleep.
+'''
+from binascii import crc32
+import json
+import utime
+import rtcmem
+from solar import Solar
+from solar import EVENTS
+
+MIN = 0
+MAX = 1
+
+# terms are (anchor, seconds), anchor is a solar event index or _MIDNIGHT
+_MIDNIGHT = len(EVENTS)
+
+_UNITS = {"h": 3600, "m": 60, "s": 1}
+
+OPERATIONS = ("open","close")
+
+
+class RuleError(ValueError):
+  pass
+
+
+def _duration(text):
+  text = text.strip()
+  if text[-1] in _UNITS:
+    return int(float(text[:-1]) * _UNITS[text[-1]])
+  return int(text)
+
+
+def _term(text):
+  text = text.strip()
+  if ":" in text:
+    hours,minutes = text.split(":")
+    return (_MIDNIGHT,int(hours) * 3600 + int(minutes) * 60)
+  name,offset = text,0
+  for sign in "+-":
+    if sign in text:
+      name,offset = text.split(sign,1)
+      offset = _duration(offset)
+      if sign == "-":
+        offset = -offset
+      break
+  name = name.strip()
+  if name not in EVENTS:
+    raise RuleError("unknown event " + name)
+  return (EVENTS.index(name),offset)
+
+
+def compile_rule(text):
+  '''
+  "max(sunrise+2h, 07:00)" -> (MAX, ((2, 7200), (6, 25200)))
+  '''
+  text = text.strip()
+  combine = MIN
+  if text.endswith(")"):
+    func,_,args = text[:-1].partition("(")
+    func = func.strip()
+    if func not in ("min","max"):
+      raise RuleError("unknown function " + func)
+    combine = MAX if func == "max" else MIN
+    text = args
+  return (combine,tuple(_term(term) for term in text.split(",")))
+
+
+def evaluate(rule,anchors):
+  # anchors: epoch seconds per solar event for one day, then local midnight
+  combine,terms = rule
+  best = None
+  for anchor,offset in terms:
+    base = anchors[anchor]
+    if base is None:
+      continue
+    t = base + offset
+    if best is None or (t > best if combine == MAX else t < best):
+      best = t
+  return best
+
+
+class Schedule:
+
+  def __init__(self,config,lat,lng,sunrise_offset=0,sunset_offset=0):
+    config = config or {}
+    # older configs only have the two offsets, they become the default rules
+    rules = {
+      "open": config.get("open","sunrise{0:+d}s".format(sunrise_offset)),
+      "close": config.get("close","sunset{0:+d}s".format(sunset_offset)),
+    }
+    self.rules = [compile_rule(rules[op]) for op in OPERATIONS]
+    self.lux = []
+    for op in OPERATIONS:
+      lux = config.get(op + "_lux",None)
+      if lux:
+        below = lux.get("below",None)
+        above = lux.get("above",None)
+        self.lux.append((None if below is None else float(below),
+                         None if above is None else float(above),
+                         int(lux.get("minutes","10")) * 60,
+                         compile_rule(lux.get("from","sunset-1h" if op == "close" else "sunrise-1h")),
+                         int(lux.get("every","120"))))
+      else:
+        self.lux.append(None)
+    # bring the network up while the doors move, or only once they stopped
+    self.network = [config.get(op + "_network","overlap") for op in OPERATIONS]
+    closed_below = config.get("closed_below",None)
+    self.closed_below = None if closed_below is None else float(closed_below)
+    self.hold_retry = int(config.get("hold_retry","900"))
+    self.utc_offset = int(config.get("utc_offset","0"))
+    self.solar = Solar(lat,lng)
+    self.key = crc32(json.dumps([config,lat,lng,sunrise_offset,sunset_offset]).encode())
+    self.timeline = None
+    self.next_operation = None
+    self.next_operation_time = None
+    # scheduled time of the entry in effect, None if a lux trigger moved it
+    self.operation_time = None
+
+  def plan(self,now):
+    '''
+    [[time, operation index, lux window start], ...] for yesterday, today
+    and tomorrow, sorted. Reused from RTC memory within the same UTC day.
+    '''
+    day = now // 86400
+    cached = rtcmem.get('sched',None)
+    if cached and cached[0] == day and cached[1] == self.key:
+      self.timeline = cached[2]
+      return self.timeline
+    timeline = []
+    for delta in (-1,0,1):
+      date = utime.localtime(now + delta * 86400)[:3]
+      midnight = utime.mktime(date + (0,0,0,0,0))
+      anchors = [None if minutes is None else midnight + int(minutes * 60) for minutes in self.solar.events(*date)]
+      anchors.append(midnight - self.utc_offset)
+      for index,rule in enumerate(self.rules):
+        t = evaluate(rule,anchors)
+        if t is None:
+          continue
+        lux = self.lux[index]
+        timeline.append([t,index,evaluate(lux[3],anchors) if lux else None])
+    timeline.sort()
+    rtcmem.set('sched',[day,self.key,timeline])
+    self.timeline = timeline
+    return timeline
+
+  def _lux_met(self,lux,latest):
+    below,above = lux[0],lux[1]
+    value = latest.get("lux",None) if latest else None
+    if value is None:
+      return False
+    return (below is not None and value < below) or (above is not None and value > above)
+
+  def evaluate(self,now,latest=None):
+    '''
+    The operation that should be in effect now ("open" or "close") and
+    the epoch second of the next wake needed to keep that true.
+    '''
+    timeline = self.plan(now)
+    current = None
+    index = 0
+    self.operation_time = None
+    while index < len(timeline) and timeline[index][0] <= now:
+      current = timeline[index][1]
+      self.operation_time = timeline[index][0]
+      index += 1
+    if index == len(timeline):
+      # nothing scheduled ahead (polar night/day), look again tomorrow
+      self.next_operation = None
+      self.next_operation_time = None
+      wake = now + 86400
+    else:
+      t,op,window = timeline[index]
+      self.next_operation = OPERATIONS[op]
+      self.next_operation_time = t
+      wake = t
+      lux = self.lux[op]
+      if lux and window is not None and op != current:
+        # lux early trigger, the run of samples past the threshold is kept
+        # across deep sleep as [entry time, first met time, fired]
+        state = rtcmem.get('lux',None)
+        if not state or state[0] != t:
+          state = [t,None,False]
+        if state[2]:
+          current = op
+          self.operation_time = None
+          wake = timeline[index + 1][0] if index + 1 < len(timeline) else t
+        elif now >= window:
+          if self._lux_met(lux,latest):
+            state[1] = state[1] or now
+            if now - state[1] >= lux[2]:
+              state[2] = True
+              current = op
+              self.operation_time = None
+          else:
+            state[1] = None
+          if not state[2]:
+            wake = min(t,now + lux[4])
+        else:
+          wake = window
+        rtcmem.set('lux',state)
+    if current is None:
+      # before the first entry, the opposite of what comes next
+      current = 1 - timeline[0][1] if timeline else 1
+    operation = OPERATIONS[current]
+    if operation == "open" and self.closed_below is not None:
+      temperature = latest.get("temperature",None) if latest else None
+      if temperature is not None and temperature < self.closed_below:
+        operation = "close"
+        wake = min(wake,now + self.hold_retry)
+    return operation,max(wake,now + 5)
+
+  def network_after(self,operation):
+    return self.network[OPERATIONS.index(operation)] == "after"
@@ -0,0 +1,45 @@
+from machine import I2C
+from machine import Pin
+from bme280_float import BME280
+from max44009 import MAX44009
+from array import array
+import utime
+
+
+class Sensors:
+  '''
+  The coop environment sensors on the I2C bus: a BME280 (temperature,
+  pressure, humidity) and a MAX44009 (lux). Either may be missing, its
+  readings are then left at None. read() updates latest in place.
+  '''
+
+  def __init__(self,scl=22,sda=21):
+    self.i2c = I2C(0,scl=Pin(scl),sda=Pin(sda))
+    try:
+      self.bme = BME280(i2c=self.i2c)
+    except OSError:
+      self.bme = None
+    try:
+      self.light = MAX44009(self.i2c)
+    except OSError:
+      self.light = None
+    self._bme_values = array("f",[0,0,0])
+    self.latest = {"temperature": None, "pressure": None, "humidity": None, "lux": None}
+    self.sample_time = 0
+
+  def read(self):
+    if self.bme:
+      try:
+        t,p,h = self.bme.read_compensated_data(self._bme_values)
+        self.latest["temperature"] = t
+        self.latest["pressure"] = p / 100
+        self.latest["humidity"] = h
+      except OSError:
+        pass
+    if self.light:
+      try:
+        self.latest["lux"] = self.light.illuminance_lux
+      except OSError:
+        pass
+    self.sample_time = utime.time()
+    return self.latest
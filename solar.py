@@ -0,0 +1,123 @@
+'''
+Sunrise, sunset and civil/nautical twilight, computed on the device with
+single precision floats. The sun's position is the Astronomical Almanac
+low precision one (good to about 0.01 deg this century), and each event
+is refined once at its own time of day. Times are minutes after 00:00 UTC of the given date (they
+can fall outside 0..1440 far from Greenwich), None if the sun never
+crosses that altitude on the day (polar day/night).
+
+host/solar_sweep.py checks every day of a year against the full NOAA
+algorithm: within 1 minute up to MAX_LATITUDE, except on days where the
+event comes within about 20 minutes of local solar noon or midnight. The
+sun only just reaches the altitude then and skims along it, so the 0.01
+deg of the sun's position moves the time by minutes (up to 1.3 in the
+sweep), in any calculator. Latitudes past MAX_LATITUDE are clamped to
+it.
+'''
+import math
+from array import array
+
+NAUTICAL_DAWN = 0
+CIVIL_DAWN = 1
+SUNRISE = 2
+SUNSET = 3
+CIVIL_DUSK = 4
+NAUTICAL_DUSK = 5
+
+EVENTS = ("nautical_dawn","civil_dawn","sunrise","sunset","civil_dusk","nautical_dusk")
+
+# cosine of the zenith angle for each event. sunrise/sunset (90.833 deg)
+# allows for refraction and the radius of the sun's disc
+_ZENITH_COS = array("f",[
+  math.cos(math.radians(102.0)),
+  math.cos(math.radians(96.0)),
+  math.cos(math.radians(90.833)),
+])
+_RISING = (True,True,True,False,False,False)
+_ZENITH = (0,1,2,2,1,0)
+
+# days before each month, non leap year
+_MONTH_DAYS = (0,31,59,90,120,151,181,212,243,273,304,334)
+
+_DEGREES = 180 / math.pi
+
+# refinements at the event's own time, more do not get closer
+ITERATIONS = 2
+MAX_LATITUDE = 70
+
+
+def day_of_year(year,month,day):
+  doy = _MONTH_DAYS[month - 1] + day
+  if month > 2 and (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+    doy += 1
+  return doy
+
+
+def days_since_2000(year,month,day):
+  # whole days from 2000-01-01, kept an int so the float math starts small
+  years = year - 2000
+  leaps = (years + 3) // 4 - (years + 99) // 100 + (years + 399) // 400
+  return 365 * years + leaps + day_of_year(year,month,day) - 1
+
+
+class Solar:
+
+  def __init__(self,lat,lng):
+    lat = min(max(lat,-MAX_LATITUDE),MAX_LATITUDE)
+    self.lat = lat
+    self.lng = lng
+    lat = math.radians(lat)
+    self.sin_lat = math.sin(lat)
+    self.cos_lat = math.cos(lat)
+    self.times = [None] * 6
+
+  def _series(self,days,minutes):
+    # equation of time (minutes) and declination (radians), n is days from J2000.0
+    n = days - 0.5 + minutes / 1440
+    L = (280.460 + 0.9856474 * n) % 360
+    g = math.radians((357.528 + 0.9856003 * n) % 360)
+    sin_g = math.sin(g)
+    # sin 2g by the double angle, saves a second sin()
+    lam = math.radians(L + 1.915 * sin_g + 0.020 * 2 * sin_g * math.cos(g))
+    eps = math.radians(23.439 - 0.0000004 * n)
+    sin_lam = math.sin(lam)
+    ra = math.atan2(math.cos(eps) * sin_lam,math.cos(lam)) * _DEGREES
+    eqtime = (L - ra + 180) % 360 - 180
+    return eqtime * 4,math.asin(math.sin(eps) * sin_lam)
+
+  def event(self,days,event):
+    zenith_cos = _ZENITH_COS[_ZENITH[event]]
+    rising = _RISING[event]
+    noon = 720 - 4 * self.lng
+    minutes = noon - 360 if rising else noon + 360
+    for _ in range(ITERATIONS):
+      eqtime,decl = self._series(days,minutes)
+      cos_ha = (zenith_cos - self.sin_lat * math.sin(decl)) / (self.cos_lat * math.cos(decl))
+      if cos_ha > 1 or cos_ha < -1:
+        return None
+      ha = math.acos(cos_ha) * _DEGREES
+      if rising:
+        minutes = noon - 4 * ha - eqtime
+      else:
+        minutes = noon + 4 * ha - eqtime
+    return minutes
+
+  def events(self,year,month,day):
+    '''
+    All six events for a date, indexed by NAUTICAL_DAWN..NAUTICAL_DUSK.
+    The returned list is reused by the next call.
+    '''
+    days = days_since_2000(year,month,day)
+    for event in range(6):
+      self.times[event] = self.event(days,event)
+    return self.times
+
+
+def bench(lat=45.0,lng=-90.0,runs=365):
+  # microseconds per events() call (all six events for one day)
+  import utime
+  solar = Solar(lat,lng)
+  start = utime.ticks_us()
+  for doy in range(runs):
+    solar.events(2024,1 + (doy % 12),1 + (doy % 28))
+  return utime.ticks_diff(utime.ticks_us(),start) // runs
@@ -0,0 +1,153 @@
+'''
+Read-only JSON status endpoint for auto mode. The response is rebuilt
+only when something changes (update()), so a request never touches flash
+or the I2C bus, it just writes the cached bytes. Served with uasyncio so
+several clients can be connected at once.
+
+/export streams the stored history instead, see export.py.
+'''
+try:
+  import uasyncio as asyncio
+except ImportError:
+  import asyncio
+import json
+import utime
+
+
+class EventBuffer:
+  '''
+  The last size door events in RAM, oldest first from items().
+  '''
+
+  def __init__(self,size=16):
+    self.size = size
+    self.slots = [None] * size
+    self.next = 0
+    self.count = 0
+
+  def add(self,door,event,seconds=None):
+    self.slots[self.next] = (utime.time(),door,event,seconds)
+    self.next = (self.next + 1) % self.size
+    self.count = min(self.count + 1,self.size)
+
+  def items(self):
+    start = (self.next - self.count) % self.size
+    for i in range(self.count):
+      yield self.slots[(start + i) % self.size]
+
+
+class StatusServer:
+
+  def __init__(self,controller,port=80,events=16):
+    self.controller = controller
+    self.port = port
+    self.events = EventBuffer(events)
+    self.exporter = controller.exporter()
+    self.response = b""
+    self.served = 0
+    self.update()
+
+  def update(self):
+    controller = self.controller
+    doors = {}
+    for door in controller.doors:
+      status = door.check_limits()
+      doors[door.name] = {
+        "target": status["target"],
+        "actual": status["actual"],
+        "state": door.state.name(),
+        "position": door.stepper.position,
+        "travel": door.stepper.travel,
+        "moving": door.moving(),
+        "telemetry": door.telemetry,
+      }
+    sensors = None
+    if controller.sensors:
+      sensors = controller.sensors.latest
+    body = json.dumps({
+      "time": utime.time(),
+      "mode": controller.mode,
+      "doors": doors,
+      "next_operation": getattr(controller,"next_operation",None),
+      "next_operation_time": controller.next_operation_time,
+      "events": [list(event) for event in self.events.items()],
+      "sensors": sensors,
+      "power": controller.power.status(),
+    }).encode()
+    self.response = b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+
+  async def handle(self,reader,writer):
+    try:
+      # every path but /export gets the status, the headers are discarded
+      request = await reader.readline()
+      while True:
+        line = await reader.readline()
+        if not line or line == b"\r\n":
+          break
+      parts = request.split(b" ")
+      path,_,query = (parts[1] if len(parts) > 1 else b"/").partition(b"?")
+      if path == b"/export":
+        await self.export(writer,query.decode())
+      else:
+        writer.write(self.response)
+        await writer.drain()
+      self.served += 1
+    except OSError:
+      pass
+    finally:
+      writer.close()
+      await writer.wait_closed()
+
+  async def export(self,writer,query):
+    try:
+      content_type,cursor,chunks = self.exporter.open(query)
+    except ValueError:
+      writer.write(b"HTTP/1.0 400 Bad Request\r\n\r\n")
+      await writer.drain()
+      return
+    writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: " + content_type.encode() +
+                 b"\r\nX-Cursor: " + str(cursor).encode() + b"\r\n\r\n")
+    for chunk in chunks:
+      writer.write(chunk)
+      await writer.drain()
+
+  async def serve(self):
+    await asyncio.start_server(self.handle,"0.0.0.0",self.port)
+    while True:
+      await asyncio.sleep(3600)
+
+  def run(self):
+    # runs in its own thread, the rest of the firmware is thread based
+    asyncio.run(self.serve())
+
+
+async def _load_client(host,port,requests,times):
+  for _ in range(requests):
+    start = utime.ticks_ms()
+    reader,writer = await asyncio.open_connection(host,port)
+    writer.write(b"GET / HTTP/1.0\r\n\r\n")
+    await writer.drain()
+    while await reader.read(512):
+      pass
+    writer.close()
+    await writer.wait_closed()
+    times.append(utime.ticks_diff(utime.ticks_ms(),start))
+
+
+def load(host,port=80,clients=8,requests=25):
+  '''
+  Load benchmark, run from another board or a host with a utime shim.
+  Returns (requests per second, median ms, worst ms).
+  '''
+  times = []
+
+  async def main():
+    tasks = [asyncio.create_task(_load_client(host,port,requests,times)) for _ in range(clients)]
+    for task in tasks:
+      await task
+
+  start = utime.ticks_ms()
+  asyncio.run(main())
+  elapsed = max(utime.ticks_diff(utime.ticks_ms(),start),1)
+  times.sort()
+  return (len(times) * 1000) // elapsed,times[len(times) // 2],times[-1]
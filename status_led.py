@@ -0,0 +1,114 @@
+'''
+Status and activity LEDs driven by the peripherals instead of a thread.
+The status LED plays its pattern from an RMT channel in loop mode, the
+activity LED is a LEDC PWM channel, so once show() returns a pattern
+costs no CPU at all. Without RMT the status LED falls back to LEDC too.
+
+Patterns are timing tables: the status LED in 50 ms slots (1 is on),
+the activity LED as (Hz, duty of 1023). They are turned into RMT levels
+and PWM settings once, at import.
+
+Before deep sleep hold() parks both pins on a fixed level and holds
+them there, lit if a fault was shown this wake, dark otherwise.
+'''
+from machine import Pin
+from machine import PWM
+
+try:
+  from esp32 import RMT
+except ImportError:
+  RMT = None
+
+try:
+  from esp32 import gpio_deep_sleep_hold
+except ImportError:
+  gpio_deep_sleep_hold = None
+
+SLOT_MS = 50
+# RMT clock is 80MHz / CLOCK_DIV, a slot has to fit in one 15 bit pulse
+CLOCK_DIV = 255
+SLOT_TICKS = (80000000 // CLOCK_DIV) * SLOT_MS // 1000
+
+PATTERNS = {
+  "off":         ("0",                      (1,0)),
+  "boot":        ("1",                      (1,1023)),
+  "idle":        ("1" + "0" * 39,           (1,20)),
+  "configuring": ("10",                     (5,512)),
+  "connecting":  ("1100",                   (2,512)),
+  "moving":      ("1111100000",             (2,900)),
+  "fault":       ("101000" + "0" * 14,      (4,512)),
+}
+
+
+def _ledc(slots):
+  # the nearest single LEDC blink to a slot pattern, never under 1Hz
+  period = len(slots) * SLOT_MS
+  return (max(1000 // period,1),(slots.count("1") * 1023) // len(slots))
+
+
+# name: (rmt levels, status LED ledc fallback, activity LED ledc)
+TABLE = {}
+for _name,(_slots,_activity) in PATTERNS.items():
+  TABLE[_name] = (tuple(int(slot) for slot in _slots),_ledc(_slots),_activity)
+
+
+class StatusLed:
+
+  def __init__(self,pin=2,activity_pin=19,channel=0):
+    # a pin held through the last deep sleep has to be let go first
+    self.pin = Pin(pin,Pin.OUT,value=0,hold=False)
+    self.activity_pin = Pin(activity_pin,Pin.OUT,value=0,hold=False)
+    self.channel = channel
+    self.rmt = None
+    self.pwm = None
+    self.activity = None
+    self.current = None
+    # a fault stays on show for the rest of the wake and through the sleep
+    self.fault = False
+
+  def show(self,name):
+    if name == self.current or (self.fault and name != "fault"):
+      return
+    levels,ledc,activity = TABLE[name]
+    if RMT:
+      if self.rmt is None:
+        self.rmt = RMT(self.channel,pin=self.pin,clock_div=CLOCK_DIV)
+      self.rmt.loop(True)
+      self.rmt.write_pulses(SLOT_TICKS,levels)
+    else:
+      self._ledc_status(*ledc)
+    if self.activity is None:
+      self.activity = PWM(self.activity_pin,freq=activity[0],duty=activity[1])
+    else:
+      self.activity.init(freq=activity[0],duty=activity[1])
+    self.current = name
+    if name == "fault":
+      self.fault = True
+
+  def _ledc_status(self,freq,duty):
+    if self.pwm is None:
+      self.pwm = PWM(self.pin,freq=freq,duty=duty)
+    else:
+      self.pwm.init(freq=freq,duty=duty)
+
+  def release(self):
+    # hand both pins back to plain GPIO
+    if self.rmt:
+      self.rmt.loop(False)
+      self.rmt.deinit()
+      self.rmt = None
+    if self.pwm:
+      self.pwm.deinit()
+      self.pwm = None
+    if self.activity:
+      self.activity.deinit()
+      self.activity = None
+    self.current = None
+
+  def hold(self):
+    self.release()
+    self.pin.init(Pin.OUT,value=1 if self.fault else 0,hold=True)
+    self.activity_pin.init(Pin.OUT,value=0,hold=True)
+    if gpio_deep_sleep_hold:
+      # the activity pin is not an RTC pin, its hold needs this as well
+      gpio_deep_sleep_hold(True)
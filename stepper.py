@@ -0,0 +1,267 @@
+from machine import PWM
+import utime
+import json
+
+try:
+  from machine import Counter
+except ImportError:
+  Counter = None
+
+
+class Stepper:
+  '''
+  Drives the STP pin with PWM and keeps count of every step sent, so the
+  door position is known while it moves. Position is in steps, 0 is the
+  close limit and travel is the number of steps to the open limit, learned
+  on a full open/close and kept in travel.json.
+
+  Steps are integrated from the programmed PWM frequency. If count_pin is
+  given (a pin jumpered to STP) the pulses are counted in hardware instead,
+  on PCNT unit counter_unit, which every door needs its own of.
+  tick() must be called every TICK_MS while moving, the controller shares
+  one timer between all doors for that.
+
+  stop() ramps down for a commanded stop. halt() is for the end stops,
+  it cuts STP and SLP at once and is safe to call from a hard irq.
+  '''
+
+  TICK_MS = 20
+
+  def __init__(self,stp,slp,motor_min,motor_max,ramp_time,ramp_steps,approach_steps=400,count_pin=None,counter_unit=0,travel_file="travel.json"):
+    self.stp = stp
+    self.slp = slp
+    self.motor_min = motor_min
+    self.approach_steps = approach_steps
+    self.travel_file = travel_file
+    self.tune(motor_max,ramp_steps,ramp_time)
+
+    self.pwm = None
+    self.freq = 0
+    self.direction = 0      # 1 opening, -1 closing, 0 stopped
+    self.target = None      # position to stop at, None runs to an end stop
+    self.on_target = None
+    self.steps = 0          # steps counted during the current move
+    self.start_position = None
+    self.from_open = False
+    self.move_start = 0
+    self._step_us = 0
+    self._last_tick = 0
+    # ticks_us of the last halt(), and how long after the limit edge it came
+    self._halt_us = None
+    self.halt_latency_us = None
+
+    # None until an end stop or travel.json tells us where the door is
+    self.position = None
+    self.travel = None
+
+    self._counter = None
+    if count_pin is not None and Counter:
+      try:
+        self._counter = Counter(counter_unit, src=count_pin, edge=Counter.RISING)
+      except Exception:
+        self._counter = None
+
+    self.load()
+
+  def tune(self,motor_max,ramp_steps,ramp_time):
+    # takes effect from the next start()
+    self.motor_max = motor_max
+    self.ramp_steps = ramp_steps
+    self.ramp_time = ramp_time
+    # acceleration in Hz per second and Hz per tick, from the ramp tuning
+    self.accel = (ramp_steps * 1000) // max(ramp_time,1)
+    self.tick_accel = max((self.accel * self.TICK_MS) // 1000,1)
+
+  def load(self):
+    try:
+      with open(self.travel_file,"r") as f:
+        travel = json.loads(f.read())
+        self.travel = travel.get('travel',None)
+        self.position = travel.get('position',None)
+    except:
+      # never calibrated, the first full move will learn the travel
+      pass
+
+  def save(self):
+    with open(self.travel_file,'w',encoding = 'utf-8') as f:
+      f.write(json.dumps({'travel': self.travel, 'position': self.position}))
+
+  def sync(self,open_limit,close_limit):
+    # snap the position to whichever end stop the door is sitting on
+    if close_limit == 1:
+      self.position = 0
+    elif open_limit == 1 and self.travel:
+      self.position = self.travel
+    self.from_open = (open_limit == 1)
+
+  def start(self,direction,target=None,on_target=None):
+    self.direction = direction
+    self.target = target
+    self.on_target = on_target
+    self.steps = 0
+    self._step_us = 0
+    self._halt_us = None
+    self.start_position = self.position
+    if self._counter:
+      self._counter.value(0)
+
+    self.slp.value(1)
+    self.freq = self.motor_min
+    self.pwm = PWM(self.stp, freq=self.freq)
+    self.move_start = utime.ticks_ms()
+    self._last_tick = utime.ticks_us()
+
+  def moving(self):
+    return self.direction != 0
+
+  def _update(self):
+    # no steps went out after a halt, count up to it and no further
+    now = utime.ticks_us() if self._halt_us is None else self._halt_us
+    if self._counter:
+      self.steps = self._counter.value()
+    else:
+      self._step_us += self.freq * utime.ticks_diff(now,self._last_tick)
+      self.steps = self._step_us // 1000000
+    self._last_tick = now
+    if self.direction and self.start_position is not None:
+      self.position = self.start_position + (self.direction * self.steps)
+
+  def end_position(self):
+    # where this move is expected to stop, None if we cant know yet
+    if self.target is not None:
+      return self.target
+    if self.direction < 0:
+      return 0
+    return self.travel
+
+  def top_speed(self,remaining):
+    # fastest frequency that still lets us ramp down to motor_min before
+    # entering the approach zone in front of the end position
+    if remaining is None:
+      return self.motor_max
+    remaining -= self.approach_steps
+    if remaining <= 0:
+      return self.motor_min
+    speed = int((self.motor_min * self.motor_min + 2 * self.accel * remaining) ** 0.5)
+    return min(speed,self.motor_max)
+
+  def tick(self):
+    if not self.direction or self._halt_us is not None:
+      return
+    self._update()
+    end = self.end_position()
+    remaining = None
+    if end is not None and self.position is not None:
+      remaining = (end - self.position) * self.direction
+
+    if self.target is not None and remaining is not None and remaining <= 0:
+      # reached a partial position, there is no switch to stop us here
+      if self.on_target:
+        self.on_target()
+      return
+
+    freq = min(self.freq + self.tick_accel,self.top_speed(remaining))
+    if freq != self.freq:
+      self.freq = freq
+      self.pwm.freq(freq)
+
+  def at_limit(self,opened):
+    # an end stop was hit, pin the position and learn the travel from it
+    if self.direction:
+      self._update()
+    if opened:
+      if self.direction > 0 and self.start_position is not None:
+        self.travel = self.start_position + self.steps
+      self.position = self.travel
+    else:
+      if self.direction < 0 and self.from_open:
+        self.travel = self.steps
+      self.position = 0
+    # stop counting, anything sent from here is into the end stop
+    self.direction = 0
+
+  def halt(self,edge_us=None):
+    # no allocation in here, the position is caught up by at_limit()/stop()
+    if self.pwm is None or self._halt_us is not None:
+      return
+    self.pwm.deinit()
+    self.slp.value(0)
+    self._halt_us = utime.ticks_us()
+    if edge_us is not None:
+      self.halt_latency_us = utime.ticks_diff(self._halt_us,edge_us)
+
+  def halted(self):
+    return self._halt_us is not None
+
+  def stop(self):
+    if self.direction:
+      self._update()
+    self.direction = 0
+
+    if self.pwm:
+      if self._halt_us is None:
+        motor_freq = self.freq
+        while motor_freq > self.motor_min:
+          self.pwm.freq(motor_freq)
+          motor_freq -= self.ramp_steps
+          utime.sleep_ms(self.ramp_time)
+        self.pwm.deinit()
+      self.pwm = None
+      self.save()
+
+    self.freq = 0
+    self.slp.value(0)
+
+  def eta(self,target=None):
+    '''
+    Predicted seconds for a move from the current position to target (or
+    the end stop in the current direction), None if not calibrated yet.
+    '''
+    if self.position is None or self.travel is None:
+      return None
+    if target is None:
+      target = self.travel if self.direction >= 0 else 0
+    steps = abs(target - self.position)
+    ramp = (self.motor_max - self.motor_min) / self.accel
+    cruise = steps - (self.approach_steps + ((self.motor_max + self.motor_min) * ramp))
+    if cruise < 0:
+      cruise = 0
+    return ramp * 2 + (self.approach_steps / self.motor_min) + (cruise / self.motor_max)
+
+
+def bench(stp=27,slp=14,edge=25,limit=32,count=None,freq=1000,runs=20):
+  '''
+  Limit edge to last step pulse, in microseconds. Needs the edge pin
+  jumpered to the limit pin, and for the pulse count the count pin
+  jumpered to STP. Returns (mean, worst, steps sent after the halt).
+  '''
+  import os
+  from machine import Pin
+  stepper = Stepper(Pin(stp,Pin.OUT),Pin(slp,Pin.OUT),freq,freq,1,1,count_pin=count,travel_file="bench.json")
+  trigger = Pin(edge,Pin.OUT,value=0)
+  switch = Pin(limit,Pin.IN)
+  # [ticks_us of the edge, pulses counted at the halt]
+  seen = [0,0]
+  def handler(pin):
+    stepper.halt(seen[0])
+    if stepper._counter:
+      seen[1] = stepper._counter.value()
+  switch.irq(trigger=Pin.IRQ_RISING,handler=handler,hard=True)
+  total = worst = late = 0
+  for _ in range(runs):
+    stepper.start(1)
+    utime.sleep_ms(50)
+    seen[0] = utime.ticks_us()
+    trigger.value(1)
+    utime.sleep_ms(20)
+    if stepper._counter:
+      late += stepper._counter.value() - seen[1]
+    latency = stepper.halt_latency_us
+    total += latency
+    worst = max(worst,latency)
+    stepper.stop()
+    trigger.value(0)
+    utime.sleep_ms(20)
+  switch.irq(handler=None)
+  os.remove("bench.json")
+  return total // runs,worst,late
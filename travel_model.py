@@ -0,0 +1,79 @@
+import ustruct
+
+OPEN = 0
+CLOSE = 1
+
+_RECORD = "<Hff"
+_RECORD_SIZE = ustruct.calcsize(_RECORD)
+
+
+class TravelModel:
+  '''
+  Running mean and variance of how long the door takes to open and close,
+  kept in travel.bin as two packed (count, mean, m2) records. Once a few
+  moves have been seen, bound() gives the longest a healthy move should
+  take so a jam is caught a few seconds late instead of at the timeout.
+  '''
+
+  def __init__(self,filename="travel.bin",min_samples=3,sigmas=4,slack=2,max_samples=50):
+    self.filename = filename
+    self.min_samples = min_samples
+    self.sigmas = sigmas
+    self.slack = slack
+    # once this many samples are in, older moves fade out so the model
+    # follows the door as it wears or the weather changes
+    self.max_samples = max_samples
+    self.stats = [[0,0.0,0.0],[0,0.0,0.0]]
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.filename,"rb") as f:
+        data = f.read()
+      for i in (OPEN,CLOSE):
+        n,mean,m2 = ustruct.unpack_from(_RECORD,data,i * _RECORD_SIZE)
+        self.stats[i] = [n,mean,m2]
+    except:
+      # no history yet, or a short/corrupt file. start over
+      self.stats = [[0,0.0,0.0],[0,0.0,0.0]]
+
+  def save(self):
+    with open(self.filename,"wb") as f:
+      for n,mean,m2 in self.stats:
+        f.write(ustruct.pack(_RECORD,n,mean,m2))
+
+  def reset(self):
+    # the door moves differently now (new tuning), learn it again
+    self.stats = [[0,0.0,0.0],[0,0.0,0.0]]
+    self.save()
+
+  def record(self,direction,seconds):
+    # Welford update, capped so the model keeps adapting
+    stat = self.stats[direction]
+    n = min(stat[0] + 1,self.max_samples)
+    delta = seconds - stat[1]
+    stat[1] += delta / n
+    stat[2] += delta * (seconds - stat[1])
+    if stat[0] + 1 > self.max_samples:
+      stat[2] *= (n - 1) / n
+    stat[0] = n
+    self.save()
+
+  def mean(self,direction):
+    return self.stats[direction][1]
+
+  def stddev(self,direction):
+    n,mean,m2 = self.stats[direction]
+    if n < 2:
+      return 0.0
+    return (m2 / (n - 1)) ** 0.5
+
+  def bound(self,direction,fallback):
+    '''
+    Seconds after which a move in this direction is considered stalled.
+    fallback is used until enough moves have been recorded.
+    '''
+    if self.stats[direction][0] < self.min_samples:
+      return fallback
+    bound = self.mean(direction) + (self.sigmas * self.stddev(direction)) + self.slack
+    return min(bound,fallback)
@@ -0,0 +1,132 @@
+'''
+Uploads what the door has stored since the last successful upload: the
+door events from eventlog.py, the sensor buckets from rollup.py and the
+wakes noted with note_wake(), in one batch.py request at the end of the
+wake, while the radio is on anyway.
+
+The cursors (last event sent, first sample bucket still to send) live
+in RTC memory and only move once the server has answered 2xx. A batch
+that failed is simply built again next wake, with whatever came since,
+and a long backlog goes out MAX_EVENTS/MAX_SAMPLES at a time. After a
+power cycle the cursors are gone and everything still stored is sent
+again, the collector keys on the sequence numbers and bucket starts.
+
+  "upload": {"host": "collector.local", "port": "8080", "path": "/upload"}
+
+MicroPython's zlib only decompresses, the deflate module (1.21 on) is
+used to compress where the firmware has it.
+'''
+try:
+  import deflate
+except ImportError:
+  deflate = None
+try:
+  import zlib
+except ImportError:
+  zlib = None
+import io
+import machine
+import batch
+import rtcmem
+from http_client import HTTPClient
+
+MAX_EVENTS = 400
+MAX_SAMPLES = 400
+# wakes waiting in RTC memory, the oldest are dropped past this. About
+# 40 bytes each as JSON, it has to fit in rtcmem.SIZE with the rest
+MAX_WAKES = 12
+HEADERS = (b"Content-Type: application/octet-stream\r\n",)
+
+
+def compress(data):
+  if deflate and hasattr(deflate,"DeflateIO"):
+    stream = io.BytesIO()
+    with deflate.DeflateIO(stream,deflate.ZLIB) as packer:
+      packer.write(data)
+    return stream.getvalue()
+  if zlib and hasattr(zlib,"compress"):
+    return zlib.compress(data)
+  return None
+
+
+def note_wake(woke,awake_ms,settled=None,latency_ms=None):
+  '''
+  Keeps what a wake cost for the next batch: when it woke (epoch s), how
+  long it was up, the schedule error settled in it (scheduled, ms) and
+  how long its notifications took to go out.
+  '''
+  wakes = rtcmem.get('wakes',None) or []
+  scheduled,error = settled or (None,None)
+  wakes.append([int(woke),int(awake_ms),scheduled,error,latency_ms])
+  rtcmem.set('wakes',wakes[-MAX_WAKES:])
+
+
+class Uploader:
+
+  def __init__(self,config,history,events):
+    port = int(config.get("port","443"))
+    self.http = HTTPClient(config["host"],port,tls=(port == 443))
+    self.path = config.get("path","/upload").encode()
+    self.history = history
+    self.events = events
+    self.device = machine.unique_id()
+    # [last event seq sent, start of the first sample bucket still to send]
+    self.cursor = rtcmem.get('upload',None) or [0,0]
+    # (events, sample buckets, payload bytes) of the last batch built
+    self.last = None
+    self.sent_wakes = 0
+
+  def build(self,now):
+    '''
+    Returns (payload, cursor once it is sent), payload None if there is
+    nothing new.
+    '''
+    seq,since = self.cursor
+    events = []
+    for record in self.events.records(since=seq):
+      events.append(record)
+      if len(events) >= MAX_EVENTS:
+        break
+    tier = self.history.covering(since)
+    seconds = self.history.tiers[tier][0]
+    samples = []
+    for entry in self.history.entries(tier,since):
+      if entry[0] < since:
+        continue
+      samples.append(entry)
+      if len(samples) >= MAX_SAMPLES:
+        break
+    wakes = rtcmem.get('wakes',None) or []
+    if not events and not samples and not wakes:
+      return None,self.cursor
+
+    cursor = [events[-1][0] if events else seq,since]
+    if samples:
+      last = samples[-1][0]
+      # a bucket that can still fill up goes again next time
+      cursor[1] = last + seconds if last + seconds <= now else last
+    payload = batch.encode(self.device,now,events,samples,seconds,self.history.fields,compress,wakes)
+    self.sent_wakes = len(wakes)
+    self.last = (len(events),len(samples),len(payload))
+    return payload,cursor
+
+  def upload(self,now):
+    '''
+    Sends one batch, True once the server has it (or there was nothing to
+    send).
+    '''
+    payload,cursor = self.build(int(now))
+    if payload is None:
+      return True
+    try:
+      status,body = self.http.request(b"POST",self.path,payload,HEADERS)
+    except OSError:
+      status = None
+    finally:
+      self.http.close()
+    if status is None or not 200 <= status < 300:
+      return False
+    self.cursor = cursor
+    rtcmem.set('upload',cursor)
+    rtcmem.set('wakes',(rtcmem.get('wakes',None) or [])[self.sent_wakes:])
+    return True
@@ -0,0 +1,166 @@
+'''
+Plans deep sleep wakes so the door moves on time instead of one boot
+late. The duration of each boot phase (boot, config, sensors, wifi,
+ntp) is measured on every wake and kept in RTC memory as a running mean
+and deviation. A wake is scheduled early by the phases that have to
+finish before the door can act, and by the RTC drift learned from NTP.
+
+Every scheduled move records how far from the scheduled time it really
+started. The RTC is only trusted once NTP has corrected it, so the error
+is settled after the sync and goes into a small histogram in RTC memory.
+'''
+import machine
+import utime
+import rtcmem
+
+# error histogram bin edges, ms (negative is early)
+ERROR_EDGES = (-5000,-1000,-250,-50,50,250,1000,5000)
+
+
+def _now_ms():
+  time_ns = getattr(utime,"time_ns",None)
+  if time_ns:
+    return time_ns() // 1000000
+  return utime.time() * 1000
+
+
+class _Phase:
+
+  def __init__(self,planner):
+    self.planner = planner
+    self.name = None
+    self.start = 0
+
+  def __enter__(self):
+    self.start = utime.ticks_ms()
+    return self
+
+  def __exit__(self,*args):
+    self.planner.record(self.name,utime.ticks_diff(utime.ticks_ms(),self.start))
+    return False
+
+
+class WakePlanner:
+
+  def __init__(self,margin_ms=500,weight=4):
+    self.margin_ms = margin_ms
+    # the running stats move 1/weight of the way to each new sample
+    self.weight = weight
+    self.phases = rtcmem.get('phases',{})
+    # [scheduled epoch s, acted epoch ms by the RTC], waiting for NTP
+    self.pending = rtcmem.get('wake_act',None)
+    self.errors = rtcmem.get('wake_err',None) or [[0] * (len(ERROR_EDGES) + 1),0,0,0]
+    # RTC drift over deep sleep, parts per million (positive runs slow)
+    self.drift_ppm = rtcmem.get('drift',0)
+    self.slept_at = rtcmem.get('slept_at',None)
+    # (scheduled epoch s, error ms) of the move settled this wake
+    self.settled = None
+    self._phase = _Phase(self)
+    # ticks restart at every reset, so this is the boot up to here
+    self.record("boot",utime.ticks_ms())
+
+  def record(self,name,ms):
+    stats = self.phases.get(name,None)
+    if stats is None:
+      stats = [ms,0]
+    else:
+      delta = ms - stats[0]
+      stats[0] += delta // self.weight
+      stats[1] += (abs(delta) - stats[1]) // self.weight
+    self.phases[name] = stats
+
+  def phase(self,name):
+    # with planner.phase("wifi"): ...
+    self._phase.name = name
+    return self._phase
+
+  def clock_valid(self):
+    # a deep sleep wake after an NTP sync keeps the time, a power cycle does not
+    return machine.reset_cause() == machine.DEEPSLEEP_RESET and rtcmem.get('synced',None) is not None
+
+  def lead_ms(self,phases):
+    lead = self.margin_ms
+    for name in phases:
+      stats = self.phases.get(name,None)
+      if stats:
+        lead += stats[0] + 2 * stats[1]
+    return lead
+
+  def sleep_ms(self,wake_at,phases):
+    '''
+    Deep sleep length for the phases to be done by wake_at (epoch s),
+    corrected for the RTC drift. Never less than a second.
+    '''
+    ms = wake_at * 1000 - _now_ms() - self.lead_ms(phases)
+    ms = ms * 1000000 // (1000000 + self.drift_ppm)
+    return max(int(ms),1000)
+
+  def acted(self,scheduled,synced=False):
+    # a scheduled move just started. Unless the clock was already set this
+    # wake, the error is settled by sync()
+    if synced:
+      self._error(_now_ms() - scheduled * 1000,scheduled)
+    else:
+      self.pending = [scheduled,_now_ms()]
+
+  def wait_for(self,due,phases):
+    # woke early on purpose, sleep out the rest so the move starts on time
+    ms = due * 1000 - _now_ms()
+    if 0 < ms <= 2 * self.lead_ms(phases) + 1000:
+      utime.sleep_ms(int(ms))
+      return True
+    return False
+
+  def sync(self,settime):
+    '''
+    Sets the clock with settime() (ntptime.settime) and uses the step it
+    made to learn the drift and settle the error of the last move.
+    '''
+    before = _now_ms()
+    start = utime.ticks_ms()
+    settime()
+    elapsed = utime.ticks_diff(utime.ticks_ms(),start)
+    after = _now_ms()
+    correction = after - (before + elapsed)
+    if self.slept_at is not None:
+      slept = before - self.slept_at
+      if slept > 60000:
+        ppm = correction * 1000000 // slept
+        self.drift_ppm += (ppm - self.drift_ppm) // self.weight
+      self.slept_at = None
+    if self.pending:
+      self._error(self.pending[1] + correction - self.pending[0] * 1000,self.pending[0])
+      self.pending = None
+    rtcmem.set('synced',after // 1000)
+    return correction
+
+  def _error(self,ms,scheduled):
+    self.settled = (scheduled,int(ms))
+    bins,count,total,worst = self.errors
+    index = 0
+    while index < len(ERROR_EDGES) and ms >= ERROR_EDGES[index]:
+      index += 1
+    bins[index] += 1
+    if abs(ms) > abs(worst):
+      worst = ms
+    self.errors = [bins,count + 1,total + ms,worst]
+
+  def save(self):
+    # before deep sleep
+    rtcmem.set('phases',self.phases)
+    rtcmem.set('wake_act',self.pending)
+    rtcmem.set('wake_err',self.errors)
+    rtcmem.set('drift',self.drift_ppm)
+    rtcmem.set('slept_at',_now_ms())
+
+  def report(self):
+    for name,stats in self.phases.items():
+      print("{0}: {1}ms +/- {2}".format(name,stats[0],stats[1]))
+    print("rtc drift: {0}ppm".format(self.drift_ppm))
+    bins,count,total,worst = self.errors
+    print("operations: {0}, mean error {1}ms, worst {2}ms".format(count,total // max(count,1),worst))
+    low = None
+    for index,n in enumerate(bins):
+      high = ERROR_EDGES[index] if index < len(ERROR_EDGES) else None
+      print("  {0} .. {1}ms: {2}".format("" if low is None else low,"" if high is None else high,n))
+      low = high